@@ -1,5 +1,6 @@
 import os
 import tempfile
+import time
 from typing import List
 import requests
 import nest_asyncio
@@ -18,13 +19,23 @@ from app_utils import (
     display_tool_calls,
     export_chat_history,
     rename_session_widget,
-    get_all_sessions,
+    get_session_page,
+    next_session_name,
+    load_session_messages,
     insert_messages,
     restart_agent,
     get_answer,
     save_message_to_db,
+    record_stream_metrics,
 )
-from models.agent import get_agent
+from models.agent import (
+    agent_pool, session_runs, record_history_turn, is_context_free, get_cached_answer, cache_answer,
+    resources, start_background_loading,
+)
+from models.case_summary import schedule_case_state_update
+from config.settings import SESSION_PAGE_SIZE
+from utils.ollama_scheduler import SchedulerBusy
+from utils.tracing import tracer
 nest_asyncio.apply()
 st.set_page_config(
     page_title="MedRAG",
@@ -55,14 +66,33 @@ payload = {
     "session_id": "session_001"
 }
 
-def download_case(user_id: str, session_id: str):
+def download_case(user_id: str, session_id: str, timeout: float = 600, poll_interval: float = 1.0):
     base_url = "http://localhost:8000"
-    payload = {"user_id": user_id, "session_id": session_id}
+    payload = {"user_id": user_id, "session_id": session_id, "format": "pdf"}
 
     try:
-        # 向后端请求 PDF 数据
-        response = requests.post(f"{base_url}/generate_case_pdf", json=payload)
-
+        # 提交异步生成任务，轮询状态，完成后再下载 PDF，避免长请求超时
+        response = requests.post(f"{base_url}/jobs", json=payload)
+        if response.status_code != 200:
+            st.error(f"提交病例报告任务失败: {response.status_code} {response.text}")
+            return None
+        job_id = response.json()["job_id"]
+
+        deadline = time.time() + timeout
+        while True:
+            response = requests.get(f"{base_url}/jobs/{job_id}")
+            if response.status_code != 200:
+                st.error(f"查询病例报告任务失败: {response.status_code} {response.text}")
+                return None
+            if response.json()["status"] in ("done", "failed"):
+                break
+            if time.time() >= deadline:
+                st.error(f"病例报告生成超时（{timeout:.0f} 秒），请稍后重试")
+                return None
+            time.sleep(poll_interval)
+
+        # 失败的任务由结果接口返回具体错误
+        response = requests.get(f"{base_url}/jobs/{job_id}/result")
         # 成功返回 PDF 内容（字节流）
         if response.status_code == 200:
             return response.content  # 返回 PDF 的二进制内容
@@ -75,6 +105,9 @@ def download_case(user_id: str, session_id: str):
 
 
 def main():
+    # 首次运行时在后台并行加载索引、存储等资源，页面无需等待；提问时只等待用到的资源
+    start_background_loading()
+
     ####################################################################
     # App header
     ####################################################################
@@ -99,71 +132,39 @@ def main():
     )
     model_id = model_options[selected_model]
 
-    ####################################################################
-    # Initialize Agent
-    ####################################################################
-    # agentic_rag_agent: Agent
-    if (
-        "agentic_rag_agent" not in st.session_state
-        or st.session_state["agentic_rag_agent"] is None
-        or st.session_state.get("current_model") != model_id
-    ):
-        logger.info("---*--- Creating new Agentic RAG  ---*---")
-        agentic_rag_agent = get_agent(session_id=st.session_state.get("current_session_name"), user_id=payload["user_id"])
-        st.session_state["agentic_rag_agent"] = agentic_rag_agent
-        st.session_state["current_model"] = model_id
-    else:
-        agentic_rag_agent = st.session_state["agentic_rag_agent"]
-
-    if "chat_sessions" not in st.session_state:
-        st.session_state["chat_sessions"] = get_all_sessions(DB_PATH)
     if "current_session_name" not in st.session_state:
-        session_count = len(st.session_state["chat_sessions"])
-        st.session_state["current_session_name"] = f"session_{session_count+1:03d}"
+        st.session_state["current_session_name"] = next_session_name(DB_PATH)
+    if "session_page" not in st.session_state:
+        st.session_state["session_page"] = 0
 
     ####################################################################
-    # Load Agent Session from the database
+    # Agent pool
     ####################################################################
-    # Check if session ID is already in session state
-    session_id_exists = (
-        "agentic_rag_agent_session_id" in st.session_state
-        and st.session_state["agentic_rag_agent_session_id"]
-    )
+    # 不再为每个浏览器会话构建并保存 Agent：需要时从池中借出预先配置好的实例（指令、工具、模型只构建一次），
+    # 绑定当前会话后使用，用完归还；会话历史在 load_session() / run() 时按 session_id 从存储读取
+    def acquire_agent():
+        return agent_pool(model_id).acquire(
+            session_id=st.session_state["current_session_name"], user_id=payload["user_id"]
+        )
 
-    if not session_id_exists:
+    # Initialize messages if it doesn't exist yet
+    if "messages" not in st.session_state:
+        st.session_state["messages"] = []
+
+    ####################################################################
+    # Load runs from the database
+    ####################################################################
+    # 界面上还没有消息时（新打开页面）才需要从存储中读取本会话的运行记录
+    agent_runs = []
+    if len(st.session_state["messages"]) == 0:
         try:
-            st.session_state["agentic_rag_agent_session_id"] = (
-                agentic_rag_agent.load_session()
-            )
+            with acquire_agent() as agent:
+                agent.load_session()
+                agent_runs = session_runs(agent)
         except Exception as e:
             logger.error(f"Session load error: {str(e)}")
             st.warning("无法创建会话，请检查数据库是否运行！")
             # Continue anyway instead of returning, to avoid breaking session switching
-    elif (
-        st.session_state["agentic_rag_agent_session_id"]
-        and hasattr(agentic_rag_agent, "memory")
-        and agentic_rag_agent.memory is not None
-        and not agentic_rag_agent.memory.runs
-    ):
-        # If we have a session ID but no runs, try to load the session explicitly
-        try:
-            agentic_rag_agent.load_session(
-                st.session_state["agentic_rag_agent_session_id"]
-            )
-        except Exception as e:
-            logger.error(f"Failed to load existing session: {str(e)}")
-            # Continue anyway
-
-    ####################################################################
-    # Load runs from memory
-    ####################################################################
-    agent_runs = []
-    if hasattr(agentic_rag_agent, "memory") and agentic_rag_agent.memory is not None:
-        agent_runs = agentic_rag_agent.memory.runs
-
-    # Initialize messages if it doesn't exist yet
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = []
 
     # Only populate messages from agent runs if we haven't already
     if len(st.session_state["messages"]) == 0 and len(agent_runs) > 0:
@@ -175,6 +176,14 @@ def main():
             # Check if _run is an object with response attribute
             if hasattr(_run, "response") and _run.response is not None:
                 add_message("assistant", _run.response.content, _run.response.tools)
+            # v2 Memory 保存的是 RunResponse：取本轮（非历史注入）的用户消息与回答
+            if not hasattr(_run, "response") and getattr(_run, "messages", None):
+                user_message = next(
+                    (m for m in reversed(_run.messages) if m.role == "user" and not m.from_history), None
+                )
+                if user_message is not None:
+                    add_message("user", user_message.content)
+                add_message("assistant", _run.content, _run.tools)
     elif len(agent_runs) == 0 and len(st.session_state["messages"]) == 0:
         logger.debug("No run history found")
 
@@ -198,6 +207,16 @@ def main():
     # Utility buttons
     ###############################################################
     st.sidebar.markdown("#### 🛠️ 功能")
+    use_answer_cache = st.sidebar.checkbox(
+        "⚡ 相似问题直接使用缓存回答", value=True, key="use_answer_cache"
+    )
+    if not resources.is_ready():
+        states = {"pending": "等待", "loading": "加载中", "failed": "失败"}
+        st.sidebar.caption("⏳ " + "，".join(
+            f"{name}: {states[status['state']]}"
+            + (f"（{max(0, status['retry_at'] - time.time()):.0f} 秒后重试）" if status["state"] == "failed" else "")
+            for name, status in resources.status().items() if status["state"] != "ready"
+        ))
     #col1, col2, col3 = st.sidebar.columns([1, 1, 1])  # Equal width columns
 
     if st.sidebar.button(
@@ -269,22 +288,59 @@ def main():
             resp_container = st.empty()
             with st.spinner("🤔 思考中..."):
                 response = ""
+                tracer.new_trace()
+                turn_start = time.perf_counter()
                 try:
-                    # Run the agent and stream the response
-                    run_response = agentic_rag_agent.run(question, stream=True)
-                    for _resp_chunk in run_response:
-                        # Display tool calls if available
-                        if hasattr(_resp_chunk, "tool") and _resp_chunk.tool:
-                            display_tool_calls(tool_calls_container, [_resp_chunk.tool])
-                        # Display response
-                        if _resp_chunk.content is not None:
-                            response += _resp_chunk.content
+                    with acquire_agent() as agentic_rag_agent:
+                        # 会话首轮的独立提问可走语义回答缓存，命中时不再调用大模型
+                        # 同时以界面上的消息数与存储中本会话的运行记录判断是否为会话首轮
+                        cacheable = (
+                            use_answer_cache
+                            and len(st.session_state["messages"]) <= 1
+                            and is_context_free(agentic_rag_agent)
+                        )
+                        cached_answer = get_cached_answer(agentic_rag_agent, question) if cacheable else None
+                        if cached_answer is not None:
+                            response = cached_answer
                             resp_container.markdown(response)
-                    add_message(
-                        "assistant", response, agentic_rag_agent.run_response.tools
-                    )
-                    answer_text = get_answer(agentic_rag_agent.run_response)
-                    save_message_to_db(st.session_state["current_session_name"], payload["user_id"], "assistant", answer_text)
+                            add_message("assistant", response)
+                            answer_text = cached_answer
+                        else:
+                            # Run the agent and stream the response
+                            stream_start = time.perf_counter()
+                            first_token_at = None
+                            chunk_count = 0
+                            # 每次调用对话模型时占用 interactive 名额（见 models/agent.py ScheduledOllama），工具检索期间不占用；
+                            # Ollama 排队过深时快速失败，不在报告生成之后无限等待
+                            run_response = agentic_rag_agent.run(question, stream=True)
+                            for _resp_chunk in run_response:
+                                # Display tool calls if available
+                                if hasattr(_resp_chunk, "tool") and _resp_chunk.tool:
+                                    display_tool_calls(tool_calls_container, [_resp_chunk.tool])
+                                # Display response
+                                if _resp_chunk.content is not None:
+                                    if first_token_at is None:
+                                        first_token_at = time.perf_counter()
+                                    chunk_count += 1
+                                    response += _resp_chunk.content
+                                    resp_container.markdown(response)
+                            record_stream_metrics(agentic_rag_agent.run_response, stream_start, first_token_at, chunk_count)
+                            add_message(
+                                "assistant", response, agentic_rag_agent.run_response.tools
+                            )
+                            answer_text = get_answer(agentic_rag_agent.run_response)
+                            if cacheable:
+                                cache_answer(agentic_rag_agent, question, answer_text)
+                        save_message_to_db(st.session_state["current_session_name"], payload["user_id"], "assistant", answer_text)
+                        # 本轮问答写入历史问答表与向量索引（只在写入时向量化一次）
+                        record_history_turn(payload["user_id"], question, answer_text, st.session_state["current_session_name"])
+                        # 未整理的消息较多时在后台合并进滚动病例状态，报告生成时无需处理完整对话
+                        schedule_case_state_update(payload["user_id"], st.session_state["current_session_name"])
+                        tracer.record("turn.total", time.perf_counter() - turn_start, cached=cached_answer is not None)
+                except SchedulerBusy:
+                    busy_message = "当前咨询人数较多，请稍后再试。"
+                    add_message("assistant", busy_message)
+                    st.warning(busy_message)
                 except Exception as e:
                     error_message = f"Sorry, I encountered an error: {str(e)}"
                     add_message("assistant", error_message)
@@ -293,33 +349,36 @@ def main():
     ####################################################################
     # Session selector
     ####################################################################
-    rename_session_widget(agentic_rag_agent)
+    rename_session_widget(acquire_agent)
 
     ####################################################################
     # History session selector
     ####################################################################
     
     st.sidebar.markdown("#### 💬 历史会话")
-    # 每次展示前都重新加载数据库，保证最新
-    st.session_state["chat_sessions"] = get_all_sessions(DB_PATH)
-    session_names = [i for i in list(st.session_state["chat_sessions"].keys())]
+    # 只查询当前用户的一页会话目录，渲染开销与总消息数无关
+    page = st.session_state["session_page"]
+    sessions, total = get_session_page(DB_PATH, payload["user_id"], page, SESSION_PAGE_SIZE)
     with st.sidebar.container():
-        for idx, name in enumerate(session_names):
+        for session in sessions:
+            name = session["session_id"]
             button_label = f"👉 {name}" if name == st.session_state.get("current_session_name") else name
-            if st.sidebar.button(button_label, key=f"session_{idx}"):
-                # 1. 保存当前会话（如果有内容且不是当前历史会话）
-                current_name = st.session_state.get("current_session_name")
-                if (
-                    st.session_state.get("messages")
-                    and len(st.session_state["messages"]) > 0
-                    and current_name is not None
-                    and current_name not in st.session_state["chat_sessions"]
-                ):
-                    st.session_state["chat_sessions"][current_name] = st.session_state["messages"].copy()
-                # 2. 切换到目标历史会话
-                st.session_state["messages"] = st.session_state["chat_sessions"][name].copy()
+            help_text = f"{session['title']}（{session['message_count']} 条消息）" if session["title"] else None
+            if st.sidebar.button(button_label, key=f"session_{name}", help=help_text):
+                # 切换到目标历史会话（当前会话的消息已逐条写入数据库）
+                st.session_state["messages"] = load_session_messages(DB_PATH, payload["user_id"], name)
                 st.session_state["current_session_name"] = name
                 st.rerun()
+    page_count = max(1, -(-total // SESSION_PAGE_SIZE))
+    if page_count > 1:
+        col_prev, col_page, col_next = st.sidebar.columns([1, 1, 1])
+        if col_prev.button("◀", disabled=page == 0, key="session_page_prev"):
+            st.session_state["session_page"] = page - 1
+            st.rerun()
+        col_page.markdown(f"{page + 1}/{page_count}")
+        if col_next.button("▶", disabled=page >= page_count - 1, key="session_page_next"):
+            st.session_state["session_page"] = page + 1
+            st.rerun()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,14 @@
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, Callable, ContextManager, Dict, List, Optional
 
 import streamlit as st
 # from agentic_rag import get_agentic_rag_agent
 from agno.agent import Agent
 from agno.models.response import ToolExecution
 from agno.utils.log import logger
-import sqlite3
 from utils.case_db import CaseStorage
+from config.settings import SESSION_PAGE_SIZE
+from utils.tracing import tracer
 
 DB_PATH = "history/case.db"
 
@@ -101,8 +103,9 @@ def display_tool_calls(tool_calls_container, tools: List[ToolExecution]):
                     )
 
 
-def rename_session_widget(agent: Agent) -> None:
+def rename_session_widget(acquire_agent: Callable[[], ContextManager[Agent]]) -> None:
     """Rename the current session of the agent and save to storage"""
+    # acquire_agent() 从池中借出绑定到当前会话的 Agent，只在编辑 / 保存时借用
 
     container = st.sidebar.container()
 
@@ -111,16 +114,19 @@ def rename_session_widget(agent: Agent) -> None:
         st.session_state.session_edit_mode = False
 
     # 只有 session_id 存在时才允许重命名
-    can_rename = hasattr(agent, "session_id") and agent.session_id
+    can_rename = bool(st.session_state.get("current_session_name"))
 
     if st.sidebar.button("✎ 重命名当前会话", disabled=not can_rename):
         st.session_state.session_edit_mode = True
         st.rerun()
 
     if st.session_state.session_edit_mode and can_rename:
+        with acquire_agent() as agent:
+            agent.load_session()
+            current_name = agent.session_name
         new_session_name = st.sidebar.text_input(
             "Enter new name:",
-            value=agent.session_name,
+            value=current_name,
             key="session_name_input",
         )
         if st.sidebar.button("Save", type="primary"):
@@ -129,39 +135,34 @@ def rename_session_widget(agent: Agent) -> None:
                 old_session_name = st.session_state.get("current_session_name")
                 case_db = CaseStorage()
                 case_db.update_session_id(old_session_name, new_session_name)
-                agent.rename_session(new_session_name)
+                with acquire_agent() as agent:
+                    agent.rename_session(new_session_name)
                 # 同步Streamlit会话名
                 st.session_state["current_session_name"] = new_session_name
-                # 同步历史会话key
-                if (
-                    "chat_sessions" in st.session_state
-                    and old_session_name in st.session_state["chat_sessions"]
-                ):
-                    st.session_state["chat_sessions"][new_session_name] = st.session_state["chat_sessions"].pop(old_session_name)
                 st.session_state.session_edit_mode = False
                 st.rerun()
     elif st.session_state.session_edit_mode and not can_rename:
         st.sidebar.warning("当前会话未初始化，无法重命名。")
 
 
-def get_all_sessions(DB_PATH):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT session_id, user_id, role, message, created_at FROM case_records ORDER BY created_at")
-    rows = cursor.fetchall()
-    conn.close()
-    # 按 session_id 分组
-    sessions = {}
-    for session_id, user_id, role, message, created_at in rows:
-        if session_id not in sessions:
-            sessions[session_id] = []
-        sessions[session_id].append({
-            "role": role,
-            "content": message,
-            "user_id": user_id,
-            "created_at": created_at
-        })
-    return sessions
+def get_session_page(DB_PATH, user_id, page=0, page_size=SESSION_PAGE_SIZE):
+    """分页读取当前用户的会话目录，返回 (会话列表, 会话总数)"""
+    case_db = CaseStorage(DB_PATH)
+    sessions = case_db.list_sessions(user_id, limit=page_size, offset=page * page_size)
+    return sessions, case_db.count_sessions(user_id)
+
+
+def next_session_name(DB_PATH):
+    """新会话名：session_00数字（按已有会话数递增）"""
+    return f"session_{CaseStorage(DB_PATH).count_sessions() + 1:03d}"
+
+
+def load_session_messages(DB_PATH, user_id, session_id):
+    """点击历史会话时才加载该会话的消息"""
+    return [
+        {"role": role, "content": message}
+        for role, message in CaseStorage(DB_PATH).get_messages(user_id, session_id)
+    ]
 
 
 
@@ -234,43 +235,28 @@ def insert_messages(DB_PATH, session_id, user_id, messages):
     """批量插入一组消息到数据库"""
     if not messages or len(messages) == 0:
         return  # 空会话不写入数据库
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    for msg in messages:
-        cursor.execute(
-            "INSERT INTO case_records (session_id, user_id, role, message) VALUES (?, ?, ?, ?)",
-            (session_id, user_id, msg["role"], msg["content"])
-        )
-    conn.commit()
-    conn.close()
+    CaseStorage(DB_PATH).save_messages(session_id, user_id, messages)
 
 def restart_agent():
     """Reset the agent and clear chat history"""
     logger.debug("---*--- Restarting Agent ---*---")
-    # 只有当前会话是最新会话时才保存
+    # 只有当前会话尚未写入数据库时才保存
+    current_name = st.session_state.get("current_session_name")
     if (
         st.session_state.get("messages")
         and len(st.session_state["messages"]) > 0
-        and st.session_state.get("current_session_name") not in st.session_state["chat_sessions"]
+        and not CaseStorage(DB_PATH).session_exists(current_name)
     ):
-        st.session_state["chat_sessions"][st.session_state.get("current_session_name")] = st.session_state["messages"].copy()
         # === 新增：写入数据库 ===
         user_id = st.session_state.get("user_id", "default_user")
         # 生成 session_id，格式为 session_00数字
-        all_sessions = get_all_sessions(DB_PATH)
-        session_count = len(all_sessions)
-        session_id = f"session_{session_count+1:03d}"
+        session_id = next_session_name(DB_PATH)
         insert_messages(DB_PATH, session_id, user_id, st.session_state["messages"])
-    # 清空
-    st.session_state["agentic_rag_agent"] = None
-    st.session_state["agentic_rag_agent_session_id"] = None
+    # 清空（Agent 每次运行从池中借用，无需重建）
     st.session_state["messages"] = []
     # 新会话名也用 session_00数字
-    all_sessions = get_all_sessions(DB_PATH)
-    session_count = len(all_sessions)
-    st.session_state["current_session_name"] = f"session_{session_count+1:03d}"
-    # 关键：从数据库重新加载 chat_sessions
-    st.session_state["chat_sessions"] = all_sessions
+    st.session_state["current_session_name"] = next_session_name(DB_PATH)
+    st.session_state["session_page"] = 0
     st.rerun()
 
 def get_answer(resp):
@@ -292,7 +278,29 @@ def get_answer(resp):
     return "[无有效回答]"
 
 
+def record_stream_metrics(run_response, stream_start, first_token_at, chunk_count):
+    """记录流式回答的首 token 延迟（TTFT）、生成耗时与每 token 耗时（tokens/s 的倒数）"""
+    end = time.perf_counter()
+    if first_token_at is None:
+        tracer.record("llm.stream", end - stream_start, tokens=0)
+        return
+    # 优先使用模型返回的输出 token 数，没有时以流式分片数近似
+    metrics = getattr(run_response, "metrics", None) or {}
+    output_tokens = metrics.get("output_tokens") if isinstance(metrics, dict) else None
+    if isinstance(output_tokens, list):
+        output_tokens = sum(t for t in output_tokens if t)
+    tokens = output_tokens or chunk_count
+    generate_seconds = end - first_token_at
+    tracer.record("llm.ttft", first_token_at - stream_start)
+    tracer.record(
+        "llm.generate", generate_seconds, tokens=tokens,
+        tokens_per_s=round(tokens / generate_seconds, 2) if generate_seconds > 0 else None,
+    )
+    if tokens:
+        tracer.record("llm.time_per_token", generate_seconds / tokens)
+    tracer.record("llm.stream", end - stream_start, tokens=tokens)
+
+
 def save_message_to_db(session_id, user_id, role, content):
-    """保存单条消息到 case.db"""
-    case_db = CaseStorage()
-    case_db.save_message(session_id, user_id, role, content)
\ No newline at end of file
+    """保存单条消息到 case.db（由后台写线程合并提交）"""
+    CaseStorage(DB_PATH).save_message(session_id, user_id, role, content)
\ No newline at end of file
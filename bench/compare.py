@@ -0,0 +1,49 @@
+"""
+对比两次基准测试结果：
+
+    python -m bench.compare bench/results/base.json bench/results/new.json
+"""
+import argparse
+import json
+
+
+def flatten(node, prefix=""):
+    """把嵌套结果展开为 {"scenario.metric.sub": 数值}"""
+    items = {}
+    if isinstance(node, dict):
+        for key, value in node.items():
+            items.update(flatten(value, f"{prefix}.{key}" if prefix else key))
+    elif isinstance(node, (int, float)) and not isinstance(node, bool):
+        items[prefix] = node
+    return items
+
+
+def compare(base, new):
+    """返回 [(指标, 旧值, 新值, 变化百分比)]"""
+    base_items = flatten(base.get("scenarios", {}))
+    new_items = flatten(new.get("scenarios", {}))
+    rows = []
+    for key in sorted(set(base_items) | set(new_items)):
+        old, cur = base_items.get(key), new_items.get(key)
+        change = (cur - old) / old * 100 if old not in (None, 0) and cur is not None else None
+        rows.append((key, old, cur, change))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="对比两次基准测试结果")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--filter", default="", help="只显示包含该字符串的指标，如 p95")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"base: {base['meta']['commit']}  new: {new['meta']['commit']}")
+    for key, old, cur, change in compare(base, new):
+        if args.filter not in key:
+            continue
+        change_text = f"{change:+.1f}%" if change is not None else "-"
+        print(f"{key:<60} {old if old is not None else '-':>14} {cur if cur is not None else '-':>14} {change_text:>9}")
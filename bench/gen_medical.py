@@ -0,0 +1,100 @@
+"""
+生成合成的 medical.json（JSONL，字段与真实知识库一致），用于不同规模下的基准测试。
+
+    python -m bench.gen_medical --records 10000 --output bench/data/medical_10k.json
+"""
+import argparse
+import json
+import os
+import random
+
+CATEGORIES = [
+    ["疾病百科", "内科", "呼吸内科"], ["疾病百科", "内科", "消化内科"], ["疾病百科", "内科", "心内科"],
+    ["疾病百科", "外科", "骨外科"], ["疾病百科", "外科", "普外科"], ["疾病百科", "儿科"],
+    ["疾病百科", "妇产科"], ["疾病百科", "皮肤科"], ["疾病百科", "眼科"], ["疾病百科", "耳鼻喉科"],
+]
+ORGANS = ["肺", "胃", "心", "肝", "肾", "肠", "脾", "胆", "支气管", "咽", "皮肤", "关节", "眼", "鼻"]
+KINDS = ["炎", "病", "综合征", "功能不全", "结石", "溃疡", "感染", "肿大", "息肉", "损伤"]
+PREFIXES = ["急性", "慢性", "病毒性", "细菌性", "过敏性", "先天性", "继发性", "原发性", "", ""]
+SYMPTOMS = [
+    "发热", "咳嗽", "咳痰", "头痛", "头晕", "乏力", "恶心", "呕吐", "腹痛", "腹泻", "胸闷", "胸痛",
+    "心悸", "气短", "皮疹", "瘙痒", "关节痛", "食欲不振", "失眠", "盗汗", "水肿", "黄疸", "鼻塞", "咽痛",
+]
+DRUGS = [
+    "阿莫西林胶囊", "布洛芬缓释胶囊", "头孢克肟分散片", "奥美拉唑肠溶胶囊", "蒙脱石散", "氯雷他定片",
+    "复方甘草片", "对乙酰氨基酚片", "阿奇霉素片", "硝苯地平缓释片", "二甲双胍片", "维生素C片",
+]
+FOODS = ["鸡蛋", "牛奶", "豆腐", "小米粥", "苹果", "香蕉", "菠菜", "南瓜", "鲫鱼", "瘦肉"]
+BAD_FOODS = ["辣椒", "白酒", "咖啡", "油条", "肥肉", "浓茶", "螃蟹", "花椒"]
+CHECKS = ["血常规", "尿常规", "胸部X线", "腹部B超", "心电图", "肝功能", "肾功能", "CT", "胃镜", "C反应蛋白"]
+DEPARTMENTS = ["内科", "外科", "儿科", "妇产科", "皮肤科", "眼科", "耳鼻喉科", "中医科"]
+SENTENCES = [
+    "本病多见于中老年人群，起病可急可缓。", "常因受凉、劳累或饮食不当诱发。", "部分患者可有家族遗传倾向。",
+    "早期症状不典型，容易被忽视。", "病程较长者可出现并发症。", "规范治疗后大多数患者预后良好。",
+    "应注意休息，保持良好的生活习惯。", "避免接触已知过敏原。", "症状加重时应及时就医。",
+]
+
+
+def make_entry(i, rng, desc_sentences):
+    name = f"{rng.choice(PREFIXES)}{rng.choice(ORGANS)}{rng.choice(KINDS)}{i}"
+    symptoms = rng.sample(SYMPTOMS, rng.randint(3, 6))
+    return {
+        "_id": {"$oid": f"{i:024x}"},
+        "name": name,
+        "desc": name + "是一种常见疾病。" + "".join(rng.choice(SENTENCES) for _ in range(desc_sentences)),
+        "category": rng.choice(CATEGORIES),
+        "prevent": "".join(rng.choice(SENTENCES) for _ in range(3)),
+        "cause": "".join(rng.choice(SENTENCES) for _ in range(3)),
+        "symptom": symptoms,
+        "yibao_status": rng.choice(["是", "否"]),
+        "get_prob": f"{rng.uniform(0.001, 0.5):.3f}%",
+        "easy_get": rng.choice(["无特定人群", "老年人", "儿童", "孕妇", "免疫力低下者"]),
+        "get_way": rng.choice(["无传染性", "呼吸道传播", "接触传播"]),
+        "acompany": [f"{rng.choice(PREFIXES)}{rng.choice(ORGANS)}{rng.choice(KINDS)}" for _ in range(2)],
+        "cure_department": rng.sample(DEPARTMENTS, 2),
+        "cure_way": rng.sample(["药物治疗", "支持性治疗", "手术治疗", "康复治疗", "中医治疗"], 2),
+        "cure_lasttime": f"{rng.randint(1, 12)}周",
+        "cured_prob": f"{rng.randint(50, 99)}%",
+        "common_drug": rng.sample(DRUGS, 2),
+        "cost_money": f"{rng.randint(500, 20000)}元",
+        "check": rng.sample(CHECKS, 3),
+        "do_eat": rng.sample(FOODS, 4),
+        "not_eat": rng.sample(BAD_FOODS, 3),
+        "recommand_drug": rng.sample(DRUGS, 4),
+        "drug_detail": [f"某某药业{d}({d})" for d in rng.sample(DRUGS, 3)],
+    }
+
+
+def generate(output, records, seed=0, desc_sentences=8):
+    """写入 records 条记录，返回 [(名称, 症状列表)]，供生成查询使用"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    topics = []
+    with open(output, "w", encoding="utf-8") as f:
+        for i in range(records):
+            entry = make_entry(i, rng, desc_sentences)
+            topics.append((entry["name"], entry["symptom"]))
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    return topics
+
+
+def load_topics(path):
+    """读取已生成的 medical.json，返回 [(名称, 症状列表)]（复用已构建的工作目录时使用）"""
+    topics = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                topics.append((entry["name"], entry["symptom"]))
+    return topics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成合成 medical.json")
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--output", default=os.path.join("bench", "data", "medical.json"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--desc-sentences", type=int, default=8, help="desc 字段的句子数（控制单条记录长度）")
+    args = parser.parse_args()
+    generate(args.output, args.records, args.seed, args.desc_sentences)
+    print(f"已生成 {args.records} 条记录: {args.output}")
@@ -0,0 +1,370 @@
+"""
+离线 RAG 基准测试：在临时目录中用合成知识库与本地 Ollama 替身服务运行各场景，结果写入 JSON 文件。
+
+    python -m bench.run --records 5000 --scenarios build retrieval history report
+    python -m bench.compare bench/results/old.json bench/results/new.json
+
+所有数据库、向量库、缓存都放在 --workdir（默认临时目录）中，不会读写项目自身的 vs/、history/ 等目录。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from bench.gen_medical import generate, load_topics
+from bench.stub_ollama import StubOllamaServer
+
+SCENARIOS = ("build", "retrieval", "history", "report")
+
+
+def configure(workdir, ollama_url):
+    """把所有存储路径指向 workdir。必须在导入项目其他模块之前调用（它们在导入时读取配置）"""
+    os.environ["OLLAMA_HOST"] = ollama_url
+    import config.settings as settings
+
+    history_dir = os.path.join(workdir, "history")
+    generated_dir = os.path.join(workdir, "generated_cases")
+    settings.ROOT_DIR = workdir
+    settings.VS_PATH = os.path.join(workdir, "vs")
+    settings.DOCSTORE_PATH = os.path.join(workdir, "docstore")
+    settings.MEDICAL_JSON_PATH = os.path.join(workdir, "medical.json")
+    settings.HISTORY_DIR = history_dir
+    settings.SESSION_DB_PATH = os.path.join(history_dir, "session.db")
+    settings.CASE_DB_PATH = os.path.join(history_dir, "case.db")
+    settings.HISTORY_INDEX_PATH = os.path.join(history_dir, "history_index.db")
+    settings.EMBED_CACHE_PATH = os.path.join(history_dir, "embedding_cache.db")
+    settings.ANSWER_CACHE_PATH = os.path.join(history_dir, "answer_cache.db")
+    settings.TRACE_PATH = os.path.join(history_dir, "traces.jsonl")
+    settings.SCHEDULER_DB_PATH = os.path.join(history_dir, "scheduler.db")
+    settings.REPORT_JOBS_DB_PATH = os.path.join(history_dir, "report_jobs.db")
+    settings.GENERATED_CASES_DIR = generated_dir
+    settings.REPORT_CACHE_DIR = os.path.join(generated_dir, "cache")
+    os.makedirs(history_dir, exist_ok=True)
+    return settings
+
+
+def latency_stats(latencies):
+    from utils.tracing import summarize
+    return summarize(np.asarray(latencies, dtype=np.float64))
+
+
+def run_calls(fn, inputs, concurrency):
+    """并发执行 fn(x)，返回 (每次调用耗时列表, 总耗时)"""
+    def timed(x):
+        start = time.perf_counter()
+        fn(x)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency <= 1:
+        latencies = [timed(x) for x in inputs]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, inputs))
+    return latencies, time.perf_counter() - start
+
+
+def throughput(latencies, wall):
+    return {
+        "requests": len(latencies),
+        "wall_s": round(wall, 3),
+        "qps": round(len(latencies) / wall, 2) if wall else None,
+        "latency": latency_stats(latencies),
+    }
+
+
+def make_queries(topics, count, rng):
+    """由合成条目的名称与症状组成查询"""
+    queries = []
+    for _ in range(count):
+        name, symptoms = rng.choice(topics)
+        queries.append(rng.choice([
+            f"{name}有哪些症状？",
+            f"{name}应该怎么治疗？",
+            f"最近{'、'.join(symptoms[:2])}，可能是什么病？",
+        ]))
+    return queries
+
+
+# ---- 场景 ----
+def scenario_build(ctx, args):
+    import faiss
+    from build_index import build
+
+    settings = ctx["settings"]
+    start = time.perf_counter()
+    build(
+        input_path=settings.MEDICAL_JSON_PATH,
+        vs_path=settings.VS_PATH,
+        docs_path=settings.DOCSTORE_PATH,
+        batch_size=args.batch_size,
+        embed_concurrency=args.embed_concurrency,
+        split_workers=args.split_workers,
+        restart=True,
+        index_type=args.index_type,
+    )
+    wall = time.perf_counter() - start
+    index = faiss.read_index(os.path.join(settings.VS_PATH, "index.faiss"))
+    return {
+        "records": args.records,
+        "chunks": index.ntotal,
+        "index_type": args.index_type,
+        "wall_s": round(wall, 3),
+        "records_per_s": round(args.records / wall, 2),
+        "chunks_per_s": round(index.ntotal / wall, 2),
+        "index_bytes": os.path.getsize(os.path.join(settings.VS_PATH, "index.faiss")),
+        "docstore_bytes": sum(
+            os.path.getsize(os.path.join(settings.DOCSTORE_PATH, f)) for f in os.listdir(settings.DOCSTORE_PATH)
+        ),
+    }
+
+
+def scenario_retrieval(ctx, args):
+    from models import agent
+    from utils.tracing import tracer
+
+    rng = random.Random(args.seed)
+    queries = make_queries(ctx["topics"], args.queries, rng)
+    # 计时前先等待检索用到的资源加载完成，并记录加载耗时
+    start = time.perf_counter()
+    agent.start_background_loading()
+    for name in ("embedding_model", "vectorstore", "docstore", "sparse_index"):
+        if name in agent.resources:
+            agent.resources.get(name)
+    result = {"load_s": round(time.perf_counter() - start, 3), "resources": agent.resources.status()}
+
+    tracer.reset()
+    latencies, wall = run_calls(agent.retrieve_medical, queries, 1)
+    result["cold_sequential"] = throughput(latencies, wall)
+    result["cold_stages"] = tracer.summary()
+
+    # 相同查询再跑一遍：查询向量命中缓存
+    tracer.reset()
+    latencies, wall = run_calls(agent.retrieve_medical, queries, 1)
+    result["warm_sequential"] = throughput(latencies, wall)
+    result["warm_stages"] = tracer.summary()
+
+    tracer.reset()
+    concurrent_queries = [f"{q}（{i}）" for i, q in enumerate(make_queries(ctx["topics"], args.queries, rng))]
+    latencies, wall = run_calls(agent.retrieve_medical, concurrent_queries, args.concurrency)
+    result["cold_concurrent"] = {"concurrency": args.concurrency, **throughput(latencies, wall)}
+
+    # 问题恰为疾病名：走名称精确查找，不调用向量化
+    tracer.reset()
+    latencies, wall = run_calls(agent.retrieve_medical, [rng.choice(ctx["topics"])[0] for _ in queries], 1)
+    result["name_lookup"] = throughput(latencies, wall)
+    result["name_lookup_stages"] = tracer.summary()
+
+    # 每组 4 个未缓存的查询：逐个调用 retrieve_medical 与一次 retrieve_medical_batch 对比
+    groups = [make_queries(ctx["topics"], 4, rng) for _ in range(max(1, args.queries // 4))]
+    tracer.reset()
+    latencies, wall = run_calls(
+        lambda group: [agent.retrieve_medical(f"{q}（逐个{i}）") for i, q in enumerate(group)], groups, 1
+    )
+    result["group_individual"] = throughput(latencies, wall)
+    tracer.reset()
+    latencies, wall = run_calls(
+        lambda group: agent.retrieve_medical_batch([f"{q}（批量{i}）" for i, q in enumerate(group)]), groups, 1
+    )
+    result["group_batch"] = throughput(latencies, wall)
+    result["group_batch_stages"] = tracer.summary()
+    return result
+
+
+def scenario_history(ctx, args):
+    from langchain_ollama import OllamaEmbeddings
+    from utils.embedding_cache import CachedEmbeddings
+    from utils.history_index import HistoryIndex
+    from utils.qa_history import QAHistoryStore
+
+    settings = ctx["settings"]
+    rng = random.Random(args.seed)
+    embedding_model = CachedEmbeddings(OllamaEmbeddings(model=settings.EMBEDDING_MODEL), settings.EMBEDDING_MODEL)
+    qa_history = QAHistoryStore(os.path.join(settings.HISTORY_DIR, "bench_session.db"))
+    history_index = HistoryIndex(os.path.join(settings.HISTORY_DIR, "bench_history_index.db"), embedding_model)
+    users = [f"bench_user_{u:03d}" for u in range(args.history_users)]
+
+    # 写入：每轮问答写入问答表 + 向量索引
+    turns = [
+        (user, q, f"关于“{q}”的回答：建议及时就医，注意休息。")
+        for user in users
+        for q in make_queries(ctx["topics"], args.history_turns, rng)
+    ]
+
+    def write(turn):
+        user, query, response = turn
+        qa_history.add(user, "bench_session", query, response)
+        history_index.add(user, query, response)
+
+    latencies, wall = run_calls(write, turns, 1)
+    result = {"users": len(users), "turns_per_user": args.history_turns, "write": throughput(latencies, wall)}
+
+    search_queries = make_queries(ctx["topics"], args.queries, rng)
+    # 每个用户首次检索需要把向量矩阵载入内存
+    history_index._cache.clear()
+    latencies, wall = run_calls(lambda user: history_index.search(user, search_queries[0], top_n=2), users, 1)
+    result["search_first_load"] = throughput(latencies, wall)
+    calls = [(rng.choice(users), q) for q in search_queries]
+    latencies, wall = run_calls(lambda c: history_index.search(c[0], c[1], top_n=2, exclude_recent=2), calls, 1)
+    result["search"] = throughput(latencies, wall)
+    latencies, wall = run_calls(lambda c: qa_history.recent(c[0], settings.HISTORY_WINDOW), calls, 1)
+    result["qa_recent_window"] = throughput(latencies, wall)
+    return result
+
+
+def scenario_report(ctx, args):
+    from utils.case_db import CaseStorage
+
+    rng = random.Random(args.seed)
+    case_db = CaseStorage()
+    sessions = []
+    for i in range(args.reports):
+        user_id, session_id = f"bench_user_{i % 10:03d}", f"bench_report_{i:04d}"
+        messages = []
+        for q in make_queries(ctx["topics"], args.report_turns, rng):
+            messages.append({"role": "user", "content": q})
+            messages.append({"role": "assistant", "content": f"请问{q}的症状持续多久了？是否伴有发热？"})
+        case_db.save_messages(session_id, user_id, messages)
+        sessions.append((user_id, session_id))
+
+    import generate_case
+
+    async def run_all():
+        async def one(session):
+            start = time.perf_counter()
+            await generate_case.generate_markdown(*session)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(one(s) for s in sessions))
+        cold = throughput(latencies, time.perf_counter() - start)
+        # 同样的会话再请求一次：命中报告缓存
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*(one(s) for s in sessions))
+        return cold, throughput(latencies, time.perf_counter() - start)
+
+    cold, cached = asyncio.run(run_all())
+    return {
+        "reports": len(sessions),
+        "turns_per_session": args.report_turns,
+        "llm_concurrency": ctx["settings"].REPORT_LLM_CONCURRENCY,
+        "markdown_cold": cold,
+        "markdown_cached": cached,
+    }
+
+
+SCENARIO_FUNCS = {
+    "build": scenario_build,
+    "retrieval": scenario_retrieval,
+    "history": scenario_history,
+    "report": scenario_report,
+}
+
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True).strip())
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线 RAG 基准测试")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--records", type=int, default=2000, help="合成知识库条目数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="工作目录（默认新建临时目录）")
+    parser.add_argument("--output", help="结果 JSON 路径（默认 bench/results/<时间>_<提交>.json）")
+    # Ollama 替身
+    parser.add_argument("--ollama-url", help="使用已有的 Ollama（或替身）服务，不在进程内启动替身")
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--tokens", type=int, default=200, help="替身每次回答的 token 数")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="替身每个 token 的耗时（秒）")
+    parser.add_argument("--embed-delay", type=float, default=0.0, help="替身每次向量化请求的耗时（秒）")
+    # 构建
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--embed-concurrency", type=int, default=4)
+    parser.add_argument("--split-workers", type=int, default=4)
+    # 检索 / 历史 / 报告
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--reranker", help="检索场景的重排序类型（默认读取配置；替身环境下可用 lexical / embedding）")
+    parser.add_argument("--history-users", type=int, default=20)
+    parser.add_argument("--history-turns", type=int, default=50)
+    parser.add_argument("--reports", type=int, default=20)
+    parser.add_argument("--report-turns", type=int, default=10)
+    args = parser.parse_args()
+
+    if "build" not in args.scenarios and not args.workdir:
+        parser.error("不运行 build 场景时需要通过 --workdir 指定已构建好的工作目录")
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="medical_bench_"))
+    server = None
+    ollama_url = args.ollama_url
+    if not ollama_url:
+        server = StubOllamaServer(port=0, dim=args.dim, tokens=args.tokens,
+                                  token_delay=args.token_delay, embed_delay=args.embed_delay).start_background()
+        ollama_url = server.url
+
+    settings = configure(workdir, ollama_url)
+    if args.reranker:
+        settings.RERANKER = args.reranker
+    ctx = {"settings": settings}
+    # 合成语料只写入工作目录（configure 已把 MEDICAL_JSON_PATH 指向 workdir）；
+    # 不运行 build 而复用已构建的工作目录时沿用其中的语料，不覆盖索引对应的数据
+    corpus = settings.MEDICAL_JSON_PATH
+    if os.path.dirname(os.path.abspath(corpus)) != workdir:
+        raise RuntimeError(f"合成语料路径 {corpus} 不在工作目录 {workdir} 中")
+    if "build" in args.scenarios or not os.path.exists(corpus):
+        ctx["topics"] = generate(corpus, args.records, args.seed)
+    else:
+        ctx["topics"] = load_topics(corpus)
+
+    results = {
+        "meta": {
+            "commit": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workdir": workdir,
+            "ollama": "stub" if server else ollama_url,
+            "args": vars(args),
+        },
+        "scenarios": {},
+    }
+    for name in SCENARIOS:
+        if name not in args.scenarios:
+            continue
+        print(f"=== {name} ===")
+        results["scenarios"][name] = SCENARIO_FUNCS[name](ctx, args)
+        print(json.dumps(results["scenarios"][name], ensure_ascii=False, indent=2))
+    if server is not None:
+        with server.stats_lock:
+            results["meta"]["stub_stats"] = dict(server.stats)
+        server.shutdown()
+
+    output = args.output or os.path.join(
+        "bench", "results", f"{datetime.now():%Y%m%d_%H%M%S}_{results['meta']['commit']}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
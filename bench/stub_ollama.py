@@ -0,0 +1,229 @@
+"""
+本地 Ollama 替身服务：返回确定性的向量与回答，用于离线基准测试。
+
+    python -m bench.stub_ollama --port 11435 --dim 1024 --tokens 200 --token-delay 0.01
+    OLLAMA_HOST=http://127.0.0.1:11435 streamlit run app.py
+
+向量由文本的字符二元组哈希得到（归一化），相同文本总是得到相同向量，且字面相近的文本向量相近，
+检索 / 历史相似度 / 回答缓存的命中行为与真实模型大致一致。
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+DEFAULT_PORT = 11435
+
+# 确定性回答模板：按病例报告结构生成，PDF 渲染等下游流程可正常处理
+ANSWER_TEMPLATE = """## 病例报告
+
+### 【基本信息】
+- 姓名：
+- 性别：
+- 年龄：
+
+### 【主诉】
+{topic}
+
+### 【现病史】
+{filler}
+
+### 【初步诊断】
+{topic}
+
+### 【初步治疗建议】
+{filler}
+"""
+
+
+def stub_embedding(text, dim):
+    """字符二元组哈希向量"""
+    codes = np.frombuffer((text or " ").encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < 2:
+        codes = np.concatenate([codes, codes])
+    buckets = (codes[:-1] * np.uint64(1000003) ^ codes[1:]) % np.uint64(dim)
+    vector = np.bincount(buckets.astype(np.int64), minlength=dim).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def stub_tokens(prompt, count):
+    """由提示词确定性地生成 count 个 token"""
+    topic = (prompt or "").strip().splitlines()[-1][:40] if (prompt or "").strip() else "无"
+    filler_words = ["患者", "自述", "症状", "持续", "建议", "休息", "复查", "观察", "饮食", "清淡"]
+    filler = "".join(filler_words[i % len(filler_words)] for i in range(count))
+    text = ANSWER_TEMPLATE.format(topic=topic, filler=filler)
+    # 每个 token 约 2 个字符
+    tokens = [text[i:i + 2] for i in range(0, len(text), 2)]
+    return tokens[:max(count, 1)]
+
+
+def stub_structured(schema, text):
+    """按 JSON Schema（format 参数）生成确定性的对象，字符串字段填入回答文本"""
+    if schema.get("type") == "object":
+        return {key: stub_structured(sub, text) for key, sub in schema.get("properties", {}).items()}
+    return text
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    server_version = "StubOllama/1.0"
+    protocol_version = "HTTP/1.1"
+    # 响应头与正文分开写出，关闭 Nagle 避免每次请求多出 40ms 的延迟确认等待
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b"{}"
+        return json.loads(body or b"{}")
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _count(self, key, n=1):
+        with self.server.stats_lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + n
+
+    def do_GET(self):
+        if self.path.startswith("/api/tags"):
+            self._send_json({"models": [{"name": m, "model": m} for m in self.server.models]})
+        elif self.path.startswith("/api/version"):
+            self._send_json({"version": "0.0.0-stub"})
+        elif self.path.startswith("/stats"):
+            with self.server.stats_lock:
+                self._send_json(dict(self.server.stats))
+        else:
+            self._send_json({"status": "Ollama is running"})
+
+    def do_POST(self):
+        try:
+            request = self._read_json()
+        except ValueError:
+            self._send_json({"error": "invalid json"}, 400)
+            return
+        if self.path.startswith("/api/embed"):
+            self._embed(request)
+        elif self.path.startswith("/api/chat"):
+            messages = request.get("messages") or []
+            prompt = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+            self._generate(request, prompt, chat=True)
+        elif self.path.startswith("/api/generate"):
+            self._generate(request, request.get("prompt", ""), chat=False)
+        elif self.path.startswith("/api/show"):
+            self._send_json({"modelfile": "", "parameters": "", "template": "", "details": {}, "model_info": {}})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _embed(self, request):
+        # /api/embed 使用 input（字符串或列表），旧版 /api/embeddings 使用 prompt
+        texts = request.get("input", request.get("prompt", ""))
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if self.server.embed_delay:
+            time.sleep(self.server.embed_delay)
+        vectors = [stub_embedding(t, self.server.dim) for t in texts]
+        self._count("embed_requests")
+        self._count("embed_texts", len(texts))
+        if self.path.startswith("/api/embeddings"):
+            self._send_json({"embedding": vectors[0]})
+        else:
+            self._send_json({"model": request.get("model"), "embeddings": vectors})
+
+    def _generate(self, request, prompt, chat):
+        model = request.get("model")
+        tokens = stub_tokens(prompt, self.server.tokens)
+        if isinstance(request.get("format"), dict):
+            # 约束输出：返回符合 Schema 的 JSON，长度与普通回答相当
+            text = json.dumps(stub_structured(request["format"], "".join(tokens)[-40:].strip()), ensure_ascii=False)
+            tokens = [text[i:i + 2] for i in range(0, len(text), 2)]
+        prompt_tokens = len(prompt or "") // 2
+        self._count("chat_requests" if chat else "generate_requests")
+        self._count("output_tokens", len(tokens))
+
+        def chunk(content, done):
+            item = {"model": model, "created_at": datetime.now(timezone.utc).isoformat(), "done": done}
+            if chat:
+                item["message"] = {"role": "assistant", "content": content}
+            else:
+                item["response"] = content
+            if done:
+                item.update(
+                    done_reason="stop",
+                    total_duration=int(self.server.token_delay * len(tokens) * 1e9),
+                    prompt_eval_count=prompt_tokens,
+                    eval_count=len(tokens),
+                    eval_duration=int(self.server.token_delay * len(tokens) * 1e9),
+                )
+            return item
+
+        if not request.get("stream", True):
+            time.sleep(self.server.token_delay * len(tokens))
+            self._send_json(chunk("".join(tokens), True))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        items = [chunk(t, False) for t in tokens] + [chunk("", True)]
+        for item in items:
+            if self.server.token_delay:
+                time.sleep(self.server.token_delay)
+            data = (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class StubOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, dim=1024, tokens=200,
+                 token_delay=0.0, embed_delay=0.0, models=("bge-m3", "qwen2.5:14b-instruct-fp16")):
+        super().__init__((host, port), StubOllamaHandler)
+        self.dim = dim
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.embed_delay = embed_delay
+        self.models = list(models)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start_background(self):
+        thread = threading.Thread(target=self.serve_forever, name="stub-ollama", daemon=True)
+        thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地 Ollama 替身服务（确定性向量与回答）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--dim", type=int, default=1024, help="向量维度（bge-m3 为 1024）")
+    parser.add_argument("--tokens", type=int, default=200, help="每次回答的 token 数")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="每个 token 的生成耗时（秒）")
+    parser.add_argument("--embed-delay", type=float, default=0.0, help="每次向量化请求的耗时（秒）")
+    args = parser.parse_args()
+
+    server = StubOllamaServer(args.host, args.port, args.dim, args.tokens, args.token_delay, args.embed_delay)
+    print(f"Stub Ollama 已启动: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
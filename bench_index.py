@@ -0,0 +1,112 @@
+"""
+离线评测不同 FAISS 索引类型的召回率与延迟（纯 CPU）。
+
+以当前 vs/ 中的精确 Flat 索引为基准：从已有向量中随机留出一部分作为查询集，
+其余向量作为底库，分别构建 flat / ivf_flat / ivf_pq / hnsw 索引，
+对比 recall@k、单条查询延迟、构建耗时与索引大小。
+
+    python bench_index.py --k 10 --num-queries 200 --nprobe 8 16 32 --ef-search 32 64 128
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from config.settings import VS_PATH, INDEX_TRAIN_SAMPLE
+from utils.faiss_index import INDEX_TYPES, create_index, train_index, apply_search_params
+
+
+def load_vectors(vs_path):
+    """从已构建的精确索引中取出全部向量"""
+    index = faiss.read_index(f"{vs_path}/index.faiss")
+    if not isinstance(index, faiss.IndexFlat):
+        raise ValueError("基准评测需要精确的 Flat 索引，请先以 INDEX_TYPE='flat' 构建 vs/")
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def recall_at_k(approx_ids, exact_ids, k):
+    hits = sum(len(set(a[:k]) & set(e[:k])) for a, e in zip(approx_ids, exact_ids))
+    return hits / (len(exact_ids) * k)
+
+
+def measure(index, queries, k):
+    """逐条查询，统计延迟分位数（毫秒）"""
+    latencies, results = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        _, ids = index.search(q.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        results.append(ids[0])
+    latencies = np.array(latencies)
+    return np.array(results), {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "qps": float(len(queries) / (latencies.sum() / 1000)),
+    }
+
+
+def run(vectors, index_types, k, num_queries, nprobes, ef_searches, seed=0):
+    rng = np.random.default_rng(seed)
+    perm = rng.permutation(len(vectors))
+    num_queries = min(num_queries, len(vectors) // 10 or 1)
+    queries = vectors[perm[:num_queries]]
+    base = vectors[perm[num_queries:]]
+    dim = base.shape[1]
+
+    # 精确检索结果作为真值
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(base)
+    _, exact_ids = exact.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        t0 = time.perf_counter()
+        index = create_index(dim, index_type, num_vectors=min(len(base), INDEX_TRAIN_SAMPLE))
+        train_index(index, base, seed=seed)
+        index.add(base)
+        build_s = time.perf_counter() - t0
+        size_mb = len(faiss.serialize_index(index)) / 1024 / 1024
+
+        if index_type in ("ivf_flat", "ivf_pq"):
+            settings = [{"nprobe": n} for n in nprobes]
+        elif index_type == "hnsw":
+            settings = [{"ef_search": e} for e in ef_searches]
+        else:
+            settings = [{}]
+        for params in settings:
+            apply_search_params(index, **params)
+            approx_ids, latency = measure(index, queries, k)
+            row = {
+                "index_type": index_type,
+                **params,
+                f"recall@{k}": recall_at_k(approx_ids, exact_ids, k),
+                **latency,
+                "build_s": build_s,
+                "size_mb": size_mb,
+            }
+            rows.append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FAISS 索引召回率 / 延迟评测")
+    parser.add_argument("--vs-path", default=VS_PATH)
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-queries", type=int, default=200, help="留出的查询向量数")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.vs_path)
+    print(f"📦 基准向量数: {len(vectors)}，维度: {vectors.shape[1]}")
+    rows = run(vectors, args.types, args.k, args.num_queries, args.nprobe, args.ef_search, args.seed)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
@@ -1,65 +1,406 @@
+import argparse
+import hashlib
 import json
-from pathlib import Path
-from langchain_core.documents import Document
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 from langchain_text_splitters import RecursiveJsonSplitter
-from langchain_ollama import OllamaEmbeddings
-from langchain.storage import LocalFileStore
-from langchain_community.docstore.in_memory import InMemoryDocstore
-from langchain_community.vectorstores import FAISS
-from langchain.retrievers.multi_vector import MultiVectorRetriever
-import uuid
-import faiss
-from tqdm import tqdm
+from utils.docstore import PackedDocStore, encode_doc
+from utils.sparse_index import SparseIndex, SPARSE_DIR
+from utils.category_index import CategoryIndex, CATEGORY_DIR
+from utils.answer_cache import SemanticAnswerCache
+from config.settings import (
+    EMBEDDING_MODEL, VS_PATH, DOCSTORE_PATH, MEDICAL_JSON_PATH, ANSWER_CACHE_PATH,
+    BUILD_SPLIT_WORKERS, BUILD_BATCH_SIZE, BUILD_EMBED_CONCURRENCY, BUILD_CHECKPOINT_EVERY, BUILD_CHECKPOINT_INTERVAL,
+    INDEX_TYPE, INDEX_TRAIN_SAMPLE,
+)
 
+id_key = "doc_id"
+CHECKPOINT_FILE = "build_checkpoint.json"
+# 记录每条知识的内容哈希及其分块 ID，用于增量更新
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
 
+# 分块在子进程中执行，splitter 在每个进程内各自创建一次
 splitter = RecursiveJsonSplitter(max_chunk_size=2000)
-embedding_model = OllamaEmbeddings(model="bge-m3")
-vs_docs_path = Path.cwd() / "docs"
-vs_path = Path.cwd() / "vs"
-docs_store = LocalFileStore(vs_docs_path)
-
-# 确定距离向量索引
-index = faiss.IndexFlatL2(len(embedding_model.embed_query("test")))
-vectorstore = FAISS(
-    embedding_function=embedding_model,
-    index=index,
-    docstore=InMemoryDocstore(),
-    index_to_docstore_id={}
-)
 
-id_key = "doc_id"
-retriever = MultiVectorRetriever(
-    vectorstore=vectorstore,
-    docstore=docs_store,
-    id_key=id_key,
-)
 
+def _sha1(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def make_doc_id(entry):
+    """由条目的稳定标识（_id 或 name）生成 doc_id，内容修改后 doc_id 不变"""
+    key = entry.get("_id")
+    if isinstance(key, dict):
+        key = key.get("$oid")
+    if not key:
+        key = entry.get("name", "")
+    return _sha1(f"entry:{key}")
+
+
+def entry_hash(entry):
+    """条目内容哈希，键排序后计算，与 JSON 书写格式无关"""
+    return _sha1(json.dumps(entry, ensure_ascii=False, sort_keys=True))
+
+
+def split_line(line):
+    """解析一行 JSONL 并分块，返回 (doc_id, 内容哈希, 父文档, [(分块ID, 分块文本, 元数据)])"""
+    entry = json.loads(line)
+    # 提取元数据
+    doc_id = make_doc_id(entry)
+    metadata = {
+        id_key: doc_id,
+        "name": entry.get("name", ""),
+        "category": ",".join(entry.get("category", [])),
+    }
+    sub_docs = splitter.create_documents(
+        texts=[entry],
+        convert_lists=True,  # 推荐设为 True：能将 list 转换为 dict，便于嵌套处理
+        ensure_ascii=False,
+        metadatas=[metadata],
+    )
+    chunks = {}
+    for d in sub_docs:
+        # 分块 ID 由所属条目、分块内容及元数据决定，内容不变则 ID 不变
+        chunk_id = _sha1(json.dumps([doc_id, d.page_content, d.metadata], ensure_ascii=False, sort_keys=True))
+        chunks.setdefault(chunk_id, (chunk_id, d.page_content, d.metadata))
+    return doc_id, entry_hash(entry), entry, list(chunks.values())
+
+
+def load_manifest(vs_path):
+    path = os.path.join(vs_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(vs_path, manifest):
+    path = os.path.join(vs_path, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(vs_path):
+    path = os.path.join(vs_path, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(vs_path, checkpoint):
+    # 先写临时文件再原子替换，避免中途崩溃留下损坏的检查点
+    path = os.path.join(vs_path, CHECKPOINT_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def embed_chunks(embedding_model, texts, batch_size, executor):
+    """按 batch_size 切分后并发调用 embed_documents，结果保持原顺序"""
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    vectors = []
+    for batch_vectors in executor.map(embedding_model.embed_documents, batches):
+        vectors.extend(batch_vectors)
+    return vectors
+
+
+def build_sparse(vectorstore, vs_path=VS_PATH):
+    """
+    由向量库中的全部分块重建检索进程使用的只读文件：按行号保存的分块 chunks.pack、
+    BM25 稀疏索引与类别索引（只读元数据、分词，不调用向量化）。需在 save_local 之后调用
+    """
+    from utils.faiss_index import save_chunk_pack
+
+    start = time.perf_counter()
+    save_chunk_pack(vectorstore, vs_path)
+    sparse_index = SparseIndex.from_vectorstore(vectorstore)
+    sparse_index.save(os.path.join(vs_path, SPARSE_DIR))
+    category_index = CategoryIndex.from_vectorstore(vectorstore)
+    category_index.save(os.path.join(vs_path, CATEGORY_DIR))
+    print(f"🔤 稀疏索引: {len(sparse_index)} 个分块，{len(sparse_index.vocab)} 个词，"
+          f"{len(sparse_index.names)} 个疾病名，{len(category_index.labels)} 个类别，用时 {time.perf_counter() - start:.1f}s")
+    return sparse_index
+
+
+def purge_answer_cache(vs_path=VS_PATH, db_path=ANSWER_CACHE_PATH):
+    """知识库重建 / 更新后清理旧版本知识库的回答缓存（旧缓存不会再命中）"""
+    from utils.faiss_index import kb_version
+
+    if os.path.exists(db_path):
+        SemanticAnswerCache(db_path, None).invalidate(kb_version(vs_path))
 
-with open("./doc/medical.json", "r", encoding="utf-8") as f:
-    total_lines = sum(1 for _ in f)
-
-with open("./doc/medical.json", "r", encoding="utf-8") as f:
-    for line in tqdm(f, total=total_lines, desc="Building FAISS index"):
-        entry = json.loads(line)
-        # 提取元数据
-        doc_id = str(uuid.uuid4())
-        metadata = {
-            id_key: doc_id,
-            "name": entry.get("name", ""),
-            "category": ",".join(entry.get("category", [])),
-        }
-
-        sub_docs = splitter.create_documents(
-            texts=[entry],
-            convert_lists=True,  # 推荐设为 True：能将 list 转换为 dict，便于嵌套处理
-            ensure_ascii=False,
-            metadatas=[metadata],
-        )
-        retriever.vectorstore.add_documents(sub_docs)
-        retriever.docstore.mset([(doc_id, str(entry).encode())])
 
-        vectorstore.save_local(vs_path)
+def build(
+    input_path=MEDICAL_JSON_PATH,
+    vs_path=VS_PATH,
+    docs_path=DOCSTORE_PATH,
+    batch_size=BUILD_BATCH_SIZE,
+    embed_concurrency=BUILD_EMBED_CONCURRENCY,
+    split_workers=BUILD_SPLIT_WORKERS,
+    checkpoint_every=BUILD_CHECKPOINT_EVERY,
+    checkpoint_interval=BUILD_CHECKPOINT_INTERVAL,
+    restart=False,
+    index_type=INDEX_TYPE,
+):
+    from langchain_ollama import OllamaEmbeddings
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    from tqdm import tqdm
+    from utils.faiss_index import create_index, train_index, requires_training, remove_vectors
 
-# ✅ 输出统计信息
-print(f"\n📦 当前向量分块数量: {vectorstore.index.ntotal}")
-print(f"🔗 索引到文档ID映射数: {len(vectorstore.index_to_docstore_id)}")
+    embedding_model = OllamaEmbeddings(model=EMBEDDING_MODEL)
+    docs_store = PackedDocStore(docs_path)
+    os.makedirs(vs_path, exist_ok=True)
+
+    checkpoint = None if restart else load_checkpoint(vs_path)
+    if checkpoint:
+        # 从上次提交的位置继续构建
+        vectorstore = FAISS.load_local(vs_path, embedding_model, allow_dangerous_deserialization=True)
+        # 向量库已保存但检查点未推进时，回滚检查点之后写入的分块，避免重复
+        extra_ids = [
+            vectorstore.index_to_docstore_id[i]
+            for i in range(checkpoint["chunks"], vectorstore.index.ntotal)
+        ]
+        remove_vectors(vectorstore, extra_ids)
+        print(f"♻️ 从检查点恢复：已处理 {checkpoint['offset']} 条记录，{vectorstore.index.ntotal} 个分块")
+        manifest = load_manifest(vs_path) or {"version": MANIFEST_VERSION, "entries": {}}
+    else:
+        # 索引在第一次提交时创建：IVF 类索引需要先积累足够的训练样本
+        vectorstore = None
+        docs_store.clear()
+        checkpoint = {"offset": 0}
+        manifest = {"version": MANIFEST_VERSION, "entries": {}}
+
+    with open(input_path, "r", encoding="utf-8") as f:
+        total_lines = sum(1 for _ in f)
+
+    offset = checkpoint["offset"]
+    embedded = 0
+    pending = {"ids": [], "texts": [], "vectors": [], "metadatas": [], "parents": [], "lines": 0}
+
+    last_save = time.perf_counter()
+
+    def commit(force=False):
+        nonlocal vectorstore, offset, last_save
+        if vectorstore is None:
+            vectors = pending["vectors"] or [embedding_model.embed_query("test")]
+            # 确定距离向量索引
+            index = create_index(len(vectors[0]), index_type, num_vectors=len(vectors))
+            train_index(index, vectors)
+            vectorstore = FAISS(
+                embedding_function=embedding_model,
+                index=index,
+                docstore=InMemoryDocstore(),
+                index_to_docstore_id={}
+            )
+        if pending["texts"]:
+            vectorstore.add_embeddings(
+                list(zip(pending["texts"], pending["vectors"])),
+                metadatas=pending["metadatas"],
+                ids=pending["ids"],
+            )
+        # 父文档只追加到打包文件与索引日志，开销与已有文档数无关
+        docs_store.mset(pending["parents"])
+        offset += pending["lines"]
+        for value in pending.values():
+            if isinstance(value, list):
+                value.clear()
+        pending["lines"] = 0
+
+        # 保存：向量库与 manifest 每次整体重写，耗时随规模增长，按时间间隔保存而不是每段都保存；
+        # 先写向量库，再推进 manifest 与检查点。中断时最多重做 checkpoint_interval 秒内处理的记录
+        if force or time.perf_counter() - last_save >= checkpoint_interval:
+            vectorstore.save_local(vs_path)
+            save_manifest(vs_path, manifest)
+            save_checkpoint(vs_path, {"offset": offset, "chunks": vectorstore.index.ntotal})
+            last_save = time.perf_counter()
+
+    start = time.perf_counter()
+    with open(input_path, "r", encoding="utf-8") as f, \
+            ProcessPoolExecutor(max_workers=split_workers) as split_pool, \
+            ThreadPoolExecutor(max_workers=embed_concurrency) as embed_pool, \
+            tqdm(total=total_lines, initial=offset, desc="Building FAISS index") as pbar:
+        lines = islice(f, offset, None)
+        while True:
+            # 每段处理 checkpoint_every 条记录，段末统一提交
+            raw_lines = list(islice(lines, checkpoint_every))
+            if not raw_lines:
+                break
+            segment = [line for line in raw_lines if line.strip()]
+            texts = []
+            for doc_id, content_hash, entry, chunks in split_pool.map(split_line, segment, chunksize=16):
+                if doc_id in manifest["entries"]:
+                    print(f"⚠️ 跳过重复条目: {entry.get('name', '')}")
+                    continue
+                manifest["entries"][doc_id] = {"hash": content_hash, "chunks": [c[0] for c in chunks]}
+                pending["parents"].append((doc_id, encode_doc(entry)))
+                for chunk_id, text, metadata in chunks:
+                    pending["ids"].append(chunk_id)
+                    pending["metadatas"].append(metadata)
+                    texts.append(text)
+
+            pending["vectors"].extend(embed_chunks(embedding_model, texts, batch_size, embed_pool))
+            pending["texts"].extend(texts)
+            pending["lines"] += len(raw_lines)
+
+            # 需要训练的索引在样本足够之前不提交
+            if (
+                vectorstore is not None
+                or not requires_training(index_type)
+                or len(pending["vectors"]) >= INDEX_TRAIN_SAMPLE
+            ):
+                commit()
+
+            embedded += len(texts)
+            elapsed = time.perf_counter() - start
+            pbar.update(len(raw_lines))
+            pbar.set_postfix(chunks_per_s=f"{embedded / elapsed:.1f}")
+
+    commit(force=True)
+    docs_store.snapshot()
+    build_sparse(vectorstore, vs_path)
+    purge_answer_cache(vs_path)
+
+    # 构建完成后删除检查点，下次运行将重新构建
+    checkpoint_path = os.path.join(vs_path, CHECKPOINT_FILE)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    elapsed = time.perf_counter() - start
+    # ✅ 输出统计信息
+    print(f"\n📦 当前向量分块数量: {vectorstore.index.ntotal}（索引类型: {index_type}）")
+    print(f"🔗 索引到文档ID映射数: {len(vectorstore.index_to_docstore_id)}")
+    print(f"⏱️ 本次向量化 {embedded} 个分块，用时 {elapsed:.1f}s，吞吐 {embedded / max(elapsed, 1e-9):.1f} chunks/s")
+    return vectorstore
+
+
+def update(
+    input_path=MEDICAL_JSON_PATH,
+    vs_path=VS_PATH,
+    docs_path=DOCSTORE_PATH,
+    batch_size=BUILD_BATCH_SIZE,
+    embed_concurrency=BUILD_EMBED_CONCURRENCY,
+    split_workers=BUILD_SPLIT_WORKERS,
+):
+    """
+    增量更新：按内容哈希对比 manifest，只向量化新增或修改的分块，
+    并删除已移除条目及过期分块对应的向量
+    """
+    manifest = load_manifest(vs_path)
+    if manifest is None or load_checkpoint(vs_path) is not None:
+        print("未找到完整的 manifest（或上次构建未完成），执行全量构建")
+        return build(input_path, vs_path, docs_path, batch_size, embed_concurrency, split_workers)
+
+    from langchain_ollama import OllamaEmbeddings
+    from langchain_community.vectorstores import FAISS
+    from utils.faiss_index import remove_vectors
+
+    embedding_model = OllamaEmbeddings(model=EMBEDDING_MODEL)
+    docs_store = PackedDocStore(docs_path)
+    vectorstore = FAISS.load_local(vs_path, embedding_model, allow_dangerous_deserialization=True)
+    entries = manifest["entries"]
+    start = time.perf_counter()
+
+    # 1. 找出新增/修改的条目，只有这些条目需要重新分块
+    seen, changed_lines = set(), []
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            doc_id = make_doc_id(entry)
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            if entries.get(doc_id, {}).get("hash") != entry_hash(entry):
+                changed_lines.append(line)
+    removed = [doc_id for doc_id in entries if doc_id not in seen]
+
+    # 2. 对比分块 ID：未变化的分块保留原向量，新分块向量化，过期分块删除
+    ids, texts, metadatas, parents, stale_ids = [], [], [], [], []
+    with ProcessPoolExecutor(max_workers=split_workers) as split_pool:
+        for doc_id, content_hash, entry, chunks in split_pool.map(split_line, changed_lines, chunksize=16):
+            old_chunks = set(entries.get(doc_id, {}).get("chunks", []))
+            new_chunk_ids = [c[0] for c in chunks]
+            for chunk_id, text, metadata in chunks:
+                if chunk_id not in old_chunks:
+                    ids.append(chunk_id)
+                    texts.append(text)
+                    metadatas.append(metadata)
+            stale_ids.extend(old_chunks - set(new_chunk_ids))
+            parents.append((doc_id, encode_doc(entry)))
+            entries[doc_id] = {"hash": content_hash, "chunks": new_chunk_ids}
+    for doc_id in removed:
+        stale_ids.extend(entries.pop(doc_id)["chunks"])
+
+    existing_ids = set(vectorstore.index_to_docstore_id.values())
+    stale_ids = [i for i in stale_ids if i in existing_ids]
+    remove_vectors(vectorstore, stale_ids)
+    with ThreadPoolExecutor(max_workers=embed_concurrency) as embed_pool:
+        vectors = embed_chunks(embedding_model, texts, batch_size, embed_pool)
+    if texts:
+        vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+    if parents:
+        docs_store.mset(parents)
+    if removed:
+        docs_store.mdelete(removed)
+    docs_store.snapshot()
+
+    vectorstore.save_local(vs_path)
+    save_manifest(vs_path, manifest)
+    build_sparse(vectorstore, vs_path)
+    purge_answer_cache(vs_path)
+
+    elapsed = time.perf_counter() - start
+    print(f"\n📝 新增/修改条目: {len(changed_lines)}，删除条目: {len(removed)}")
+    print(f"🧩 新向量化分块: {len(texts)}，删除分块: {len(stale_ids)}")
+    print(f"📦 当前向量分块数量: {vectorstore.index.ntotal}，用时 {elapsed:.1f}s")
+    return vectorstore
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="构建医学知识库向量索引")
+    parser.add_argument("--input", default=MEDICAL_JSON_PATH, help="medical.json 路径（JSONL）")
+    parser.add_argument("--batch-size", type=int, default=BUILD_BATCH_SIZE, help="每次 embed_documents 的分块数")
+    parser.add_argument("--concurrency", type=int, default=BUILD_EMBED_CONCURRENCY, help="并发向量化请求数")
+    parser.add_argument("--workers", type=int, default=BUILD_SPLIT_WORKERS, help="分块进程数")
+    parser.add_argument("--checkpoint-every", type=int, default=BUILD_CHECKPOINT_EVERY, help="每段处理的记录数")
+    parser.add_argument("--checkpoint-interval", type=float, default=BUILD_CHECKPOINT_INTERVAL, help="保存向量库与检查点的最短间隔（秒）")
+    parser.add_argument("--restart", action="store_true", help="忽略已有检查点，从头构建")
+    parser.add_argument("--incremental", action="store_true", help="增量更新：只处理新增、修改和删除的条目")
+    parser.add_argument("--index-type", default=INDEX_TYPE, help="全量构建的索引类型：flat / ivf_flat / ivf_pq / hnsw")
+    parser.add_argument("--sparse-only", action="store_true", help="只由已有向量库重建分块文件、BM25 稀疏索引与类别索引")
+    args = parser.parse_args()
+
+    if args.sparse_only:
+        from langchain_ollama import OllamaEmbeddings
+        from langchain_community.vectorstores import FAISS
+        build_sparse(FAISS.load_local(VS_PATH, OllamaEmbeddings(model=EMBEDDING_MODEL), allow_dangerous_deserialization=True))
+    elif args.incremental:
+        update(
+            input_path=args.input,
+            batch_size=args.batch_size,
+            embed_concurrency=args.concurrency,
+            split_workers=args.workers,
+        )
+    else:
+        build(
+            input_path=args.input,
+            batch_size=args.batch_size,
+            embed_concurrency=args.concurrency,
+            split_workers=args.workers,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_interval=args.checkpoint_interval,
+            restart=args.restart,
+            index_type=args.index_type,
+        )
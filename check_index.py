@@ -3,13 +3,16 @@ from pathlib import Path
 from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain.storage import LocalFileStore
+from utils.docstore import PackedDocStore
+from config.settings import DOCSTORE_PATH
+from utils.faiss_index import apply_search_params
+from utils.embedding_cache import CachedEmbeddings
 
 vs_path = Path.cwd() / "vs"
-vs_docs_path = Path.cwd() / "docs"
-embedding_model = OllamaEmbeddings(model="bge-m3")
+embedding_model = CachedEmbeddings(OllamaEmbeddings(model="bge-m3"), "bge-m3")
 vectorstore = FAISS.load_local(vs_path, embedding_model, allow_dangerous_deserialization=True)
-docstore = LocalFileStore(vs_docs_path)
+apply_search_params(vectorstore.index)
+docstore = PackedDocStore(DOCSTORE_PATH)
 retriever = MultiVectorRetriever(
     vectorstore=vectorstore,
     docstore=docstore,
@@ -27,11 +30,13 @@ for i, raw_bytes in enumerate(results):
     decoded = raw_bytes.decode("utf-8")
     # 转换为 JSON 对象（字典）
     try:
-        doc_dict = eval(decoded)
+        doc_dict = json.loads(decoded)
         print(json.dumps(doc_dict, indent=2, ensure_ascii=False))
     except Exception as e:
         print("⚠️ 解码失败:", e)
 
+print(f"\n🗃️ 向量缓存统计: {embedding_model.stats()}")
+
 
 # 遍历 vectorstore 中的所有分块，
 # print(f"📦 当前向量数量: {vectorstore.index.ntotal}")
@@ -8,7 +8,139 @@ EMBEDDING_MODEL = "bge-m3"
 ROOT_DIR = os.path.abspath(os.path.join(BASE_DIR, ".."))  
 
 VS_PATH = os.path.join(ROOT_DIR, "vs")
-VS_DOCS_PATH = os.path.join(ROOT_DIR, "docs")
+VS_DOCS_PATH = os.path.join(ROOT_DIR, "docs")  # 旧版 LocalFileStore 父文档目录，仅用于迁移
+DOCSTORE_PATH = os.path.join(ROOT_DIR, "docstore")  # 打包的父文档存储（docs.pack + docs.idx + docs.idx.log）
 
 TOP_K = 2
 SEARCH_TYPE = "similarity"
+
+# 历史会话存储
+HISTORY_DIR = os.path.join(ROOT_DIR, "history")
+SESSION_DB_PATH = os.path.join(HISTORY_DIR, "session.db")
+CASE_DB_PATH = os.path.join(HISTORY_DIR, "case.db")
+# 历史问答向量索引，与 session.db 放在同一目录，按 user_id 分区
+HISTORY_INDEX_PATH = os.path.join(HISTORY_DIR, "history_index.db")
+HISTORY_TOP_N = 2           # 每次返回的相关历史问答条数
+HISTORY_EXCLUDE_RECENT = 2  # 排除最近的若干条记录（已在当前上下文中）
+HISTORY_WINDOW = 500        # 读取历史问答表时每个用户最多取最近的若干条
+
+# 知识库构建
+MEDICAL_JSON_PATH = os.path.join(ROOT_DIR, "doc", "medical.json")
+BUILD_SPLIT_WORKERS = 4        # 分块进程数
+BUILD_BATCH_SIZE = 64          # 每次 embed_documents 的分块数
+BUILD_EMBED_CONCURRENCY = 4    # 同时进行的向量化请求数
+BUILD_CHECKPOINT_EVERY = 500   # 每段处理的记录数（分块、向量化后加入内存中的索引）
+BUILD_CHECKPOINT_INTERVAL = 300   # 保存向量库与检查点的最短间隔（秒）；整体保存的耗时随索引规模增长，不再每段都保存
+
+# 向量索引类型："flat"（精确检索）| "ivf_flat" | "ivf_pq" | "hnsw"
+INDEX_TYPE = "flat"
+INDEX_TRAIN_SAMPLE = 20000     # IVF 类索引的训练样本数
+IVF_NLIST = 1024               # IVF 聚类中心数（样本不足时自动缩小）
+IVF_NPROBE = 16                # 检索时访问的聚类数
+PQ_M = 16                      # PQ 子向量个数，需整除向量维度
+PQ_NBITS = 8
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# 查询向量缓存：进程内 LRU + 可选的 SQLite 持久层（设为 None 关闭持久层）
+EMBED_CACHE_SIZE = 4096
+EMBED_CACHE_TTL = 7 * 24 * 3600      # 秒，None 表示不过期
+EMBED_CACHE_PATH = os.path.join(HISTORY_DIR, "embedding_cache.db")
+EMBED_CACHE_DISK_MAX = 200000        # 持久层最多保存的条目数
+
+# 语义回答缓存：与已回答问题的向量相似度超过阈值时直接返回缓存回答
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_PATH = os.path.join(HISTORY_DIR, "answer_cache.db")
+ANSWER_CACHE_THRESHOLD = 0.95      # 余弦相似度阈值
+ANSWER_CACHE_MAX_ENTRIES = 2000    # 超出后按最近使用时间淘汰
+
+# 病例报告服务
+GENERATED_CASES_DIR = os.path.join(ROOT_DIR, "generated_cases")
+REPORT_LLM_CONCURRENCY = 2     # 同时进行的报告生成（大模型调用）数
+REPORT_PDF_WORKERS = 2         # PDF 渲染进程数
+REPORT_JOB_TTL = 3600          # 已完成任务保留时间（秒）
+REPORT_JOBS_DB_PATH = os.path.join(HISTORY_DIR, "report_jobs.db")   # 任务状态与报告生成锁，多个 worker 共享
+REPORT_LOCK_LEASE = 1800       # 报告生成锁租期（秒），持有进程卡死时超时后由其他进程接管
+REPORT_CACHE_DIR = os.path.join(GENERATED_CASES_DIR, "cache")
+REPORT_CACHE_MAX_BYTES = 512 * 1024 * 1024   # 报告缓存磁盘配额，超出后按最近使用时间淘汰
+REPORT_STRUCTURED_OUTPUT = True   # 报告按固定 JSON Schema 约束输出后渲染为 Markdown；False 时模型直接输出 Markdown
+REPORT_TEMPERATURE = 0.0          # 报告与病例状态合并的采样温度，同一对话生成稳定的报告
+
+# 病例滚动摘要：未整理的消息超过阈值时，将较早的消息合并进结构化病例状态
+CASE_STATE_MAX_PENDING = 12    # 未整理消息数超过该值时触发合并
+CASE_STATE_KEEP_RECENT = 4     # 合并时保留最近若干条消息原文，供报告生成使用
+
+# SQLite 存储层
+SQLITE_POOL_SIZE = 8             # 每个数据库文件的连接池大小
+SQLITE_BUSY_TIMEOUT_MS = 5000    # 遇到写锁时的等待时间
+SQLITE_WRITE_BATCH = 256         # 后台写线程单个事务最多合并的写入数
+
+# 历史会话目录（侧边栏分页展示）
+SESSION_PAGE_SIZE = 20           # 侧边栏每页显示的会话数
+SESSION_TITLE_LENGTH = 30        # 会话标题取首条用户消息的前若干字
+
+# 延迟追踪：各阶段耗时写入 JSONL，/metrics 输出 Prometheus 文本格式
+TRACING_ENABLED = True
+TRACE_PATH = os.path.join(HISTORY_DIR, "traces.jsonl")
+TRACE_WINDOW = 2048              # 每个阶段保留最近若干次耗时用于计算 p50/p95/p99
+TRACE_MAX_BYTES = 50 * 1024 * 1024   # JSONL 超过该大小时轮转为 traces.jsonl.1
+TRACE_TAIL_BYTES = 4 * 1024 * 1024   # /metrics 首次只读取 JSONL 末尾的字节数，之后增量读取新追加的记录
+
+# 检索服务：设置 RETRIEVAL_SERVICE_URL 后，问答应用与报告服务通过 HTTP 调用 retrieval_service.py，
+# 不再在每个进程中加载索引
+RETRIEVAL_SERVICE_URL = os.environ.get("RETRIEVAL_SERVICE_URL", "")
+RETRIEVAL_TIMEOUT = 10           # 调用检索服务的超时（秒）
+INDEX_MMAP = True                # 以内存映射方式只读加载索引，多个进程共享物理内存（仅 flat / hnsw，IVF 类退回普通加载）
+
+# 混合检索：稠密向量与 BM25 稀疏索引并行检索，按倒数排名融合（RRF）；
+# 问题与疾病名完全一致时直接按名称取文档，不调用向量化
+HYBRID_ENABLED = True
+SPARSE_TOKENIZER = "bigram"      # "bigram"（汉字二元组）| "jieba"（需安装 jieba，未安装时回退为 bigram）
+BM25_K1 = 1.5
+BM25_B = 0.75
+HYBRID_CANDIDATES = 20           # 稠密、稀疏各自取回的候选分块数
+RRF_K = 60                       # RRF 平滑常数：score = Σ 1 / (RRF_K + rank)
+
+# 批量检索工具（retrieve_medical_batch）单次最多处理的查询数，超出部分忽略
+RETRIEVE_BATCH_MAX = 8
+
+# 两阶段检索：先取较大的候选池，由重排序模型打分后只保留前 TOP_K 个，并按 token 预算截断
+# "embedding" 会把未命中向量缓存的候选父文档整篇送去 Ollama 向量化，占用 embeddings 调度名额，增加 Ollama 负载
+RERANKER = "none"                # "none" | "embedding"（父文档向量余弦）| "cross_encoder"（需安装 sentence-transformers）| "lexical"（确定性替身，用于测试）
+RERANK_MODEL = "BAAI/bge-reranker-v2-m3"   # cross_encoder 使用的模型
+RERANK_CANDIDATES = 10           # 候选父文档数
+RERANK_BATCH_SIZE = 16           # 交叉编码器每批推理的 (问题, 文档) 对数
+RERANK_DOC_CHARS = 1024          # 每篇候选文档送入重排序模型的最大字符数
+CONTEXT_TOKEN_BUDGET = 2000      # 重排序后返回给模型的检索结果总 token 数（估算）
+
+# 上下文构建：检索结果只保留命中分块的内容与选定的父文档字段，按字段去重后按 CONTEXT_TOKEN_BUDGET 截断，
+# 不再把整篇父文档 JSON 放进提示词
+CONTEXT_BUILDER_ENABLED = True
+CONTEXT_PARENT_FIELDS = ("name", "desc", "symptom", "cure_department")   # 每篇文档都保留的父文档字段
+CONTEXT_FIELD_MAX_TOKENS = 256   # 单个字段的 token 上限（估算），超出部分截断
+
+# Ollama 连接与 Agent 复用：所有 Agent 共用一个 Ollama 客户端（HTTP 连接池，长连接），
+# 每次请求都带上 keep_alive，模型在空闲 OLLAMA_KEEP_ALIVE 秒内保持加载；-1 表示常驻
+OLLAMA_KEEP_ALIVE = 30 * 60
+OLLAMA_WARMUP = True             # 启动时预热对话模型与向量化模型，首个请求不再等待模型加载
+AGENT_POOL_SIZE = 4              # 问诊 Agent 池保留的空闲实例数，超出时临时创建、用完丢弃
+
+# 后台资源加载：加载失败的资源按次数指数退避后重试，退避期内不重新加载
+RESOURCE_RETRY_BACKOFF = 5       # 首次失败后的重试间隔（秒）
+RESOURCE_RETRY_MAX = 300         # 重试间隔上限（秒）
+
+# Ollama 请求调度：Streamlit、报告服务、检索服务等多个进程通过同一个 SQLite 队列协调对 Ollama 的请求，
+# 按优先级（数字越小越优先）分配并发名额；排队数超过 max_queue 时立即拒绝，排队超过 timeout 秒时放弃
+SCHEDULER_ENABLED = True
+SCHEDULER_DB_PATH = os.path.join(HISTORY_DIR, "scheduler.db")
+SCHEDULER_CLASSES = {
+    # llm: 占用对话模型的名额（与 SCHEDULER_LLM_SLOTS 共同限制）；向量化模型单独计数
+    "interactive": {"priority": 0, "limit": 2, "max_queue": 16, "timeout": 30, "llm": True},
+    "embeddings": {"priority": 1, "limit": 4, "max_queue": 64, "timeout": 10, "llm": False},
+    "reports": {"priority": 2, "limit": 1, "max_queue": 8, "timeout": 300, "llm": True},
+}
+SCHEDULER_LLM_SLOTS = 2          # 对话模型同时处理的请求数，与 Ollama 的 OLLAMA_NUM_PARALLEL 保持一致
+SCHEDULER_POLL_INTERVAL = 0.02   # 排队时检查名额的初始间隔（秒），之后按指数退避
+SCHEDULER_POLL_MAX_INTERVAL = 0.25   # 排队时检查名额的最大间隔（秒）
+SCHEDULER_LEASE = 900            # 名额最长占用时间（秒），超时视为持有进程已失去响应并回收
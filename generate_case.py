@@ -1,96 +1,280 @@
+import asyncio
 import os
-from fastapi import FastAPI, Query
-from fastapi.responses import FileResponse, JSONResponse
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Literal
+from urllib.parse import quote
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from utils.case_db import CaseStorage
-from models.agent import get_agent
-from test_session import is_valid_message
+from utils.report_cache import ReportCache
+from utils.report_jobs import ReportJobStore
+from utils.ollama_scheduler import SchedulerBusy, scheduler
+from utils.tracing import tracer, span_reader, render_prometheus, summarize
+from models.agent import resources, start_background_loading
+from models.report_engine import agenerate_report
+from models.case_summary import case_state_tracker
 from markdown2 import markdown
-from weasyprint import HTML
-from datetime import datetime
+from config.settings import (
+    DEFAULT_MODEL, REPORT_LLM_CONCURRENCY, REPORT_PDF_WORKERS, REPORT_STRUCTURED_OUTPUT,
+)
+
+# 报告提示词模板版本，修改 models/report_engine.py 中的提示词或报告结构后需同步更新，使旧缓存失效
+PROMPT_VERSION = "case-report-v3-json" if REPORT_STRUCTURED_OUTPUT else "case-report-v3"
 
-app = FastAPI()
 case_db = CaseStorage()
+# 限制同时进行的大模型调用数；PDF 渲染放到进程池，不阻塞事件循环
+llm_semaphore = asyncio.Semaphore(REPORT_LLM_CONCURRENCY)
+pdf_pool = None
+# 任务状态保存在 SQLite 中，多个 uvicorn worker 之间共享：任意 worker 都能查询任务与取结果
+jobs = ReportJobStore()
+# 本进程内执行中的任务（保持引用，避免被垃圾回收）
+running_jobs = set()
+# 按对话内容寻址的报告缓存；同一报告的并发请求共用一把锁，只生成一次
+report_cache = ReportCache()
+# (类型, 报告键) -> [锁, 持有与等待的请求数]；只保存进行中的报告，最后一个请求结束时删除
+report_locks = {}
+
+
+@asynccontextmanager
+async def report_lock(kind: str, key: str):
+    entry = report_locks.setdefault((kind, key), [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        # 进程内的请求先在本地锁上排队，只有一个去竞争跨进程锁，其他 worker 中的同一报告等待其完成后读缓存
+        async with entry[0], jobs.lock(f"{kind}:{key}"):
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del report_locks[(kind, key)]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global pdf_pool
+    # 索引、存储等资源在后台并行加载，服务立即开始接收请求
+    start_background_loading()
+    pdf_pool = ProcessPoolExecutor(max_workers=REPORT_PDF_WORKERS)
+    yield
+    pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(SchedulerBusy)
+async def scheduler_busy(request: Request, exc: SchedulerBusy):
+    """报告排队过深或等待超时：快速返回 503，不在 Ollama 前无限堆积"""
+    return JSONResponse(status_code=503, content={"error": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
 
 class GenerateCaseRequest(BaseModel):
     user_id: str
     session_id: str
 
-@app.post("/generate_case_text")
-def generate_case_summary(req: GenerateCaseRequest):
-    print(req.user_id, req.session_id)
-    context = case_db.generate_case(req.user_id, req.session_id)
 
-    if not context:
-        return JSONResponse(status_code=404, content={"error": "No messages found."})
+class CaseJobRequest(GenerateCaseRequest):
+    format: Literal["markdown", "pdf"] = "markdown"
 
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    prompt = f"""你是一名医学助手。以下是患者与AI助手的问诊对话记录。请根据对话内容，尽可能提取出患者的基本信息（如姓名、年龄、性别），如果无法确定，请保留空项；
-    主诉内容请填入患者症状自述，现病史包括当前症状的详细发展过程、有无相关症状、是否接受过治疗、疗效如何等；
-    既往病史包括既往重大疾病（如高血压、糖尿病、心脏病等）、手术史、外伤史、过敏史（药物、食物等）、疫苗接种史（如与发热相关）等；
-    个人史：吸烟、饮酒、职业、生活环境等、家族史：家族中是否有相似病史或遗传疾病。
-    根据现有资料作出的初步判断以及初步治疗建议，包括药物治疗（药名、剂量、途径、频率）、非药物治疗（休息、饮食、心理疏导等）。
-    然后生成完整的病例摘要，格式为markdown，并严格按照如下结构输出：
+class NoMessagesError(Exception):
+    pass
 
-## 病例报告
 
-### 【基本信息】
-- 姓名：<提取的姓名或空>
-- 性别：<提取的性别或空>
-- 年龄：<提取的年龄或空>
+def render_pdf(markdown_text: str, pdf_path: str) -> str:
+    """在进程池中执行：Markdown 转 HTML 后由 WeasyPrint 渲染 PDF"""
+    from weasyprint import HTML
 
-### 【主诉】
-...
+    # ✅ 删除解释性开头，只保留从 "## 病例报告" 开始的内容
+    if "## 病例报告" in markdown_text:
+        markdown_text = markdown_text.split("## 病例报告", 1)[1]
+        markdown_text = "## 病例报告" + markdown_text  # 保留标题
 
-### 【现病史】
-...
+    html_text = markdown(markdown_text)
+    # 先写临时文件再替换，避免缓存中留下未写完的 PDF；临时文件名唯一，多个 worker 同时渲染时互不覆盖
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(pdf_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        HTML(string=html_text).write_pdf(tmp_path)
+        os.replace(tmp_path, pdf_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return pdf_path
 
-### 【既往史】
-...
 
-### 【个人史、家族史】
-...
+def pdf_response(f, filename: str) -> StreamingResponse:
+    """流式返回已打开的 PDF 文件：传输期间文件被缓存淘汰删除也不影响读取，传输结束后关闭"""
+    def chunks():
+        while chunk := f.read(64 * 1024):
+            yield chunk
 
-### 【初步诊断】
-...
+    disposition = (
+        f'attachment; filename="{filename}"' if quote(filename) == filename
+        else f"attachment; filename*=utf-8''{quote(filename)}"
+    )
+    return StreamingResponse(
+        chunks(),
+        media_type="application/pdf",
+        headers={"Content-Disposition": disposition, "Content-Length": str(os.fstat(f.fileno()).st_size)},
+        background=BackgroundTask(f.close),
+    )
 
-### 【初步治疗建议】
-...
 
-生成时间：{current_time}
+async def prepare_case(user_id: str, session_id: str):
+    """读取去重后的对话记录，返回 (对话记录, 缓存键)"""
+    transcript = await case_db.agenerate_case(user_id, session_id)
+    if not transcript:
+        raise NoMessagesError()
+    return transcript, ReportCache.key(transcript, PROMPT_VERSION, DEFAULT_MODEL)
 
-本病例报告由人工智能助手生成，结果仅供参考，不构成医疗建议。
 
-以下是对话内容（供参考）：
-{context}
-"""
+async def generate_markdown(user_id: str, session_id: str, job_id=None, prepared=None) -> str:
+    _, key = prepared or await prepare_case(user_id, session_id)
+    async with report_lock("markdown", key):
+        cached = report_cache.get_markdown(key)
+        if cached is not None:
+            return cached
 
-    agent = get_agent()
-    response = agent.run(prompt)
-    content = response.content if hasattr(response, "content") else str(response)
-    return {"markdown": content}
+        async with llm_semaphore:
+            if job_id is not None:
+                await jobs.aupdate(job_id, status="generating", progress=20)
+            # 提示词只包含滚动病例状态 + 尚未合并的最新对话，长度不随会话增长
+            await asyncio.to_thread(case_state_tracker.update, user_id, session_id)
+            context = await asyncio.to_thread(case_state_tracker.build_context, user_id, session_id)
+            # 不经过问诊 Agent：一次直接的（结构化输出）模型调用，无工具、无会话历史
+            content = await agenerate_report(context, DEFAULT_MODEL)
+        report_cache.put_markdown(key, content)
+        return content
+
+
+async def generate_pdf(user_id: str, session_id: str, job_id=None):
+    """返回已打开的 PDF 文件（调用方负责关闭），避免返回路径后、读取前被缓存淘汰"""
+    prepared = await prepare_case(user_id, session_id)
+    key = prepared[1]
+    async with report_lock("pdf", key):
+        cached = report_cache.open_pdf(key)
+        if cached is not None:
+            return cached
+
+        markdown_text = await generate_markdown(user_id, session_id, job_id, prepared)
+        if job_id is not None:
+            await jobs.aupdate(job_id, status="rendering", progress=70)
 
+        # 直接渲染到缓存目录
+        loop = asyncio.get_running_loop()
+        with tracer.span("report.pdf"):
+            await loop.run_in_executor(pdf_pool, render_pdf, markdown_text, report_cache.pdf_path(key))
+        # 先打开再检查配额，刚渲染的文件即使被淘汰也能完整返回
+        f = report_cache.open_pdf(key)
+        report_cache.evict()
+        if f is None:
+            raise RuntimeError("PDF was evicted right after rendering; check REPORT_CACHE_MAX_BYTES.")
+        return f
 
 
+async def run_job(job_id: str, req: CaseJobRequest):
+    tracer.new_trace(job_id)
+    start = time.perf_counter()
+    try:
+        if req.format == "pdf":
+            # 结果只保存路径，取结果时重新打开
+            with await generate_pdf(req.user_id, req.session_id, job_id) as f:
+                result = f.name
+        else:
+            result = await generate_markdown(req.user_id, req.session_id, job_id)
+        status = dict(status="done", progress=100, result=result)
+    except NoMessagesError:
+        status = dict(status="failed", error="No messages found.")
+    except Exception as e:
+        status = dict(status="failed", error=str(e))
+    await jobs.aupdate(job_id, **status)
+    tracer.record("report.job", time.perf_counter() - start, format=req.format, status=status["status"])
+
+
+@app.post("/jobs")
+async def submit_case_job(req: CaseJobRequest):
+    """提交病例报告生成任务，立即返回 job_id"""
+    await asyncio.to_thread(jobs.purge)
+    job = await asyncio.to_thread(jobs.create, req.format, f"case_{req.user_id}_{req.session_id}.pdf")
+    task = asyncio.create_task(run_job(job["job_id"], req))
+    running_jobs.add(task)
+    task.add_done_callback(running_jobs.discard)
+    return {"job_id": job["job_id"], "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+async def get_case_job(job_id: str):
+    """查询任务状态与进度"""
+    job = await jobs.aget(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return {k: job[k] for k in ("job_id", "format", "status", "progress", "error", "created_at", "updated_at")}
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_case_job_result(job_id: str):
+    """流式返回任务结果：Markdown 文本或 PDF 文件"""
+    job = await jobs.aget(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job["status"] == "failed":
+        return JSONResponse(status_code=404 if job["error"] == "No messages found." else 500, content={"error": job["error"]})
+    if job["status"] != "done":
+        return JSONResponse(status_code=409, content={"status": job["status"], "progress": job["progress"]})
+    if job["format"] == "pdf":
+        try:
+            f = open(job["result"], "rb")
+        except FileNotFoundError:
+            return JSONResponse(status_code=410, content={"error": "Result evicted, please resubmit."})
+        return pdf_response(f, job["filename"])
+    return StreamingResponse(iter([job["result"]]), media_type="text/markdown; charset=utf-8")
+
+
+@app.post("/generate_case_text")
+async def generate_case_summary(req: GenerateCaseRequest):
+    print(req.user_id, req.session_id)
+    try:
+        content = await generate_markdown(req.user_id, req.session_id)
+    except NoMessagesError:
+        return JSONResponse(status_code=404, content={"error": "No messages found."})
+    return {"markdown": content}
+
 
 @app.post("/generate_case_pdf")
-def generate_case_pdf(req: GenerateCaseRequest):
-    result = generate_case_summary(req)
-    if isinstance(result, JSONResponse) and result.status_code != 200:
-        return result
+async def generate_case_pdf(req: GenerateCaseRequest):
+    try:
+        f = await generate_pdf(req.user_id, req.session_id)
+    except NoMessagesError:
+        return JSONResponse(status_code=404, content={"error": "No messages found."})
+    return pdf_response(f, f"case_{req.user_id}_{req.session_id}.pdf")
 
-    markdown_text = result["markdown"]
-    # ✅ 删除解释性开头，只保留从 "## 病例报告" 开始的内容
-    if "## 病例报告" in markdown_text:
-        markdown_text = markdown_text.split("## 病例报告", 1)[1]
-        markdown_text = "## 病例报告" + markdown_text  # 保留标题
 
-    html_text = markdown(markdown_text)
+@app.get("/ready")
+async def ready():
+    """各资源的加载状态；报告生成所需的会话存储就绪后返回 200，否则 503"""
+    status = resources.status()
+    is_ready = status["storage"]["state"] == "ready"
+    return JSONResponse(status_code=200 if is_ready else 503, content={
+        "ready": is_ready, "resources": status, "scheduler": await asyncio.to_thread(scheduler.stats),
+    })
+
+
+@app.get("/metrics")
+async def metrics():
+    """各阶段耗时与 Ollama 调度队列深度的 Prometheus 文本格式指标（汇总 Streamlit 与本服务写入的记录）"""
+    items = await asyncio.to_thread(span_reader.read)
+    queue_metrics = await asyncio.to_thread(scheduler.prometheus)
+    return PlainTextResponse(render_prometheus(items) + queue_metrics, media_type="text/plain; version=0.0.4")
 
-    # 生成临时 PDF 文件
-    os.makedirs("generated_cases", exist_ok=True)
-    pdf_path = f"generated_cases/case_{req.user_id}_{req.session_id}.pdf"
-    HTML(string=html_text).write_pdf(pdf_path)
 
-    return FileResponse(path=pdf_path, filename=os.path.basename(pdf_path), media_type="application/pdf")
+@app.get("/metrics/summary")
+async def metrics_summary():
+    """各阶段耗时的 p50/p95/p99 汇总（毫秒）"""
+    items = await asyncio.to_thread(span_reader.read)
+    return {name: summarize(values, count, total) for name, (values, count, total) in sorted(items.items())}
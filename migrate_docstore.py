@@ -0,0 +1,55 @@
+"""
+将旧版 docs/ 目录（LocalFileStore，每个父文档一个文件，内容为 str(dict)）
+迁移为打包的父文档存储 docstore/（docs.pack + docs.idx + docs.idx.log，JSON 格式）。
+
+    python migrate_docstore.py [--src docs] [--dst docstore]
+
+旧文件使用 ast.literal_eval 安全解析，不执行任意代码；迁移不修改源目录。
+"""
+import argparse
+import ast
+import json
+from langchain.storage import LocalFileStore
+from tqdm import tqdm
+from config.settings import VS_DOCS_PATH, DOCSTORE_PATH
+from utils.docstore import PackedDocStore, encode_doc
+
+
+def migrate(src=VS_DOCS_PATH, dst=DOCSTORE_PATH, batch_size=500):
+    source = LocalFileStore(src)
+    target = PackedDocStore(dst)
+    keys = list(source.yield_keys())
+    migrated, failed = 0, []
+    for i in tqdm(range(0, len(keys), batch_size), desc="Migrating docstore"):
+        batch_keys = keys[i:i + batch_size]
+        pairs = []
+        for key, raw_bytes in zip(batch_keys, source.mget(batch_keys)):
+            if raw_bytes is None:
+                continue
+            decoded = raw_bytes.decode("utf-8")
+            try:
+                entry = json.loads(decoded)
+            except json.JSONDecodeError:
+                try:
+                    entry = ast.literal_eval(decoded)
+                except (ValueError, SyntaxError) as e:
+                    failed.append((key, str(e)))
+                    continue
+            pairs.append((key, encode_doc(entry)))
+        target.mset(pairs)
+        migrated += len(pairs)
+    target.compact()
+
+    print(f"\n📦 已迁移父文档: {migrated}，失败: {len(failed)}")
+    for key, error in failed[:10]:
+        print(f"⚠️ {key}: {error}")
+    return migrated, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="迁移旧版 docs/ 父文档到打包存储")
+    parser.add_argument("--src", default=VS_DOCS_PATH, help="旧版 LocalFileStore 目录")
+    parser.add_argument("--dst", default=DOCSTORE_PATH, help="打包存储目录")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    migrate(args.src, args.dst, args.batch_size)
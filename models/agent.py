@@ -1,145 +1,459 @@
 from agno.agent import Agent
 from agno.models.ollama import Ollama
 from agno.tools.reasoning import ReasoningTools
-from config.settings import DEFAULT_MODEL, VS_PATH, VS_DOCS_PATH, EMBEDDING_MODEL, TOP_K, SEARCH_TYPE
-from langchain_ollama import OllamaEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain.storage import LocalFileStore
-from agno.storage.sqlite import SqliteStorage
-from typing import Annotated
+from config.settings import (
+    DEFAULT_MODEL, VS_PATH, DOCSTORE_PATH, EMBEDDING_MODEL, INDEX_MMAP, RETRIEVAL_SERVICE_URL,
+    SESSION_DB_PATH, HISTORY_INDEX_PATH, HISTORY_TOP_N, HISTORY_EXCLUDE_RECENT,
+    HISTORY_WINDOW, ANSWER_CACHE_ENABLED, ANSWER_CACHE_PATH, HYBRID_ENABLED, RETRIEVE_BATCH_MAX, RERANKER,
+    OLLAMA_KEEP_ALIVE, OLLAMA_WARMUP, AGENT_POOL_SIZE,
+)
+from typing import Annotated, List, Optional
+import asyncio
 import json
 import logging
+import threading
+import weakref
+from dataclasses import dataclass
 from textwrap import dedent
-import numpy as np
-import sqlite3
-from sklearn.metrics.pairwise import cosine_similarity
+from models.agent_pool import AgentPool
+from utils.ollama_scheduler import scheduler
+from utils.resources import ResourceLoader
+from utils.tracing import tracer
 
 logger = logging.getLogger(__name__)
 
-# 初始化向量数据库组件一次，避免每次调用都重复加载
-embedding_model = OllamaEmbeddings(model=EMBEDDING_MODEL)
-vectorstore = FAISS.load_local(VS_PATH, embedding_model, allow_dangerous_deserialization=True)
-docstore = LocalFileStore(VS_DOCS_PATH)
-retriever = MultiVectorRetriever(
-    vectorstore=vectorstore,
-    docstore=docstore,
-    id_key="doc_id",
-    search_type=SEARCH_TYPE,
-    search_kwargs={"k": TOP_K},
-)
+# 问诊 Agent 的固定 agent_id：agno 按 agent_id 过滤会话历史，
+# 池中的各个实例、Streamlit 重新运行后借出的实例都要能读到同一会话此前的轮次
+AGENT_ID = "medical-assistant"
+
+# 重量级资源（向量索引、各类 SQLite 存储、Ollama 健康检查）不在导入时加载：
+# 服务启动时调用 start_background_loading() 在后台并行加载，请求只等待自己用到的资源
+resources = ResourceLoader()
+
+
+def _load_embedding_model():
+    # 检索、历史问答检索共用同一个带缓存的向量化模型，重复提问无需再次请求 Ollama
+    from langchain_ollama import OllamaEmbeddings
+    from utils.embedding_cache import CachedEmbeddings
+    # 缓存未命中的向量化请求经调度器排队（embeddings 类别），命中缓存不占名额
+    from utils.ollama_scheduler import ScheduledEmbeddings
+    return CachedEmbeddings(
+        ScheduledEmbeddings(OllamaEmbeddings(model=EMBEDDING_MODEL, keep_alive=OLLAMA_KEEP_ALIVE), scheduler),
+        EMBEDDING_MODEL,
+    )
+
+
+def _load_vectorstore():
+    # 索引以内存映射方式只读加载，并按配置覆盖 IVF / HNSW 的检索参数（nprobe / efSearch）
+    from utils.faiss_index import load_vectorstore
+    return load_vectorstore(VS_PATH, resources.get("embedding_model"), mmap=INDEX_MMAP)
+
+
+def _load_docstore():
+    from utils.docstore import PackedDocStore
+    return PackedDocStore(DOCSTORE_PATH)
+
+
+def _load_sparse_index():
+    # BM25 稀疏索引（vs/sparse），旧版知识库未构建时返回 None，检索退化为纯向量检索
+    import os
+    from utils.sparse_index import SparseIndex, SPARSE_DIR
+    sparse_index = SparseIndex.load(os.path.join(VS_PATH, SPARSE_DIR), mmap=INDEX_MMAP)
+    if sparse_index is None:
+        logger.warning("未找到稀疏索引，请执行 python build_index.py --sparse-only 生成")
+    return sparse_index
+
+
+def _load_category_index():
+    # 类别 -> 向量行号（vs/categories），retrieve_medical 指定科室 / 类别时用于过滤
+    import os
+    from utils.category_index import CategoryIndex, CATEGORY_DIR
+    return CategoryIndex.load(os.path.join(VS_PATH, CATEGORY_DIR))
 
-def db_history_queries():
+
+def _load_reranker():
+    # 两阶段检索的重排序模型；交叉编码器在 CPU 上推理，加载较慢，与其他资源并行加载
+    from utils.reranker import create_reranker
+    return create_reranker(RERANKER, resources.get("embedding_model"))
+
+
+def _load_retrieval_client():
+    # 检索服务模式：索引只在 retrieval_service.py 中加载，本进程不持有索引
+    from utils.retrieval import RetrievalClient
+    return RetrievalClient(RETRIEVAL_SERVICE_URL)
+
+
+def _load_qa_history():
+    # 规范化的历史问答表（session.db 中的 qa_history），每轮问答完成时写入
+    from utils.qa_history import QAHistoryStore
+    return QAHistoryStore(SESSION_DB_PATH)
+
+
+def _load_history_index():
+    # 历史问答向量索引：每轮问答写入时向量化一次，检索时只需对当前问题向量化一次
+    from utils.history_index import HistoryIndex
+    # 问答全文只写入一次、不会再被查询，写入时绕过向量缓存，直接请求（经调度的）向量化模型
+    embedding_model = resources.get("embedding_model")
+    return HistoryIndex(
+        HISTORY_INDEX_PATH, embedding_model, backfill_source=db_history_queries,
+        document_model=embedding_model.embeddings,
+    )
+
+
+def _load_answer_cache():
+    # 按模型和知识库版本分区，知识库重建后旧缓存自动失效
+    from utils.answer_cache import SemanticAnswerCache
+    return SemanticAnswerCache(ANSWER_CACHE_PATH, resources.get("embedding_model"))
+
+
+def _load_kb_version() -> str:
+    """知识库版本；检索服务模式下由服务返回（索引文件不在本机）"""
+    from utils.faiss_index import kb_version
+    if not RETRIEVAL_SERVICE_URL:
+        return kb_version(VS_PATH)
+    try:
+        return resources.get("retrieval_client").health()["kb_version"]
+    except Exception as e:
+        logger.warning(f"获取检索服务知识库版本失败: {e}")
+        return "unknown"
+
+
+def _load_storage():
+    from agno.storage.sqlite import SqliteStorage
+    return SqliteStorage(
+        table_name="agent_sessions",
+        db_file=SESSION_DB_PATH,
+        auto_upgrade_schema=True
+    )
+
+
+def _load_ollama_client():
+    # 所有 Agent 共用一个同步客户端（内部为 httpx 连接池），不再每个 Agent 各建一个
+    import ollama
+    return ollama.Client()
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_ollama_client():
+    """
+    当前事件循环共用的异步 Ollama 客户端。httpx 的异步连接绑定在创建它的事件循环上，
+    因此按事件循环各缓存一个，而不是作为全局资源共用
+    """
+    import ollama
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = ollama.AsyncClient()
+    return client
+
+
+def _check_ollama():
+    """确认 Ollama 可访问且所需模型已拉取（只用于就绪状态展示，不阻塞其他资源）"""
+    available = {m.model for m in resources.get("ollama_client").list().models}
+    missing = [m for m in (DEFAULT_MODEL, EMBEDDING_MODEL) if m not in available and f"{m}:latest" not in available]
+    if missing:
+        logger.warning(f"Ollama 中缺少模型: {missing}")
+    return {"models": sorted(available), "missing": missing}
+
+
+def _warm_up_models():
+    """
+    预热：让 Ollama 提前加载对话模型与向量化模型并按 keep_alive 保持常驻，
+    首个请求不再承担模型冷加载的时间。空提示词只加载模型，不生成内容
+    """
+    import time
+    client = resources.get("ollama_client")
+    timings = {}
+    start = time.perf_counter()
+    client.generate(model=DEFAULT_MODEL, prompt="", keep_alive=OLLAMA_KEEP_ALIVE)
+    timings[DEFAULT_MODEL] = round(time.perf_counter() - start, 3)
+    start = time.perf_counter()
+    client.embed(model=EMBEDDING_MODEL, input="预热", keep_alive=OLLAMA_KEEP_ALIVE)
+    timings[EMBEDDING_MODEL] = round(time.perf_counter() - start, 3)
+    logger.info(f"模型预热完成（秒）: {timings}")
+    return timings
+
+
+resources.register("embedding_model", _load_embedding_model)
+if RETRIEVAL_SERVICE_URL:
+    resources.register("retrieval_client", _load_retrieval_client)
+else:
+    resources.register("vectorstore", _load_vectorstore)
+    resources.register("docstore", _load_docstore)
+    resources.register("category_index", _load_category_index)
+    if HYBRID_ENABLED:
+        resources.register("sparse_index", _load_sparse_index)
+    if RERANKER != "none":
+        resources.register("reranker", _load_reranker)
+resources.register("qa_history", _load_qa_history)
+resources.register("history_index", _load_history_index)
+resources.register("answer_cache", _load_answer_cache)
+resources.register("kb_version", _load_kb_version)
+resources.register("storage", _load_storage)
+resources.register("ollama_client", _load_ollama_client)
+resources.register("ollama", _check_ollama)
+if OLLAMA_WARMUP:
+    resources.register("model_warmup", _warm_up_models)
+
+
+def start_background_loading():
+    """服务启动时调用：后台并行加载全部资源，立即返回（重复调用无副作用）"""
+    return resources.start()
+
+
+def __getattr__(name):
+    # 兼容 models.agent.vectorstore / models.agent.storage 等旧的模块级属性，访问时才加载
+    if name in resources:
+        return resources.get(name)
+    if name == "KB_VERSION":
+        return resources.get("kb_version")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def db_history_queries(user_id: Optional[str] = None, limit: Optional[int] = HISTORY_WINDOW):
     """
     从 SQLite 数据库中获取历史查询记录
+    user_id: 指定时只返回该用户的会话记录
+    limit: 最多返回最近的若干条
     """
-    # 连接到 SQLite 数据库
-    conn = sqlite3.connect('history/session.db')
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT * FROM agent_sessions")
-        history_queries = cursor.fetchall()
-    except sqlite3.Error as e:
-        print(f"数据库查询失败: {e}")
-        return []
-    # 关闭数据库连接
-    conn.close()
-
-    # 提取第二个字段中的JSON内容
-    json_data = []
-    for session in history_queries:
-        try:
-            json_data.append(json.loads(session[2]))
-        except json.JSONDecodeError:
-            continue  # 跳过无效数据
-
-    # 提取历史消息
-    messages = []
-    for parsed_data in json_data:
-        for message in parsed_data["runs"][-1]["messages"]: # 该session最后一次运行的message包含该次全部对话
-            if message["role"] == "user":
-                query = message["content"]
-            elif message["role"] == "assistant":
-                response = message["content"]
-                # 将查询和回应一起存储
-                messages.append({
-                    "query": query,
-                    "response": response
-                })
+    messages = resources.get("qa_history").recent(user_id, limit)
     print(f"从数据库中获取到 {len(messages)} 条历史查询记录。")
     return messages
 
+
+def record_history_turn(user_id: Optional[str], query: str, response: str, session_id: Optional[str] = None):
+    """一轮对话完成后写入历史问答表与历史问答索引；写入失败只记录日志，不影响已返回给用户的回答"""
+    user_id = user_id or "default_user"
+    try:
+        resources.get("qa_history").add(user_id, session_id, query, response)
+        resources.get("history_index").add(user_id, query, response)
+    except Exception as e:
+        logger.warning(f"写入历史问答失败: {e}")
+
+
 # RAG优化-获取与当前查询相关的历史查询记录，并返回格式化后的问答对
-def get_relevant_history_queries(current_query: str):
+def get_relevant_history_queries(agent: Agent, current_query: str):
     """
     current_query: str
     """
-    # 从数据库中获取历史查询记录
-    history_queries = db_history_queries()
-    if len(history_queries) < 2:
+    # agno 会自动注入调用该工具的 agent，用其 user_id 只检索当前用户自己的历史
+    user_id = getattr(agent, "user_id", None) or "default_user"
+    with tracer.span("history.search") as attrs:
+        results = resources.get("history_index").search(
+            user_id, current_query, top_n=HISTORY_TOP_N, exclude_recent=HISTORY_EXCLUDE_RECENT
+        )
+        attrs["hits"] = len(results)
+    if not results:
         print("历史查询记录不足，无法进行相关性检索。")
         return "未找到相关历史会话。"
-
-    # 将当前查询向量化
-    current_query_embedding = np.array(embedding_model.embed_query(current_query)).reshape(1, -1)
-    # 存储历史记录的嵌入向量
-    history_embeddings = []
-
-    # 对每条历史记录分别向量化
-    for entry in history_queries[:-2]:  # 排除最近的2条记录
-        history_text = entry["query"] + " " + entry["response"]
-        history_embedding = np.array(embedding_model.embed_query(history_text)).reshape(1, -1)
-        history_embeddings.append(history_embedding)
-
-    # 将历史嵌入列表转化为一个二维数组 (m, n)，m是历史记录数，n是每个嵌入的维度
-    history_embeddings = np.vstack(history_embeddings)
-    # 计算当前查询与历史查询的余弦相似度
-    similarities = cosine_similarity(current_query_embedding, history_embeddings)
-    # 获取最相关的历史查询记录（选择相似度最高的2条）
-    top_n = 2
-    top_indices = similarities[0].argsort()[-top_n:][::-1]
-    # 输出最相关的历史记录
-    relevant_history = [history_queries[i] for i in top_indices]
-    print(f"当前查询: {current_query}，相关历史记录索引: {top_indices}, 相似度: {similarities[0][top_indices]}")
+    print(f"当前查询: {current_query}，相关历史记录相似度: {[round(score, 4) for _, score in results]}")
 
     # 构造格式化后的问答对字典
-    history_context = []
-    for entry in relevant_history:
-        history_context.append({
-            "query": entry["query"],
-            "response": entry["response"]
-        })
+    history_context = [
+        {"query": entry["query"], "response": entry["response"]}
+        for entry, _ in results
+    ]
 
     # 将字典列表转换为JSON格式字符串
-    return json.dumps(history_context, ensure_ascii=False) if history_context else "未找到相关历史会话。"
+    return json.dumps(history_context, ensure_ascii=False)
+
+
+def session_runs(agent: Agent) -> list:
+    """
+    当前会话在内存中的运行记录。agno 1.6 默认的 v2 Memory 按 session_id 分组保存（runs 为字典），
+    显式传入的旧版 AgentMemory 保存为列表
+    """
+    memory = getattr(agent, "memory", None)
+    if memory is None:
+        return []
+    if hasattr(memory, "get_runs"):
+        return memory.get_runs(agent.session_id)
+    return memory.runs or []
+
+
+def is_context_free(agent: Agent) -> bool:
+    """
+    当前会话中尚无历史轮次（内存中的运行记录为空）。调用方还需确认界面上没有本会话的历史消息；
+    首轮回答仍可能引用该用户以往的会话，因此回答缓存按用户分区，不跨用户复用
+    """
+    if agent.storage is not None and agent.session_id:
+        # 从池中借出的实例内存为空，先从存储读取本会话已有的运行记录
+        agent.initialize_agent()
+        agent.read_from_storage(session_id=agent.session_id)
+    return not session_runs(agent)
+
+
+def _record_cached_run(agent: Agent, question: str, answer: str):
+    """把缓存命中的问答作为一次运行写入会话内存与存储，写入后逐项校验，失败时抛出 RuntimeError"""
+    from uuid import uuid4
+    from agno.models.message import Message
+    from agno.run.response import RunResponse
+
+    # 与 run() 相同：初始化内存，并先从存储读取本会话已有的运行记录，写回时不会覆盖
+    agent.initialize_agent()
+    if not agent.session_id:
+        agent.session_id = str(uuid4())
+    agent.read_from_storage(session_id=agent.session_id)
+
+    user_message = Message(role="user", content=question)
+    assistant_message = Message(role="assistant", content=answer)
+    run_response = RunResponse(
+        content=answer,
+        messages=[user_message, assistant_message],
+        model=agent.model.id,
+        run_id=str(uuid4()),
+        agent_id=agent.agent_id,
+        session_id=agent.session_id,
+    )
+    if hasattr(agent.memory, "get_runs"):
+        agent.memory.add_run(agent.session_id, run_response)
+    else:
+        from agno.memory.agent import AgentRun
+
+        agent.memory.add_run(AgentRun(
+            message=user_message, messages=[user_message, assistant_message], response=run_response,
+        ))
+    if not any(_run_id(run) == run_response.run_id for run in session_runs(agent)):
+        raise RuntimeError("缓存回答未写入会话内存")
+    if agent.storage is not None:
+        saved = agent.write_to_storage(session_id=agent.session_id, user_id=agent.user_id)
+        stored = ((saved.memory or {}).get("runs") or []) if saved is not None else []
+        if not any(_run_id(run) == run_response.run_id for run in stored):
+            raise RuntimeError("缓存回答未写入会话存储")
+
+
+def _run_id(run):
+    # v2 Memory 保存 RunResponse，旧版 AgentMemory 保存 AgentRun（response 中带 run_id）；存储中为对应的字典
+    if isinstance(run, dict):
+        return run.get("run_id") or (run.get("response") or {}).get("run_id")
+    response = getattr(run, "response", None)
+    return getattr(run, "run_id", None) or getattr(response, "run_id", None)
+
+
+def get_cached_answer(agent: Agent, question: str) -> Optional[str]:
+    """命中语义缓存时返回历史回答，并写入当前会话记录，保证后续轮次的上下文完整"""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    try:
+        with tracer.span("answer_cache.lookup") as attrs:
+            hit = resources.get("answer_cache").lookup(
+                question, agent.user_id or "default_user", agent.model.id, resources.get("kb_version")
+            )
+            attrs["hit"] = hit is not None
+    except Exception as e:
+        logger.warning(f"回答缓存查询失败: {e}")
+        return None
+    if hit is None:
+        return None
+    answer, score = hit
+    print(f"命中回答缓存，相似度: {score:.4f}")
+    try:
+        _record_cached_run(agent, question, answer)
+    except Exception:
+        # 会话里没有这一轮，后续轮次的上下文会缺失：不使用缓存回答，本轮照常调用模型
+        logger.exception("缓存回答写入会话失败，改为调用模型回答")
+        return None
+    return answer
+
+
+def cache_answer(agent: Agent, question: str, answer: str):
+    """将会话首轮的独立提问及其回答写入语义缓存"""
+    if not ANSWER_CACHE_ENABLED or not answer or answer == "[无有效回答]":
+        return
+    try:
+        resources.get("answer_cache").store(
+            question, answer, agent.user_id or "default_user", agent.model.id, resources.get("kb_version")
+        )
+    except Exception as e:
+        logger.warning(f"写入回答缓存失败: {e}")
 
 
 # agno的agent推理功能依据prompt就会自动进行简单的查询重写，以及工具函数的返回结果并不会直接作为调用该工具的agent的返回，
 # 而是会进一步用于推理回答，所以工具函数无需再实例化一个agent
 # 即retrieve_medical只需要返回检索结果
-def retrieve_medical(query: Annotated[str, "需要查询的医学问题"]) -> str:
-    results = retriever.invoke(query)
-    contexts = []
-    for raw_bytes in results:
-        try:
-            decoded = raw_bytes.decode("utf-8")
-            doc_dict = eval(decoded)
-            contexts.append(json.dumps(doc_dict, ensure_ascii=False))
-        except Exception as e:
-            logger.warning(f"解码失败: {e}")
+def retrieve_medical(
+    query: Annotated[str, "需要查询的医学问题"],
+    category: Annotated[Optional[str], "可选，科室或疾病类别（如“内科”“儿科”“皮肤科”），只在该类别中检索"] = None,
+) -> str:
+    with tracer.span("retrieve.total"):
+        if RETRIEVAL_SERVICE_URL:
+            contexts = resources.get("retrieval_client").retrieve(query, category=category)
+        else:
+            from utils.retrieval import search_documents
+            contexts = search_documents(
+                query, resources.get("embedding_model"), resources.get("vectorstore"), resources.get("docstore"),
+                sparse_index=resources.get("sparse_index") if "sparse_index" in resources else None,
+                category=category,
+                category_index=resources.get("category_index") if category else None,
+                reranker=resources.get("reranker") if "reranker" in resources else None,
+            )
     return "\n\n".join(contexts) if contexts else "未找到相关医学资料。"
 
-storage = SqliteStorage(
-    table_name="agent_sessions",
-    db_file="history/session.db",
-    auto_upgrade_schema=True
-)
+
+def retrieve_medical_batch(
+    queries: Annotated[List[str], "需要同时查询的多个医学问题或疾病名，如多个疑似疾病"],
+    category: Annotated[Optional[str], "可选，科室或疾病类别（如“内科”“儿科”“皮肤科”），只在该类别中检索"] = None,
+) -> str:
+    # 多个查询合并为一次向量化请求和一次索引检索，父文档跨查询去重
+    queries = list(queries)[:RETRIEVE_BATCH_MAX]
+    with tracer.span("retrieve.total", batch=len(queries)):
+        if RETRIEVAL_SERVICE_URL:
+            contexts = resources.get("retrieval_client").retrieve_batch(queries, category=category)
+        else:
+            from utils.retrieval import search_documents_batch
+            contexts = search_documents_batch(
+                queries, resources.get("embedding_model"), resources.get("vectorstore"), resources.get("docstore"),
+                sparse_index=resources.get("sparse_index") if "sparse_index" in resources else None,
+                category=category,
+                category_index=resources.get("category_index") if category else None,
+                reranker=resources.get("reranker") if "reranker" in resources else None,
+            )
+    return "\n\n".join(contexts) if contexts else "未找到相关医学资料。"
+
+@dataclass
+class ScheduledOllama(Ollama):
+    """
+    每次调用对话模型时占用一个调度名额（流式调用在消费完之前一直占用）。
+    Agent 执行工具（检索、历史问答检索）发生在两次模型调用之间，此时不占用对话模型的名额
+    """
+
+    scheduler_class: str = "interactive"
+
+    def invoke(self, *args, **kwargs):
+        with scheduler.slot(self.scheduler_class):
+            return super().invoke(*args, **kwargs)
+
+    async def ainvoke(self, *args, **kwargs):
+        async with scheduler.aslot(self.scheduler_class):
+            return await super().ainvoke(*args, **kwargs)
+
+    def invoke_stream(self, *args, **kwargs):
+        with scheduler.slot(self.scheduler_class):
+            yield from super().invoke_stream(*args, **kwargs)
+
+    async def ainvoke_stream(self, *args, **kwargs):
+        async with scheduler.aslot(self.scheduler_class):
+            async for chunk in super().ainvoke_stream(*args, **kwargs):
+                yield chunk
+
+
+def build_model(model_id: str = DEFAULT_MODEL) -> Ollama:
+    """共用 Ollama 客户端与 keep_alive 的模型对象，每次模型调用经调度器排队（interactive 类别）"""
+    return ScheduledOllama(
+        id=model_id,
+        keep_alive=OLLAMA_KEEP_ALIVE,
+        client=resources.get("ollama_client"),
+    )
+
 
 # agent
 def get_agent(model_id: str = DEFAULT_MODEL, session_id=None, user_id=None) -> Agent:
     return Agent(
         name="Medical Assistant",
-        model=Ollama(id=model_id),
+        agent_id=AGENT_ID,
+        model=build_model(model_id),
         session_id=session_id,
         user_id=user_id,
         instructions=dedent("""\
@@ -162,7 +476,7 @@ def get_agent(model_id: str = DEFAULT_MODEL, session_id=None, user_id=None) -> A
                                  * 是否近期接触感冒患者、天气变化、工作环境变化等？
                                - 有无基础疾病史（如哮喘、胃病、糖尿病等）
                             3. 请使用get_relevant_history_queries工具指令 `get_relevant_history_queries(query)` 获取与当前提问相关的历史查询记录，如有完全相同的提问可以直接返回历史回答，并在此基础上询问用户是否哪里理解不清楚。
-                            4. 在合适时机使用工具指令 `retrieve_medical("疾病名")` 查询相关疾病的结构化信息。
+                            4. 在合适时机使用工具指令 `retrieve_medical("疾病名")` 查询相关疾病的结构化信息；已能判断所属科室时可指定类别缩小范围，如 `retrieve_medical("胸痛", category="心内科")`。需要同时查询多个疑似疾病时，使用 `retrieve_medical_batch(["疾病名1", "疾病名2"])` 一次完成，不要逐个调用 `retrieve_medical`。
                             5. 在信息收集充分后，整理并输出一份面向医生的简要病例描述，并建议用户就诊方向（如科室或检查类型）。
 
                             【行为规范】
@@ -187,13 +501,34 @@ def get_agent(model_id: str = DEFAULT_MODEL, session_id=None, user_id=None) -> A
                             - 建议：建议前往呼吸科就诊，必要时进行过敏原检测
                             如果你认为用户当前的问题无法凭借自身内部知识直接回答，需要检索类似上述的医学知识，那么使用retrieve_medical工具，例如：retrieve_medical(query)，否则无需检索直接回答\
                         """),
-        tools=[ReasoningTools(add_instructions=True), retrieve_medical, get_relevant_history_queries],
+        tools=[ReasoningTools(add_instructions=True), retrieve_medical, retrieve_medical_batch, get_relevant_history_queries],
         show_tool_calls=True,
         markdown=True,
         num_history_responses=3,
         add_history_to_messages=True,
-        storage=storage,
+        storage=resources.get("storage"),
         search_previous_sessions_history=True,
         num_history_sessions=2,
     )
 
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def agent_pool(model_id: str = DEFAULT_MODEL) -> AgentPool:
+    """
+    按模型取问诊 Agent 池，首次使用时创建。用法：
+        with agent_pool().acquire(session_id=..., user_id=...) as agent:
+            agent.run(...)
+    """
+    with _pools_lock:
+        pool = _pools.get(model_id)
+        if pool is None:
+            pool = _pools[model_id] = AgentPool(lambda: get_agent(model_id), AGENT_POOL_SIZE)
+    return pool
+
+
+def pool_stats():
+    with _pools_lock:
+        return {model_id: pool.stats() for model_id, pool in _pools.items()}
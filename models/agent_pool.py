@@ -0,0 +1,84 @@
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+
+class AgentPool:
+    """
+    预先配置好的 Agent 实例池：指令、工具 schema、ReasoningTools 与模型对象只构建一次，
+    每个请求借出一个实例并绑定自己的 session_id / user_id，用完清理会话状态后归还。
+    会话历史在 run() 时按 session_id 从存储读取，实例之间需使用相同的 agent_id（历史按 agent_id 过滤）。
+    Agent 在一次运行期间保存运行状态，不能被两个请求同时使用；池中没有空闲实例时临时新建一个，
+    归还时池已满则丢弃，因此借用从不阻塞，异步代码中也可以直接使用。
+    """
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        # 后进先出：最近用过的实例先借出
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.borrowed = 0
+
+    def _new(self):
+        agent = self.factory()
+        with self._lock:
+            self.created += 1
+        return agent
+
+    def prewarm(self):
+        """预先创建 size 个实例"""
+        while self._idle.qsize() < self.size:
+            self._idle.put(self._new())
+        return self
+
+    @staticmethod
+    def _bind(agent, session_id, user_id):
+        # run() 时按 session_id 从存储中读取该会话的历史，user_id 供工具与跨会话历史使用
+        agent.reset_session_state()
+        agent.reset_run_state()
+        agent.session_id = session_id or str(uuid4())
+        agent.user_id = user_id
+
+    @staticmethod
+    def _unbind(agent):
+        # 清理本次会话加载到内存中的历史运行记录，池中实例的内存不随服务过的会话数增长
+        # （v2 Memory 的 runs 为按 session_id 分组的字典，旧版 AgentMemory 为列表，均可 clear）
+        memory = getattr(agent, "memory", None)
+        if memory is not None and getattr(memory, "runs", None):
+            memory.runs.clear()
+        agent.reset_session_state()
+        agent.reset_run_state()
+        agent.session_id = None
+        agent.user_id = None
+
+    @contextmanager
+    def acquire(self, session_id=None, user_id=None):
+        """借出一个绑定到 session_id / user_id 的 Agent；流式运行需在 with 块内消费完"""
+        try:
+            agent = self._idle.get_nowait()
+        except queue.Empty:
+            agent = self._new()
+        with self._lock:
+            self.borrowed += 1
+        self._bind(agent, session_id, user_id)
+        try:
+            yield agent
+        finally:
+            with self._lock:
+                self.borrowed -= 1
+            try:
+                self._unbind(agent)
+            except Exception as e:
+                logger.warning(f"Agent 状态清理失败，丢弃该实例: {e}")
+                return
+            if self._idle.qsize() < self.size:
+                self._idle.put(agent)
+
+    def stats(self):
+        return {"size": self.size, "idle": self._idle.qsize(), "borrowed": self.borrowed, "created": self.created}
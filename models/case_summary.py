@@ -0,0 +1,44 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from config.settings import DEFAULT_MODEL
+from models.report_engine import object_schema, structured_chat
+from utils.case_db import CaseStorage
+from utils.case_state import CaseStateTracker, CASE_STATE_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+def summarize_case_state(state: dict, transcript: str, model_id: str = DEFAULT_MODEL):
+    """将新增的问诊对话合并进结构化病例状态，解析失败时返回 None（保留原状态）"""
+    prompt = f"""你是一名医学助手，负责在问诊过程中持续维护一份结构化病例信息。
+以下是目前已整理的病例信息（JSON）：
+{json.dumps(state, ensure_ascii=False, indent=2)}
+
+以下是新增的问诊对话：
+{transcript}
+
+请结合新增对话更新病例信息：保留已有内容，补充或修正新的信息，无法确定的字段保留为空字符串。
+只输出一个 JSON 对象，不要输出其他内容，键依次为：{"、".join(CASE_STATE_FIELDS)}。
+"""
+    try:
+        # 按病例状态字段约束输出，一次调用即得到可解析的 JSON
+        return structured_chat(prompt, object_schema(CASE_STATE_FIELDS), model_id)
+    except ValueError as e:
+        logger.warning(f"病例状态解析失败: {e}")
+        return None
+
+
+case_state_tracker = CaseStateTracker(CaseStorage(), summarize_case_state)
+# 后台单线程执行合并，不阻塞问诊回复
+_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def schedule_case_state_update(user_id: str, session_id: str):
+    """新消息写入后调用：未整理消息超过阈值时在后台合并"""
+    def _update():
+        try:
+            case_state_tracker.update(user_id, session_id)
+        except Exception as e:
+            logger.warning(f"病例状态更新失败: {e}")
+    _executor.submit(_update)
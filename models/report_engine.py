@@ -0,0 +1,128 @@
+import json
+import logging
+from datetime import datetime
+from config.settings import DEFAULT_MODEL, OLLAMA_KEEP_ALIVE, REPORT_STRUCTURED_OUTPUT, REPORT_TEMPERATURE
+from models.agent import async_ollama_client, resources
+from utils.ollama_scheduler import scheduler
+from utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# 病例报告引擎：一次直接调用 Ollama 生成报告，不经过问诊 Agent（无工具、无推理循环、不注入会话历史）。
+# 结构化模式下按固定 JSON Schema 约束输出（Ollama 的 format 参数），再由固定模板渲染为 Markdown；
+# 关闭结构化输出时由模型直接按 Markdown 模板输出。
+
+BASIC_INFO_FIELDS = ["姓名", "性别", "年龄"]
+REPORT_SECTIONS = ["主诉", "现病史", "既往史", "个人史、家族史", "初步诊断", "初步治疗建议"]
+DISCLAIMER = "本病例报告由人工智能助手生成，结果仅供参考，不构成医疗建议。"
+
+
+def object_schema(fields, nested=None):
+    """字段均为字符串的 JSON 对象 Schema；nested: 字段名 -> 子对象 Schema"""
+    nested = nested or {}
+    properties = {field: nested.get(field, {"type": "string"}) for field in fields}
+    return {"type": "object", "properties": properties, "required": list(fields)}
+
+
+REPORT_SCHEMA = object_schema(
+    ["基本信息"] + REPORT_SECTIONS, {"基本信息": object_schema(BASIC_INFO_FIELDS)}
+)
+
+REPORT_INSTRUCTIONS = """你是一名医学助手，负责根据患者与AI助手的问诊记录整理病例报告，各部分要求如下：
+- 基本信息：患者的姓名、性别、年龄，无法确定时留空；
+- 主诉：患者的症状自述；
+- 现病史：当前症状的详细发展过程、有无相关症状、是否接受过治疗、疗效如何等；
+- 既往史：既往重大疾病（如高血压、糖尿病、心脏病等）、手术史、外伤史、过敏史（药物、食物等）、疫苗接种史（如与发热相关）等；
+- 个人史、家族史：吸烟、饮酒、职业、生活环境等；家族中是否有相似病史或遗传疾病；
+- 初步诊断：根据现有资料作出的初步判断；
+- 初步治疗建议：药物治疗（药名、剂量、途径、频率）、非药物治疗（休息、饮食、心理疏导等）。
+问诊记录可能包含【已整理的病例信息】（此前对话的结构化摘要）与【最新对话】两部分，请综合两者；记录中没有的信息不要编造，留空即可。"""
+
+
+def parse_json_object(content: str) -> dict:
+    """取出模型输出中的 JSON 对象，失败时抛出 ValueError"""
+    content = content or ""
+    value = json.loads(content[content.index("{"):content.rindex("}") + 1])
+    if not isinstance(value, dict):
+        raise ValueError("输出不是 JSON 对象")
+    return value
+
+
+def _text(value) -> str:
+    # 受约束输出均为字符串；模型偶尔返回列表 / 对象时逐项展开
+    if isinstance(value, list):
+        return "\n".join(f"- {_text(item)}" for item in value)
+    if isinstance(value, dict):
+        return "\n".join(f"- {key}：{_text(item)}" for key, item in value.items())
+    return "" if value is None else str(value).strip()
+
+
+def render_report(report: dict, generated_at: str = None) -> str:
+    """结构化报告 -> Markdown，结构与 PDF 渲染所需的“## 病例报告”格式一致"""
+    generated_at = generated_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    basic = report.get("基本信息")
+    basic = basic if isinstance(basic, dict) else {}
+    lines = ["## 病例报告", "", "### 【基本信息】"]
+    lines += [f"- {field}：{_text(basic.get(field))}" for field in BASIC_INFO_FIELDS]
+    for section in REPORT_SECTIONS:
+        lines += ["", f"### 【{section}】", _text(report.get(section)) or "未提及"]
+    lines += ["", f"生成时间：{generated_at}", "", DISCLAIMER]
+    return "\n".join(lines) + "\n"
+
+
+_MARKDOWN_TEMPLATE = render_report(
+    {"基本信息": {field: f"<{field}或空>" for field in BASIC_INFO_FIELDS}, **{s: "..." for s in REPORT_SECTIONS}},
+    generated_at="<生成时间>",
+)
+
+
+def _report_request(context: str, model_id: str, structured: bool) -> dict:
+    if structured:
+        instructions = f"{REPORT_INSTRUCTIONS}\n只输出一个 JSON 对象，键依次为：基本信息（含{'、'.join(BASIC_INFO_FIELDS)}）、{'、'.join(REPORT_SECTIONS)}。"
+    else:
+        instructions = f"{REPORT_INSTRUCTIONS}\n以 Markdown 格式输出，严格按照如下结构：\n\n{_MARKDOWN_TEMPLATE}"
+    request = {
+        "model": model_id,
+        "messages": [
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": f"以下是问诊记录：\n{context}"},
+        ],
+        "options": {"temperature": REPORT_TEMPERATURE},
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+    }
+    if structured:
+        request["format"] = REPORT_SCHEMA
+    return request
+
+
+async def agenerate_report(context: str, model_id: str = DEFAULT_MODEL, structured: bool = REPORT_STRUCTURED_OUTPUT) -> str:
+    """
+    由 报告上下文（病例状态 + 最新对话）生成 Markdown 病例报告，只调用一次模型；
+    结构化输出解析失败时退回 Markdown 模式再生成一次
+    """
+    client = async_ollama_client()
+    # 报告属于批量类请求，优先级最低，不与交互问答争抢对话模型的名额
+    async with scheduler.aslot("reports"):
+        with tracer.span("report.llm", prompt_chars=len(context), structured=structured):
+            response = await client.chat(**_report_request(context, model_id, structured))
+    content = response.message.content or ""
+    if not structured:
+        return content
+    try:
+        return render_report(parse_json_object(content))
+    except ValueError as e:
+        logger.warning(f"结构化报告解析失败，改用 Markdown 输出: {e}")
+        return await agenerate_report(context, model_id, structured=False)
+
+
+def structured_chat(prompt: str, schema: dict, model_id: str = DEFAULT_MODEL) -> dict:
+    """单次按 JSON Schema 约束输出的同步调用，返回解析后的对象，解析失败时抛出 ValueError"""
+    with scheduler.slot("reports"):
+        response = resources.get("ollama_client").chat(
+            model=model_id,
+            messages=[{"role": "user", "content": prompt}],
+            format=schema,
+            options={"temperature": REPORT_TEMPERATURE},
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+    return parse_json_object(response.message.content)
@@ -0,0 +1,112 @@
+"""
+独立的知识库检索服务：索引只在这里加载（内存映射、只读），问答应用与报告服务通过 HTTP 调用，
+各工作进程不再各自持有一份索引。
+
+    uvicorn retrieval_service:app --host 127.0.0.1 --port 8001 --workers 2
+    RETRIEVAL_SERVICE_URL=http://127.0.0.1:8001 streamlit run app.py
+
+多个 worker 映射同一组只读文件（index.faiss、分块 chunks.pack、父文档 docs.pack、稀疏索引），
+页由操作系统页缓存共享。只有 Flat / HNSW 索引支持映射，IVF 类索引会退回普通加载，每个 worker 各持有一份。
+"""
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from typing import List, Optional
+from pydantic import BaseModel
+from langchain_ollama import OllamaEmbeddings
+from config.settings import (
+    VS_PATH, DOCSTORE_PATH, EMBEDDING_MODEL, TOP_K, INDEX_MMAP, HYBRID_ENABLED, RETRIEVE_BATCH_MAX, RERANKER,
+    OLLAMA_KEEP_ALIVE,
+)
+from utils.category_index import CategoryIndex, CATEGORY_DIR
+from utils.docstore import PackedDocStore
+from utils.embedding_cache import CachedEmbeddings
+from utils.faiss_index import kb_version, load_vectorstore
+from utils.ollama_scheduler import ScheduledEmbeddings, SchedulerBusy, scheduler
+from utils.reranker import create_reranker
+from utils.retrieval import search_documents, search_documents_batch
+from utils.sparse_index import SparseIndex, SPARSE_DIR
+
+resources = {}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 向量化请求经调度器排队，与其他进程共享 embeddings 类别的并发名额
+    embedding_model = CachedEmbeddings(
+        ScheduledEmbeddings(OllamaEmbeddings(model=EMBEDDING_MODEL, keep_alive=OLLAMA_KEEP_ALIVE), scheduler),
+        EMBEDDING_MODEL,
+    )
+    resources["embedding_model"] = embedding_model
+    resources["vectorstore"] = load_vectorstore(VS_PATH, embedding_model, mmap=INDEX_MMAP)
+    resources["docstore"] = PackedDocStore(DOCSTORE_PATH)
+    resources["category_index"] = CategoryIndex.load(os.path.join(VS_PATH, CATEGORY_DIR))
+    if HYBRID_ENABLED:
+        resources["sparse_index"] = SparseIndex.load(os.path.join(VS_PATH, SPARSE_DIR), mmap=INDEX_MMAP)
+    resources["reranker"] = create_reranker(RERANKER, embedding_model)
+    resources["kb_version"] = kb_version(VS_PATH)
+    yield
+    resources.clear()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(SchedulerBusy)
+async def scheduler_busy(request: Request, exc: SchedulerBusy):
+    """Ollama 排队过深或等待超时：快速返回 503，由调用方稍后重试"""
+    return JSONResponse(status_code=503, content={"error": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
+class RetrieveRequest(BaseModel):
+    query: str
+    k: int = TOP_K
+    category: Optional[str] = None
+
+
+@app.post("/retrieve")
+def retrieve(req: RetrieveRequest):
+    """同步接口，FAISS 检索在线程池中执行（检索时释放 GIL）"""
+    documents = search_documents(
+        req.query, resources["embedding_model"], resources["vectorstore"], resources["docstore"], k=req.k,
+        sparse_index=resources.get("sparse_index"),
+        category=req.category,
+        category_index=resources.get("category_index"),
+        reranker=resources.get("reranker"),
+    )
+    return {"documents": documents}
+
+
+class RetrieveBatchRequest(BaseModel):
+    queries: List[str]
+    k: int = TOP_K
+    category: Optional[str] = None
+
+
+@app.post("/retrieve_batch")
+def retrieve_batch(req: RetrieveBatchRequest):
+    """多个查询一次向量化、一次索引检索，父文档跨查询去重"""
+    documents = search_documents_batch(
+        req.queries[:RETRIEVE_BATCH_MAX], resources["embedding_model"], resources["vectorstore"],
+        resources["docstore"], k=req.k,
+        sparse_index=resources.get("sparse_index"),
+        category=req.category,
+        category_index=resources.get("category_index"),
+        reranker=resources.get("reranker"),
+    )
+    return {"documents": documents}
+
+
+@app.get("/health")
+def health():
+    vectorstore = resources.get("vectorstore")
+    return {
+        "status": "ok" if vectorstore is not None else "loading",
+        "vectors": vectorstore.index.ntotal if vectorstore is not None else 0,
+        "kb_version": resources.get("kb_version"),
+        "mmap": INDEX_MMAP,
+        "sparse": resources.get("sparse_index") is not None,
+        "reranker": RERANKER,
+        "scheduler": scheduler.stats(),
+    }
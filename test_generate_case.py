@@ -25,3 +25,22 @@ if resp_pdf.status_code == 200:
     print("✅ PDF 已保存为 downloaded_case.pdf")
 else:
     print("❌ PDF 请求失败:", resp_pdf.status_code, resp_pdf.text)
+
+
+# 3. 测试异步任务接口：提交 -> 轮询状态 -> 获取结果
+import time
+
+resp_job = requests.post(f"{base_url}/jobs", json={**payload, "format": "markdown"})
+print("\n=== 异步任务 ===")
+if resp_job.status_code == 200:
+    job_id = resp_job.json()["job_id"]
+    while True:
+        status = requests.get(f"{base_url}/jobs/{job_id}").json()
+        print(f"状态: {status['status']}，进度: {status['progress']}%")
+        if status["status"] in ("done", "failed"):
+            break
+        time.sleep(1)
+    resp_result = requests.get(f"{base_url}/jobs/{job_id}/result")
+    print(resp_result.text if resp_result.status_code == 200 else f"❌ 任务失败: {resp_result.text}")
+else:
+    print("❌ 提交任务失败:", resp_job.status_code, resp_job.text)
@@ -1,6 +1,6 @@
 import os, sys
 import time
-from models.agent import get_agent
+from models.agent import agent_pool
 from utils.case_db import CaseStorage
 
 case_db = CaseStorage()
@@ -11,25 +11,27 @@ def test_session_and_save():
 
     # === 第一次会话 ===
     session_1 = "session_001"
-    agent1 = get_agent(session_id=session_1, user_id=user_id)
+    # 每轮从池中借出 Agent 并绑定会话，会话历史由存储按 session_id 读取
 
     q1 = "什么是肺泡蛋白质沉积症？"
-    a1 = get_answer(agent1.run(q1))
+    with agent_pool().acquire(session_id=session_1, user_id=user_id) as agent:
+        a1 = get_answer(agent.run(q1))
     case_db.save_message(session_1, user_id, "user", q1)
     case_db.save_message(session_1, user_id, "assistant", a1)
 
     q2 = "它的治疗方式有哪些？"
-    a2 = get_answer(agent1.run(q2))
+    with agent_pool().acquire(session_id=session_1, user_id=user_id) as agent:
+        a2 = get_answer(agent.run(q2))
     case_db.save_message(session_1, user_id, "user", q2)
     case_db.save_message(session_1, user_id, "assistant", a2)
 
     # === 第二次会话（跨 session 接着问）===
     session_2 = "session_002"
-    agent2 = get_agent(session_id=session_2, user_id=user_id)
 
     # ✅ 显式补充“我上次说的病是...”
     q3 = "我上次说的肺泡蛋白质沉积症，还有什么并发症？"
-    a3 = get_answer(agent2.run(q3))
+    with agent_pool().acquire(session_id=session_2, user_id=user_id) as agent:
+        a3 = get_answer(agent.run(q3))
     case_db.save_message(session_2, user_id, "user", q3)
     case_db.save_message(session_2, user_id, "assistant", a3)
 
@@ -0,0 +1,139 @@
+# utils/answer_cache.py
+import os
+import threading
+import time
+
+import numpy as np
+
+from config.settings import ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ENTRIES
+from utils.storage import connect
+
+
+class SemanticAnswerCache:
+    """
+    语义回答缓存：按 (用户, 模型, 知识库版本) 分区保存已回答的问题向量与回答。
+    新问题与缓存问题的余弦相似度超过阈值时直接返回缓存回答，无需再调用大模型。
+    回答可能引用该用户的历史会话，因此只在同一用户内复用，不同用户之间不共享。
+    旧版本知识库的缓存不会再命中，由重建 / 更新索引时调用 invalidate(kb_version) 清理。
+    """
+
+    def __init__(self, db_path, embedding_model, threshold=ANSWER_CACHE_THRESHOLD, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = connect(db_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                model_id TEXT,
+                kb_version TEXT,
+                question TEXT,
+                answer TEXT,
+                embedding BLOB,
+                hits INTEGER DEFAULT 0,
+                last_used REAL
+            )
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(answer_cache)")}
+        if "user_id" not in columns:
+            # 旧版缓存不区分用户，可能包含引用其他用户历史的回答，升级时直接丢弃
+            self.conn.execute("ALTER TABLE answer_cache ADD COLUMN user_id TEXT")
+            self.conn.execute("DELETE FROM answer_cache")
+        self.conn.execute("DROP INDEX IF EXISTS idx_answer_cache_partition")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_answer_cache_user_partition ON answer_cache (user_id, model_id, kb_version)"
+        )
+        self.conn.commit()
+        # (user_id, model_id, kb_version) -> {"ids": [...], "matrix": np.ndarray, "version": (行数, 最大 id)}
+        self._partitions = {}
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _load(self, user_id, model_id, kb_version):
+        """
+        取分区的向量矩阵。其他进程（问答应用、报告服务、其他 worker）写入或淘汰的条目不会通知本进程，
+        每次先按索引查询分区的行数与最大 id，与缓存的不一致时重新加载
+        """
+        key = (user_id, model_id, kb_version)
+        version = tuple(self.conn.execute(
+            "SELECT COUNT(*), MAX(id) FROM answer_cache WHERE user_id=? AND model_id=? AND kb_version=?", key
+        ).fetchone())
+        partition = self._partitions.get(key)
+        if partition is None or partition["version"] != version:
+            rows = self.conn.execute(
+                "SELECT id, embedding FROM answer_cache WHERE user_id=? AND model_id=? AND kb_version=? ORDER BY id",
+                key,
+            ).fetchall()
+            partition = {
+                "ids": [r[0] for r in rows],
+                "matrix": np.vstack([np.frombuffer(r[1], dtype=np.float32) for r in rows]) if rows else None,
+                "version": (len(rows), rows[-1][0] if rows else None),
+            }
+            self._partitions[key] = partition
+        return partition
+
+    def lookup(self, question, user_id, model_id, kb_version):
+        """返回 (回答, 相似度)，未命中返回 None"""
+        with self.lock:
+            partition = self._load(user_id, model_id, kb_version)
+            if partition["matrix"] is None:
+                return None
+        query = self._normalize(self.embedding_model.embed_query(question))
+        with self.lock:
+            scores = partition["matrix"] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            entry_id = partition["ids"][best]
+            row = self.conn.execute("SELECT answer FROM answer_cache WHERE id=?", (entry_id,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE answer_cache SET hits = hits + 1, last_used=? WHERE id=?", (time.time(), entry_id)
+            )
+            self.conn.commit()
+            return row[0], float(scores[best])
+
+    def store(self, question, answer, user_id, model_id, kb_version):
+        embedding = self._normalize(self.embedding_model.embed_query(question))
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO answer_cache (user_id, model_id, kb_version, question, answer, embedding, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, model_id, kb_version, question, answer, embedding.tobytes(), time.time()),
+            )
+            evicted = self.conn.execute(
+                "DELETE FROM answer_cache WHERE id IN ("
+                "SELECT id FROM answer_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            self.conn.commit()
+            if evicted:
+                # 有条目被淘汰时各分区均在下次查询时重新加载
+                self._partitions = {}
+                return
+            partition = self._partitions.get((user_id, model_id, kb_version))
+            if partition is not None:
+                partition["ids"].append(cursor.lastrowid)
+                partition["version"] = (len(partition["ids"]), cursor.lastrowid)
+                partition["matrix"] = (
+                    embedding.reshape(1, -1) if partition["matrix"] is None
+                    else np.vstack([partition["matrix"], embedding])
+                )
+
+    def invalidate(self, kb_version=None):
+        """清空缓存；指定 kb_version 时只保留该版本的缓存"""
+        with self.lock:
+            if kb_version is None:
+                self.conn.execute("DELETE FROM answer_cache")
+            else:
+                self.conn.execute("DELETE FROM answer_cache WHERE kb_version != ?", (kb_version,))
+            self.conn.commit()
+            self._partitions = {}
@@ -1,42 +1,194 @@
 # utils/case_db.py
-import sqlite3
+import asyncio
+import json
 from datetime import datetime
+from config.settings import CASE_DB_PATH, SESSION_TITLE_LENGTH
+from utils.storage import get_pool
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS case_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        user_id TEXT,
+        role TEXT,        -- 'user' or 'assistant'
+        message TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_case_records_user_session ON case_records (user_id, session_id, id);
+    CREATE INDEX IF NOT EXISTS idx_case_records_created_at ON case_records (created_at);
+    -- 会话的结构化病例状态（滚动摘要），last_message_id 之前的消息已合并进 state
+    CREATE TABLE IF NOT EXISTS case_states (
+        user_id TEXT,
+        session_id TEXT,
+        state TEXT,
+        last_message_id INTEGER DEFAULT 0,
+        updated_at TIMESTAMP,
+        PRIMARY KEY (user_id, session_id)
+    );
+    -- 会话目录：由触发器在写入消息时维护，侧边栏分页查询无需扫描 case_records
+    CREATE TABLE IF NOT EXISTS case_sessions (
+        user_id TEXT,
+        session_id TEXT,
+        title TEXT DEFAULT '',
+        message_count INTEGER DEFAULT 0,
+        created_at TIMESTAMP,
+        last_active_at TIMESTAMP,
+        PRIMARY KEY (user_id, session_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_case_sessions_user_active ON case_sessions (user_id, last_active_at);
+    CREATE INDEX IF NOT EXISTS idx_case_sessions_session ON case_sessions (session_id);
+    CREATE TRIGGER IF NOT EXISTS trg_case_records_insert AFTER INSERT ON case_records
+    BEGIN
+        INSERT INTO case_sessions (user_id, session_id, title, message_count, created_at, last_active_at)
+        VALUES (
+            NEW.user_id, NEW.session_id,
+            CASE WHEN NEW.role = 'user' THEN substr(NEW.message, 1, {title_length}) ELSE '' END,
+            1, NEW.created_at, NEW.created_at
+        )
+        ON CONFLICT (user_id, session_id) DO UPDATE SET
+            message_count = message_count + 1,
+            last_active_at = max(last_active_at, excluded.last_active_at),
+            title = CASE WHEN title = '' THEN excluded.title ELSE title END;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_case_records_delete AFTER DELETE ON case_records
+    BEGIN
+        UPDATE case_sessions SET message_count = message_count - 1
+        WHERE user_id = OLD.user_id AND session_id = OLD.session_id;
+        DELETE FROM case_sessions
+        WHERE user_id = OLD.user_id AND session_id = OLD.session_id AND message_count <= 0;
+    END;
+    -- 会话重命名：消息计数从旧会话移到新会话
+    CREATE TRIGGER IF NOT EXISTS trg_case_records_move AFTER UPDATE OF session_id, user_id ON case_records
+    WHEN OLD.session_id IS NOT NEW.session_id OR OLD.user_id IS NOT NEW.user_id
+    BEGIN
+        UPDATE case_sessions SET message_count = message_count - 1
+        WHERE user_id = OLD.user_id AND session_id = OLD.session_id;
+        DELETE FROM case_sessions
+        WHERE user_id = OLD.user_id AND session_id = OLD.session_id AND message_count <= 0;
+        INSERT INTO case_sessions (user_id, session_id, title, message_count, created_at, last_active_at)
+        VALUES (
+            NEW.user_id, NEW.session_id,
+            CASE WHEN NEW.role = 'user' THEN substr(NEW.message, 1, {title_length}) ELSE '' END,
+            1, NEW.created_at, NEW.created_at
+        )
+        ON CONFLICT (user_id, session_id) DO UPDATE SET
+            message_count = message_count + 1,
+            created_at = min(created_at, excluded.created_at),
+            last_active_at = max(last_active_at, excluded.last_active_at),
+            title = CASE WHEN title = '' THEN excluded.title ELSE title END;
+    END;
+""".replace("{title_length}", str(SESSION_TITLE_LENGTH))
+
+# 已有数据库首次建立会话目录时，从 case_records 汇总一次
+BACKFILL_SESSIONS = f"""
+    INSERT OR IGNORE INTO case_sessions (user_id, session_id, title, message_count, created_at, last_active_at)
+    SELECT r.user_id, r.session_id,
+           COALESCE((
+               SELECT substr(t.message, 1, {SESSION_TITLE_LENGTH}) FROM case_records t
+               WHERE t.user_id = r.user_id AND t.session_id = r.session_id AND t.role = 'user'
+               ORDER BY t.id LIMIT 1
+           ), ''),
+           COUNT(*), MIN(r.created_at), MAX(r.created_at)
+    FROM case_records r
+    GROUP BY r.user_id, r.session_id
+"""
+
+# 每个进程对每个数据库只建表一次
+_initialized = set()
+
 
 class CaseStorage:
-    def __init__(self, db_path="history/case.db"):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS case_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT,
-                user_id TEXT,
-                role TEXT,        -- 'user' or 'assistant'
-                message TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        self.conn.commit()
+    def __init__(self, db_path=CASE_DB_PATH):
+        self.pool = get_pool(db_path)
+        if self.pool.db_path not in _initialized:
+            self.pool.executescript(SCHEMA)
+            if self.pool.query_one("SELECT 1 FROM case_sessions LIMIT 1") is None:
+                self.pool.execute(BACKFILL_SESSIONS)
+            _initialized.add(self.pool.db_path)
 
     def save_message(self, session_id, user_id, role, message):
-        self.conn.execute(
+        # 交给后台写线程，与并发到达的其他消息合并提交
+        self.pool.submit(
             "INSERT INTO case_records (session_id, user_id, role, message, created_at) VALUES (?, ?, ?, ?, ?)",
             (session_id, user_id, role, message, datetime.utcnow())
         )
-        self.conn.commit()
+
+    def save_messages(self, session_id, user_id, messages):
+        """批量写入一组消息（单个事务）"""
+        now = datetime.utcnow()
+        self.pool.flush()
+        self.pool.executemany(
+            "INSERT INTO case_records (session_id, user_id, role, message, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(session_id, user_id, msg["role"], msg["content"], now) for msg in messages]
+        )
 
     def get_messages(self, user_id, session_id=None):
-        cursor = self.conn.cursor()
+        # 读之前先等待排队中的写入落盘，保证读到自己刚写的消息
+        self.pool.flush()
         if session_id:
-            cursor.execute(
+            return self.pool.query(
                 "SELECT role, message FROM case_records WHERE user_id=? AND session_id=? ORDER BY id",
                 (user_id, session_id)
             )
+        return self.pool.query(
+            "SELECT role, message FROM case_records WHERE user_id=? ORDER BY id",
+            (user_id,)
+        )
+
+    def get_messages_after(self, user_id, session_id, after_id=0):
+        """获取某会话中 id 大于 after_id 的消息，返回 (id, role, message)"""
+        self.pool.flush()
+        return self.pool.query(
+            "SELECT id, role, message FROM case_records WHERE user_id=? AND session_id=? AND id>? ORDER BY id",
+            (user_id, session_id, after_id)
+        )
+
+    # ---- 会话目录 ----
+    def list_sessions(self, user_id, limit, offset=0):
+        """按最近活跃时间分页列出用户的会话，返回 [{"session_id", "title", "message_count", "last_active_at"}]"""
+        self.pool.flush()
+        rows = self.pool.query(
+            "SELECT session_id, title, message_count, last_active_at FROM case_sessions "
+            "WHERE user_id=? ORDER BY last_active_at DESC, session_id LIMIT ? OFFSET ?",
+            (user_id, limit, offset)
+        )
+        return [
+            {"session_id": session_id, "title": title, "message_count": count, "last_active_at": last_active_at}
+            for session_id, title, count, last_active_at in rows
+        ]
+
+    def count_sessions(self, user_id=None):
+        """会话数；不指定 user_id 时统计全部（不同用户的同名会话只计一次）"""
+        self.pool.flush()
+        if user_id is None:
+            return self.pool.query_one("SELECT COUNT(DISTINCT session_id) FROM case_sessions")[0]
+        return self.pool.query_one("SELECT COUNT(*) FROM case_sessions WHERE user_id=?", (user_id,))[0]
+
+    def session_exists(self, session_id, user_id=None):
+        self.pool.flush()
+        if user_id is None:
+            row = self.pool.query_one("SELECT 1 FROM case_sessions WHERE session_id=? LIMIT 1", (session_id,))
         else:
-            cursor.execute(
-                "SELECT role, message FROM case_records WHERE user_id=? ORDER BY id",
-                (user_id,)
+            row = self.pool.query_one(
+                "SELECT 1 FROM case_sessions WHERE user_id=? AND session_id=?", (user_id, session_id)
             )
-        return cursor.fetchall()
+        return row is not None
+
+    def get_case_state(self, user_id, session_id):
+        """返回 (病例状态字典, 已合并的最后一条消息 id)，无状态时返回 (None, 0)"""
+        row = self.pool.query_one(
+            "SELECT state, last_message_id FROM case_states WHERE user_id=? AND session_id=?",
+            (user_id, session_id)
+        )
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def save_case_state(self, user_id, session_id, state, last_message_id):
+        self.pool.execute(
+            "INSERT OR REPLACE INTO case_states (user_id, session_id, state, last_message_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, session_id, json.dumps(state, ensure_ascii=False), last_message_id, datetime.utcnow())
+        )
 
     def get_answer(self, resp):
         """提取 Agent 回复中最可能是"人话"的那条"""
@@ -70,11 +222,8 @@ class CaseStorage:
         return True
 
 
-    def generate_case(self, user_id, session_id):
-        """生成病例摘要（去重，单 session）"""
-        messages = self.get_messages(user_id, session_id)
-        # debug
-        print("test debug: ", messages)
+    def format_transcript(self, messages):
+        """将 (role, message) 列表去重并格式化为对话文本"""
         seen = set()
         lines = []
         for role, msg in messages:
@@ -88,6 +237,11 @@ class CaseStorage:
             lines.append(f"{prefix}{msg.strip()}")
         return "\n\n".join(lines)
 
+    def generate_case(self, user_id, session_id):
+        """生成病例摘要（去重，单 session）"""
+        messages = self.get_messages(user_id, session_id)
+        return self.format_transcript(messages)
+
     def generate_case_all_sessions(self, user_id):
         """汇总该用户所有 session 的问诊记录（去重）"""
         messages = self.get_messages(user_id)
@@ -120,8 +274,24 @@ class CaseStorage:
 
     def update_session_id(self, old_session_id, new_session_id):
         """批量更新 session_id"""
-        self.conn.execute(
-            "UPDATE case_records SET session_id=? WHERE session_id=?",
-            (new_session_id, old_session_id)
-        )
-        self.conn.commit()
\ No newline at end of file
+        self.pool.flush()
+        with self.pool.connection() as conn:
+            with conn:
+                conn.execute(
+                    "UPDATE case_records SET session_id=? WHERE session_id=?",
+                    (new_session_id, old_session_id)
+                )
+                conn.execute(
+                    "UPDATE case_states SET session_id=? WHERE session_id=?",
+                    (new_session_id, old_session_id)
+                )
+
+    # ---- 异步接口（供 FastAPI 等异步服务使用） ----
+    async def asave_message(self, session_id, user_id, role, message):
+        await asyncio.to_thread(self.save_message, session_id, user_id, role, message)
+
+    async def aget_messages(self, user_id, session_id=None):
+        return await asyncio.to_thread(self.get_messages, user_id, session_id)
+
+    async def agenerate_case(self, user_id, session_id):
+        return await asyncio.to_thread(self.generate_case, user_id, session_id)
\ No newline at end of file
@@ -0,0 +1,59 @@
+# utils/case_state.py
+import json
+import threading
+from collections import defaultdict
+
+from config.settings import CASE_STATE_MAX_PENDING, CASE_STATE_KEEP_RECENT
+
+CASE_STATE_FIELDS = ["基本信息", "主诉", "现病史", "既往史", "个人史", "家族史", "初步诊断", "初步治疗建议"]
+
+
+def empty_case_state():
+    return {field: "" for field in CASE_STATE_FIELDS}
+
+
+class CaseStateTracker:
+    """
+    会话的滚动病例摘要。
+    未整理的消息超过 max_pending 条时，把较早的消息交给 summarize_fn 合并进结构化病例状态，
+    只保留最近 keep_recent 条原文。生成报告时只需 病例状态 + 尚未合并的消息，
+    提示词长度不再随会话长度增长。
+    summarize_fn(state: dict, transcript: str) -> dict
+    """
+
+    def __init__(self, case_db, summarize_fn, max_pending=CASE_STATE_MAX_PENDING, keep_recent=CASE_STATE_KEEP_RECENT):
+        self.case_db = case_db
+        self.summarize_fn = summarize_fn
+        self.max_pending = max_pending
+        self.keep_recent = keep_recent
+        # 同一会话的合并串行执行
+        self._locks = defaultdict(threading.Lock)
+
+    def update(self, user_id, session_id, force=False):
+        """未整理消息过多（或 force）时合并进病例状态，返回是否发生了合并"""
+        with self._locks[(user_id, session_id)]:
+            state, last_id = self.case_db.get_case_state(user_id, session_id)
+            pending = self.case_db.get_messages_after(user_id, session_id, last_id)
+            if len(pending) <= (0 if force else self.max_pending):
+                return False
+            to_fold = pending if force else pending[:len(pending) - self.keep_recent]
+            transcript = self.case_db.format_transcript([(role, msg) for _, role, msg in to_fold])
+            if transcript:
+                new_state = self.summarize_fn(state or empty_case_state(), transcript)
+                if new_state is None:
+                    return False
+                state = {field: new_state.get(field, "") for field in CASE_STATE_FIELDS}
+            self.case_db.save_case_state(user_id, session_id, state or empty_case_state(), to_fold[-1][0])
+            return True
+
+    def build_context(self, user_id, session_id):
+        """报告生成所需的上下文：已整理的病例状态 + 尚未合并的对话"""
+        state, last_id = self.case_db.get_case_state(user_id, session_id)
+        pending = self.case_db.get_messages_after(user_id, session_id, last_id)
+        transcript = self.case_db.format_transcript([(role, msg) for _, role, msg in pending])
+        if state is None:
+            return transcript
+        parts = ["【已整理的病例信息】\n" + json.dumps(state, ensure_ascii=False, indent=2)]
+        if transcript:
+            parts.append("【最新对话】\n" + transcript)
+        return "\n\n".join(parts)
@@ -0,0 +1,110 @@
+# utils/category_index.py
+import json
+import os
+import threading
+
+import numpy as np
+
+from utils.sparse_index import normalize_name
+
+# 类别索引保存在向量库目录下（vs/categories），构建与增量更新后由向量库重建
+CATEGORY_DIR = "categories"
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+
+
+class CategoryIndex:
+    """
+    类别 -> 向量行号 的倒排表（CSR：labels / indptr / rows），由分块元数据中的 category 字段生成。
+    检索时把类别转换为行号位图，交给 FAISS 的 IDSelector 与 BM25 打分，只在该类别的分块中检索。
+    行号与 index.faiss 中的行号一致。
+    """
+
+    def __init__(self, labels, indptr, rows, ntotal):
+        self.labels = labels
+        self.indptr = indptr
+        self.rows = rows
+        self.ntotal = ntotal
+        self._keys = {normalize_name(label): i for i, label in enumerate(labels)}
+        self._bitmaps = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        postings = {}
+        ntotal = vectorstore.index.ntotal
+        for row in range(ntotal):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[row])
+            for label in doc.metadata.get("category", "").split(","):
+                label = label.strip()
+                if label:
+                    postings.setdefault(label, []).append(row)
+        labels = sorted(postings)
+        indptr = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum([len(postings[label]) for label in labels], out=indptr[1:])
+        rows = np.fromiter((r for label in labels for r in postings[label]), dtype=np.int64, count=int(indptr[-1]))
+        return cls(labels, indptr, rows, ntotal)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name, value in (("indptr", self.indptr), ("rows", self.rows)):
+            tmp_path = os.path.join(path, f"{name}.npy.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, value)
+            os.replace(tmp_path, os.path.join(path, f"{name}.npy"))
+        # meta.json 最后写入，作为索引完整的标志
+        meta = {"version": FORMAT_VERSION, "labels": self.labels, "ntotal": self.ntotal}
+        tmp_path = os.path.join(path, META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(path, META_FILE))
+
+    @classmethod
+    def load(cls, path):
+        """不存在或版本不符时返回 None（检索不做类别过滤）"""
+        meta_path = os.path.join(path, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            return None
+        indptr = np.load(os.path.join(path, "indptr.npy"))
+        rows = np.load(os.path.join(path, "rows.npy"), mmap_mode="r")
+        return cls(meta["labels"], indptr, rows, meta["ntotal"])
+
+    def resolve(self, hint):
+        """
+        科室 / 类别提示 -> 匹配的类别。先精确匹配（忽略空白与标点），
+        否则取包含该提示的类别（如“心内”匹配“心内科”），都没有时返回空列表
+        """
+        key = normalize_name(hint)
+        if not key:
+            return []
+        if key in self._keys:
+            return [self.labels[self._keys[key]]]
+        return [self.labels[i] for k, i in self._keys.items() if key in k]
+
+    def bitmap(self, hint):
+        """
+        提示对应类别（多个时取并集）的行号位图（uint8，小端位序），结果按提示缓存；
+        无匹配类别时返回 None，调用方应退回不过滤的检索
+        """
+        key = normalize_name(hint)
+        with self._lock:
+            if key in self._bitmaps:
+                return self._bitmaps[key]
+        labels = self.resolve(hint)
+        bitmap = None
+        if labels:
+            mask = np.zeros(self.ntotal, dtype=bool)
+            for label in labels:
+                i = self._keys[normalize_name(label)]
+                mask[self.rows[self.indptr[i]:self.indptr[i + 1]]] = True
+            bitmap = np.packbits(mask, bitorder="little")
+        with self._lock:
+            # 提示来自模型输出，取值不可控，缓存超出上限时清空
+            if len(self._bitmaps) >= 1024:
+                self._bitmaps.clear()
+            self._bitmaps[key] = bitmap
+        return bitmap
@@ -0,0 +1,92 @@
+# utils/context_builder.py
+import json
+from typing import List, Optional
+
+from config.settings import CONTEXT_PARENT_FIELDS, CONTEXT_FIELD_MAX_TOKENS
+from utils.token_budget import truncate_to_tokens
+
+# medical.json 字段的中文名称，输出为“字段：值”的纯文本，比 JSON 少去引号、转义和键名的 token
+FIELD_LABELS = {
+    "name": "疾病名称",
+    "desc": "简介",
+    "category": "类别",
+    "prevent": "预防",
+    "cause": "病因",
+    "symptom": "症状",
+    "yibao_status": "医保",
+    "get_prob": "患病比例",
+    "easy_get": "易感人群",
+    "get_way": "传染方式",
+    "acompany": "并发症",
+    "cure_department": "就诊科室",
+    "cure_way": "治疗方式",
+    "cure_lasttime": "治疗周期",
+    "cured_prob": "治愈率",
+    "common_drug": "常用药品",
+    "cost_money": "治疗费用",
+    "check": "检查项目",
+    "do_eat": "宜吃",
+    "not_eat": "忌吃",
+    "recommand_eat": "推荐食谱",
+    "recommand_drug": "推荐药品",
+    "drug_detail": "药品明细",
+}
+SKIP_FIELDS = {"_id"}
+
+
+def _items(value) -> List[str]:
+    """字段值展开为条目列表：分块时列表被转换为 {"0": ..., "1": ...}，按值展开"""
+    if isinstance(value, dict):
+        if all(key.isdigit() for key in value):
+            return [item for v in value.values() for item in _items(v)]
+        return [f"{key}：{'、'.join(_items(v))}" for key, v in value.items()]
+    if isinstance(value, list):
+        return [item for v in value for item in _items(v)]
+    text = str(value).strip()
+    return [text] if text else []
+
+
+def build_context(parent_text: str, sections: Optional[List[str]] = None,
+                  parent_fields=CONTEXT_PARENT_FIELDS, field_tokens=CONTEXT_FIELD_MAX_TOKENS) -> str:
+    """
+    由父文档与命中的分块构建上下文：先放 parent_fields 中的父文档字段，再放命中分块（RecursiveJsonSplitter
+    的子文档）中的字段；同一字段在多处出现时按条目合并去重。sections 为 None 时保留父文档全部字段。
+    每个字段截断到 field_tokens，父文档无法解析时原样返回。
+    """
+    try:
+        parent = json.loads(parent_text)
+    except ValueError:
+        return parent_text
+    if not isinstance(parent, dict):
+        return parent_text
+
+    fields = {}
+
+    def add(key, value):
+        if key in SKIP_FIELDS:
+            return
+        items = fields.setdefault(key, [])
+        for item in _items(value):
+            if item not in items:
+                items.append(item)
+
+    for key in parent_fields:
+        if key in parent:
+            add(key, parent[key])
+    if sections is None:
+        for key, value in parent.items():
+            add(key, value)
+    else:
+        for section in sections:
+            try:
+                section = json.loads(section)
+            except ValueError:
+                continue
+            if isinstance(section, dict):
+                for key, value in section.items():
+                    add(key, value)
+
+    return "\n".join(
+        f"{FIELD_LABELS.get(key, key)}：{truncate_to_tokens('、'.join(items), field_tokens)}"
+        for key, items in fields.items() if items
+    )
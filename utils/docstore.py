@@ -0,0 +1,283 @@
+# utils/docstore.py
+import json
+import mmap
+import os
+import threading
+from array import array
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.stores import BaseStore
+
+MAGIC = b"MEDDOCS"
+FORMAT_VERSION = 1
+HEADER = MAGIC + bytes([FORMAT_VERSION])
+PACK_FILE = "docs.pack"
+INDEX_FILE = "docs.idx"
+INDEX_LOG_FILE = "docs.idx.log"
+
+
+class PackedDocStore(BaseStore[str, bytes]):
+    """
+    父文档存储：所有文档以 JSON（UTF-8）追加写入同一个打包文件 docs.pack，
+    docs.idx 记录 doc_id -> (偏移, 长度)。读取时对打包文件做内存映射，
+    按偏移直接切片，查找为 O(1)，无需逐个打开小文件，也无需解析 Python 字面量。
+    mset / mdelete 只把变更追加到 docs.idx.log（每行一个 JSON 数组），不再每次重写整个 docs.idx，
+    写入开销与已有文档数无关；snapshot()、clear()、compact() 时把日志合并进 docs.idx。
+    日志首行记录所属的索引代数（generation），与 docs.idx 不一致的日志视为已合并，读取时忽略。
+    """
+
+    def __init__(self, root_path):
+        self.root_path = str(root_path)
+        self.pack_path = os.path.join(self.root_path, PACK_FILE)
+        self.index_path = os.path.join(self.root_path, INDEX_FILE)
+        self.log_path = os.path.join(self.root_path, INDEX_LOG_FILE)
+        self.lock = threading.Lock()
+        self._offsets = {}
+        self._generation = 0
+        self._mmap = None
+        self._index_mtime = None
+        self._log_pos = 0
+        self._log_ino = None
+        os.makedirs(self.root_path, exist_ok=True)
+        if not os.path.exists(self.pack_path):
+            with open(self.pack_path, "wb") as f:
+                f.write(HEADER)
+        self._reload()
+
+    def _reload(self):
+        """索引文件或追加日志被其他进程（如构建脚本）更新后重新加载；日志只读取新追加的部分"""
+        mtime = os.stat(self.index_path).st_mtime_ns if os.path.exists(self.index_path) else None
+        remap = self._mmap is None
+        if mtime != self._index_mtime or remap:
+            if mtime is None:
+                self._offsets, self._generation = {}, 0
+            else:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+                if index.get("version") != FORMAT_VERSION:
+                    raise ValueError(f"不支持的父文档存储版本: {index.get('version')}")
+                self._offsets, self._generation = index["offsets"], index.get("generation", 0)
+            self._index_mtime = mtime
+            self._log_pos = 0
+            self._log_ino = None
+            # 索引被重写时打包文件可能已被整体替换（clear / compact）
+            remap = True
+        self._replay_log()
+        if remap or len(self._mmap) != os.path.getsize(self.pack_path):
+            with open(self.pack_path, "rb") as f:
+                if f.read(len(HEADER)) != HEADER:
+                    raise ValueError(f"{self.pack_path} 不是有效的父文档存储文件")
+                if self._mmap is not None:
+                    self._mmap.close()
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _replay_log(self):
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino == self._log_ino and stat.st_size == self._log_pos:
+            # 没有新追加的内容（读取路径上的常见情况），不打开日志文件
+            return
+        try:
+            f = open(self.log_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            ino = os.fstat(f.fileno()).st_ino
+            if ino != self._log_ino:
+                if self._log_pos:
+                    # 日志已被替换（其他进程把日志合并进了索引），下次调用时重新加载索引
+                    self._index_mtime = None
+                    return
+                self._log_ino = ino
+            if self._log_pos == 0:
+                header = f.readline()
+                if not header.endswith(b"\n") or json.loads(header).get("generation") != self._generation:
+                    # 属于旧代数的日志（已合并进 docs.idx）或尚未写完的日志头
+                    return
+                self._log_pos = f.tell()
+            f.seek(self._log_pos)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # 写入中的最后一行，下次再读
+                    break
+                self._log_pos += len(line)
+                entry = json.loads(line)
+                if len(entry) == 1:
+                    self._offsets.pop(entry[0], None)
+                else:
+                    self._offsets[entry[0]] = entry[1:]
+
+    def _append_log(self, entries):
+        if not os.path.exists(self.log_path):
+            self._reset_log()
+        with open(self.log_path, "ab") as f:
+            f.write(b"".join(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n" for entry in entries))
+
+    def _reset_log(self):
+        tmp_path = self.log_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps({"generation": self._generation}).encode("utf-8") + b"\n")
+        os.replace(tmp_path, self.log_path)
+
+    def _write_index(self):
+        """写入完整索引并开始新一代的空日志；先替换索引再替换日志，读取方不会把旧日志叠加到新索引上"""
+        self._generation += 1
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, "generation": self._generation, "offsets": self._offsets}, f)
+        os.replace(tmp_path, self.index_path)
+        self._reset_log()
+        self._index_mtime = None
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        with self.lock:
+            self._reload()
+            results = []
+            for key in keys:
+                location = self._offsets.get(key)
+                if location is None:
+                    results.append(None)
+                else:
+                    offset, length = location
+                    results.append(self._mmap[offset:offset + length])
+            return results
+
+    def mget_text(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """直接返回 JSON 文本，可原样放入提示词"""
+        return [None if v is None else v.decode("utf-8") for v in self.mget(keys)]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        if not key_value_pairs:
+            return
+        with self.lock:
+            self._reload()
+            entries = []
+            # 先写文档再追加日志，读取方看到日志时文档已在打包文件中
+            with open(self.pack_path, "ab") as f:
+                offset = f.tell()
+                for key, value in key_value_pairs:
+                    f.write(value)
+                    entries.append([key, offset, len(value)])
+                    offset += len(value)
+            self._append_log(entries)
+            self._reload()
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        """只从索引中删除，打包文件中的空间由 compact() 回收"""
+        with self.lock:
+            self._reload()
+            removed = [key for key in keys if key in self._offsets]
+            if removed:
+                self._append_log([[key] for key in removed])
+                self._reload()
+
+    def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        with self.lock:
+            self._reload()
+            keys = list(self._offsets)
+        for key in keys:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    def snapshot(self):
+        """把追加日志合并进 docs.idx（批量写入结束后调用），之后加载时无需重放日志"""
+        with self.lock:
+            self._reload()
+            self._write_index()
+            self._reload()
+
+    def clear(self):
+        """清空存储（全量重建前调用）；写入新的空打包文件后原子替换，其他进程已映射的旧文件不受影响"""
+        with self.lock:
+            # 先替换为空索引，其他进程不会再按旧偏移读取新的打包文件
+            self._offsets = {}
+            self._write_index()
+            tmp_path = self.pack_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER)
+            os.replace(tmp_path, self.pack_path)
+            self._reload()
+
+    def compact(self):
+        """重写打包文件，去掉已删除或被覆盖的文档占用的空间"""
+        with self.lock:
+            self._reload()
+            tmp_path = self.pack_path + ".tmp"
+            new_offsets = {}
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER)
+                for key, (offset, length) in self._offsets.items():
+                    new_offsets[key] = [f.tell(), length]
+                    f.write(self._mmap[offset:offset + length])
+            os.replace(tmp_path, self.pack_path)
+            self._offsets = new_offsets
+            self._write_index()
+            self._reload()
+
+
+def encode_doc(entry) -> bytes:
+    """父文档统一序列化为 UTF-8 JSON"""
+    return json.dumps(entry, ensure_ascii=False).encode("utf-8")
+
+
+class RowPack:
+    """
+    按行号读取的只读打包文件：<name>.pack 依次保存每一行的字节串，<name>.offsets.npy 保存各行起始偏移（n+1 个）。
+    两个文件均以内存映射方式打开，加载时不做任何反序列化，多个进程读取同一文件时共享页缓存。
+    各行按字节序排好序保存时，可用 find() 二分查找某一行。
+    """
+
+    def __init__(self, path, name, mmap_mode="r"):
+        self.offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode=mmap_mode)
+        with open(os.path.join(path, f"{name}.pack"), "rb") as f:
+            if f.read(len(HEADER)) != HEADER:
+                raise ValueError(f"{f.name} 不是有效的打包文件")
+            f.seek(0)
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if mmap_mode else f.read()
+
+    @staticmethod
+    def exists(path, name):
+        return os.path.exists(os.path.join(path, f"{name}.offsets.npy"))
+
+    @staticmethod
+    def write(path, name, rows):
+        """rows: 可迭代的字节串；先写 .pack 再写 .offsets.npy，均为写临时文件后原子替换"""
+        os.makedirs(path, exist_ok=True)
+        pack_path = os.path.join(path, f"{name}.pack")
+        offsets = array("q", [len(HEADER)])
+        with open(pack_path + ".tmp", "wb") as f:
+            f.write(HEADER)
+            for value in rows:
+                f.write(value)
+                offsets.append(offsets[-1] + len(value))
+        os.replace(pack_path + ".tmp", pack_path)
+        offsets_path = os.path.join(path, f"{name}.offsets.npy")
+        with open(offsets_path + ".tmp", "wb") as f:
+            np.save(f, np.frombuffer(offsets, dtype=np.int64))
+        os.replace(offsets_path + ".tmp", offsets_path)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row) -> bytes:
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return self._data[int(self.offsets[row]):int(self.offsets[row + 1])]
+
+    def text(self, row) -> str:
+        return self[row].decode("utf-8")
+
+    def find(self, key: str) -> Optional[int]:
+        """在按 UTF-8 字节序排序的行中二分查找 key，返回行号，不存在返回 None"""
+        target = key.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self[lo] == target else None
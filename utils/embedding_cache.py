@@ -0,0 +1,173 @@
+# utils/embedding_cache.py
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config.settings import EMBED_CACHE_SIZE, EMBED_CACHE_TTL, EMBED_CACHE_PATH, EMBED_CACHE_DISK_MAX
+from utils.storage import connect
+from utils.tracing import tracer
+
+
+def normalize_text(text: str) -> str:
+    """全角转半角、去除首尾空白并合并连续空白，使等价的提问命中同一缓存"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    向量化模型的缓存包装：进程内 LRU 层 + 可选的 SQLite 持久层。
+    缓存键为 模型名 + 规范化后的文本，支持容量与 TTL 淘汰，并统计命中情况。
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        max_size: int = EMBED_CACHE_SIZE,
+        ttl=EMBED_CACHE_TTL,
+        db_path=EMBED_CACHE_PATH,
+        disk_max: int = EMBED_CACHE_DISK_MAX,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_max = disk_max
+        self.lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> (vector, expires_at)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._writes = 0
+
+        self.conn = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self.conn = connect(db_path)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    embedding BLOB,
+                    expires_at REAL,
+                    created_at REAL
+                )
+            """)
+            self.conn.commit()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _expires_at(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    def _get(self, key):
+        now = time.time()
+        with self.lock:
+            item = self._memory.get(key)
+            if item is not None:
+                vector, expires_at = item
+                if expires_at is None or expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._memory[key]
+            if self.conn is None:
+                return None
+            row = self.conn.execute(
+                "SELECT embedding, expires_at FROM embedding_cache WHERE key=?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] <= now:
+                self.conn.execute("DELETE FROM embedding_cache WHERE key=?", (key,))
+                self.conn.commit()
+                return None
+            vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+            self._put_memory(key, vector, row[1])
+            self.disk_hits += 1
+            return vector
+
+    def _put_memory(self, key, vector, expires_at):
+        self._memory[key] = (vector, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _put_many(self, items):
+        expires_at = self._expires_at()
+        with self.lock:
+            for key, vector in items:
+                self._put_memory(key, vector, expires_at)
+            if self.conn is None:
+                return
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, model, embedding, expires_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (key, self.model_name, np.asarray(v, dtype=np.float32).tobytes(), expires_at, time.time())
+                    for key, v in items
+                ],
+            )
+            self._writes += len(items)
+            # 每写入一定数量后清理过期条目，并淘汰超出容量的最旧条目
+            if self._writes >= 1000:
+                self._writes = 0
+                self.conn.execute("DELETE FROM embedding_cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+                self.conn.execute(
+                    "DELETE FROM embedding_cache WHERE key IN ("
+                    "SELECT key FROM embedding_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.disk_max,),
+                )
+            self.conn.commit()
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is not None:
+            return vector
+        with self.lock:
+            self.misses += 1
+        with tracer.span("embedding.query"):
+            vector = self.embeddings.embed_query(text)
+        self._put_many([(key, vector)])
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """只对未命中的文本调用一次底层 embed_documents"""
+        keys = [self._key(t) for t in texts]
+        vectors = [self._get(k) for k in keys]
+        missing = {}
+        for i, v in enumerate(vectors):
+            if v is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            with self.lock:
+                self.misses += len(missing)
+            miss_keys = list(missing)
+            with tracer.span("embedding.documents", batch=len(miss_keys)):
+                new_vectors = self.embeddings.embed_documents([texts[missing[k][0]] for k in miss_keys])
+            self._put_many(list(zip(miss_keys, new_vectors)))
+            for key, vector in zip(miss_keys, new_vectors):
+                for i in missing[key]:
+                    vectors[i] = vector
+        return vectors
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+                "size": len(self._memory),
+            }
@@ -0,0 +1,270 @@
+# utils/faiss_index.py
+import json
+import logging
+import os
+from collections.abc import Mapping
+
+import faiss
+import numpy as np
+
+from config.settings import (
+    INDEX_TYPE, INDEX_TRAIN_SAMPLE, IVF_NLIST, IVF_NPROBE, PQ_M, PQ_NBITS,
+    HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH,
+)
+from utils.docstore import RowPack
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# 分块（page_content + metadata）按向量行号保存为 RowPack，供检索进程内存映射读取，代替 index.pkl
+CHUNK_PACK = "chunks"
+CHUNK_META = "chunks.json"
+
+
+def requires_training(index_type=INDEX_TYPE):
+    return index_type in ("ivf_flat", "ivf_pq")
+
+
+def create_index(dim, index_type=INDEX_TYPE, num_vectors=None):
+    """
+    按配置创建 FAISS 索引
+    num_vectors: 训练样本数，IVF 的聚类数会按样本量缩小，保证每个聚类至少约 39 个样本
+    """
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist, nbits = IVF_NLIST, PQ_NBITS
+        if num_vectors:
+            nlist = max(1, min(nlist, num_vectors // 39))
+            # PQ 码本训练同样需要至少 2^nbits 个样本
+            nbits = max(1, min(nbits, int(np.log2(num_vectors))))
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, PQ_M, nbits)
+        index.nprobe = IVF_NPROBE
+        return index
+    raise ValueError(f"未知的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+
+
+def train_index(index, vectors, sample_size=INDEX_TRAIN_SAMPLE, seed=0):
+    """在随机抽样的向量上训练索引（无需训练的索引直接返回）"""
+    if index.is_trained:
+        return index
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) > sample_size:
+        rng = np.random.default_rng(seed)
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    index.train(vectors)
+    return index
+
+
+def apply_search_params(index, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
+    """设置检索参数：IVF 的 nprobe、HNSW 的 efSearch"""
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def supports_remove(index):
+    """HNSW 不支持 remove_ids，删除向量时需要重建"""
+    return not hasattr(index, "hnsw")
+
+
+def remove_vectors(vectorstore, ids):
+    """
+    从 langchain FAISS 向量库中删除指定 docstore id 的向量。
+    HNSW 无法原地删除，取出保留的向量后重新建图（不需要重新向量化）。
+    """
+    ids = set(ids)
+    if not ids:
+        return
+    if supports_remove(vectorstore.index):
+        vectorstore.delete(list(ids))
+        return
+
+    old_index = vectorstore.index
+    old_mapping = vectorstore.index_to_docstore_id
+    keep = [i for i in range(old_index.ntotal) if old_mapping[i] not in ids]
+    vectors = old_index.reconstruct_n(0, old_index.ntotal)[keep] if keep else None
+    new_index = create_index(old_index.d, "hnsw")
+    if vectors is not None:
+        new_index.add(vectors)
+    vectorstore.index = new_index
+    vectorstore.index_to_docstore_id = {new_i: old_mapping[old_i] for new_i, old_i in enumerate(keep)}
+    vectorstore.docstore.delete(list(ids))
+
+
+def kb_version(vs_path):
+    """知识库版本：由索引文件的大小和修改时间决定，重建或增量更新后版本随之变化"""
+    path = os.path.join(vs_path, "index.faiss")
+    if not os.path.exists(path):
+        return "none"
+    stat = os.stat(path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def read_index_mmap(path):
+    """
+    以内存映射方式只读加载索引：向量数据留在页缓存中，多个进程加载同一文件时共享物理内存。
+    目前只有 Flat 与 HNSW 支持；IVF 类索引（ivf_flat / ivf_pq）的倒排表无法映射，
+    会退回普通加载，每个进程各持有一份索引。
+    """
+    flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(path, flags)
+    except RuntimeError as e:
+        logger.warning(f"{path} 不支持内存映射加载，改为普通加载（本进程独占一份索引内存）: {str(e).splitlines()[0]}")
+        return faiss.read_index(path)
+
+
+class _RowIds(Mapping):
+    """向量行号 -> 分块存储的键；PackedChunkStore 直接以行号为键"""
+
+    def __init__(self, ntotal):
+        self.ntotal = ntotal
+
+    def __getitem__(self, row):
+        if not 0 <= row < self.ntotal:
+            raise KeyError(row)
+        return int(row)
+
+    def __iter__(self):
+        return iter(range(self.ntotal))
+
+    def __len__(self):
+        return self.ntotal
+
+
+class PackedChunkStore:
+    """
+    按向量行号读取分块的只读 docstore（供 langchain FAISS 使用，键为行号）。
+    分块以 JSON 保存在内存映射的 RowPack 中，加载时不反序列化整个 docstore。
+    """
+
+    def __init__(self, pack):
+        self.pack = pack
+
+    def search(self, row):
+        from langchain_core.documents import Document
+
+        try:
+            record = json.loads(self.pack[row])
+        except (IndexError, TypeError):
+            return f"ID {row} not found."
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def add(self, texts):
+        raise NotImplementedError("PackedChunkStore 只读")
+
+    def delete(self, ids):
+        raise NotImplementedError("PackedChunkStore 只读")
+
+
+def save_chunk_pack(vectorstore, vs_path):
+    """按向量行号保存分块文本与元数据（在 save_local 之后调用，与 index.faiss 的版本对应）"""
+    docstore, mapping = vectorstore.docstore, vectorstore.index_to_docstore_id
+
+    def rows():
+        for row in range(vectorstore.index.ntotal):
+            doc = docstore.search(mapping[row])
+            record = {"id": mapping[row], "page_content": doc.page_content, "metadata": doc.metadata}
+            yield json.dumps(record, ensure_ascii=False).encode("utf-8")
+
+    RowPack.write(vs_path, CHUNK_PACK, rows())
+    # 最后写入元数据，记录对应的索引版本，索引之后又被更新时不再使用这份分块
+    meta_path = os.path.join(vs_path, CHUNK_META)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"rows": vectorstore.index.ntotal, "kb_version": kb_version(vs_path)}, f)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def load_chunk_store(vs_path, ntotal, mmap=True):
+    """加载与当前 index.faiss 对应的分块存储，不存在或已过期时返回 None"""
+    meta_path = os.path.join(vs_path, CHUNK_META)
+    if not os.path.exists(meta_path) or not RowPack.exists(vs_path, CHUNK_PACK):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("rows") != ntotal or meta.get("kb_version") != kb_version(vs_path):
+        return None
+    return PackedChunkStore(RowPack(vs_path, CHUNK_PACK, "r" if mmap else None))
+
+
+def load_vectorstore(vs_path, embeddings, mmap=False, index_name="index"):
+    """
+    加载只读的 langchain FAISS 向量库（检索服务使用），可选以内存映射方式读取索引。
+    分块从内存映射的 chunks.pack 按行号读取；没有或已过期时退回加载 index.pkl（整个 docstore 反序列化到本进程）。
+    返回的向量库不能再 add / delete，构建与增量更新仍使用 FAISS.load_local。
+    """
+    from langchain_community.vectorstores import FAISS
+
+    index_path = os.path.join(vs_path, f"{index_name}.faiss")
+    index = read_index_mmap(index_path) if mmap else faiss.read_index(index_path)
+    docstore = load_chunk_store(vs_path, index.ntotal, mmap)
+    if docstore is not None:
+        index_to_docstore_id = _RowIds(index.ntotal)
+    else:
+        import pickle
+
+        logger.warning(f"{vs_path} 缺少与索引对应的分块文件，改为加载 {index_name}.pkl；"
+                       f"可运行 python build_index.py --sparse-only 生成")
+        with open(os.path.join(vs_path, f"{index_name}.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    vectorstore = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    apply_search_params(vectorstore.index)
+    return vectorstore
+
+
+def search_params(index, selector):
+    """带 ID 过滤器的检索参数；显式带上索引当前的 nprobe / efSearch，否则会被参数对象的默认值覆盖"""
+    try:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nprobe)
+    except RuntimeError:
+        pass
+    if hasattr(index, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def search_by_vectors(vectorstore, embeddings, k, bitmap=None):
+    """
+    多个查询向量一次 index.search，返回每个查询的 Document 列表（与 similarity_search_by_vector 相同）。
+    bitmap: 可选的行号位图（小端位序），只在选中的向量中检索；Flat / IVF / HNSW 在检索过程中跳过未选中的向量，
+    不是先检索再过滤。
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(vectors)
+    if bitmap is None:
+        _, rows = vectorstore.index.search(vectors, k)
+    else:
+        # 选择器只保存位图的指针，调用方需在检索期间持有 bitmap
+        selector = faiss.IDSelectorBitmap(len(bitmap) * 8, faiss.swig_ptr(bitmap))
+        _, rows = vectorstore.index.search(vectors, k, params=search_params(vectorstore.index, selector))
+    results = []
+    for query_rows in rows:
+        docs = []
+        for row in query_rows:
+            if row < 0:
+                continue
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(row)])
+            if not isinstance(doc, str):
+                docs.append(doc)
+        results.append(docs)
+    return results
+
+
+def filtered_search(vectorstore, embedding, k, bitmap):
+    """只在 bitmap 选中的向量中检索单个查询向量"""
+    return search_by_vectors(vectorstore, [embedding], k, bitmap)[0]
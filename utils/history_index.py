@@ -0,0 +1,171 @@
+# utils/history_index.py
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from utils.storage import connect
+
+
+class HistoryIndex:
+    """
+    按用户分区的历史问答向量索引。
+    每条问答在写入时向量化一次并持久化到 SQLite，查询时只需对当前问题做一次向量化，
+    再与该用户的向量矩阵做一次 top-k 内积检索。
+    """
+
+    def __init__(self, db_path, embedding_model, backfill_source=None, document_model=None):
+        """
+        db_path: 索引数据库路径
+        embedding_model: 提供 embed_query / embed_documents 的向量化模型
+        backfill_source: 可选，user_id -> [{"query", "response"}]，用户首次写入或检索时导入已有历史
+        document_model: 可选，写入问答时使用的向量化模型（默认同 embedding_model）；
+            问答全文不会再被查询，传入未经向量缓存包装的模型，避免挤占缓存中有用的问题向量
+        """
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.embedding_model = embedding_model
+        self.document_model = document_model or embedding_model
+        self.backfill_source = backfill_source
+        self.lock = threading.Lock()
+        # 同一用户的历史导入只执行一次（并发的首次写入 / 检索等待导入完成）
+        self._backfill_lock = threading.Lock()
+        self._backfilled = set()
+        self.conn = connect(db_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS history_vectors (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                query TEXT,
+                response TEXT,
+                embedding BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_history_vectors_user ON history_vectors (user_id, id)"
+        )
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS history_index_meta (
+                user_id TEXT PRIMARY KEY,
+                backfilled INTEGER DEFAULT 0
+            )
+        """)
+        self.conn.commit()
+        # user_id -> {"entries": [...], "matrix": np.ndarray(归一化后的向量), "max_id": 已加载的最大行号}
+        self._cache = {}
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _insert(self, user_id, pairs, embeddings):
+        now = datetime.utcnow()
+        rows = [
+            (user_id, p["query"], p["response"], self._normalize(e).tobytes(), now)
+            for p, e in zip(pairs, embeddings)
+        ]
+        self.conn.executemany(
+            "INSERT INTO history_vectors (user_id, query, response, embedding, created_at) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.conn.commit()
+
+    def _existing_pairs(self, user_id):
+        rows = self.conn.execute("SELECT query, response FROM history_vectors WHERE user_id=?", (user_id,)).fetchall()
+        return set(rows)
+
+    def add(self, user_id, query, response):
+        """写入一轮问答：只在写入时向量化一次"""
+        if not query or not response:
+            return
+        # 先导入已有历史，保证历史问答按时间顺序写入；导入的历史可能已包含本轮问答
+        if self._ensure_backfilled(user_id):
+            with self.lock:
+                if (query, response) in self._existing_pairs(user_id):
+                    return
+        embedding = self.document_model.embed_query(query + " " + response)
+        with self.lock:
+            self._insert(user_id, [{"query": query, "response": response}], [embedding])
+
+    def add_many(self, user_id, pairs):
+        """批量写入问答对，使用一次 embed_documents 调用"""
+        pairs = [p for p in pairs if p.get("query") and p.get("response")]
+        if not pairs:
+            return
+        embeddings = self.document_model.embed_documents([p["query"] + " " + p["response"] for p in pairs])
+        with self.lock:
+            self._insert(user_id, pairs, embeddings)
+
+    def _ensure_backfilled(self, user_id):
+        """
+        首次写入或检索某用户时导入其已有历史，与已写入的问答按 (query, response) 去重；
+        返回本次是否执行了导入
+        """
+        if self.backfill_source is None or user_id in self._backfilled:
+            return False
+        with self._backfill_lock:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT backfilled FROM history_index_meta WHERE user_id=?", (user_id,)
+                ).fetchone()
+            done = bool(row and row[0])
+            if not done:
+                self._backfill(user_id)
+            self._backfilled.add(user_id)
+        return not done
+
+    def _backfill(self, user_id):
+        pairs = self.backfill_source(user_id)
+        with self.lock:
+            existing = self._existing_pairs(user_id)
+        self.add_many(user_id, [p for p in pairs if (p.get("query"), p.get("response")) not in existing])
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO history_index_meta (user_id, backfilled) VALUES (?, 1)", (user_id,)
+            )
+            self.conn.commit()
+
+    def _load(self, user_id):
+        self._ensure_backfilled(user_id)
+        with self.lock:
+            cached = self._cache.get(user_id)
+            max_id = cached["max_id"] if cached is not None else 0
+            # 其他进程（或本进程）写入的新行按行号增量追加，缓存不会过期
+            rows = self.conn.execute(
+                "SELECT id, query, response, embedding FROM history_vectors WHERE user_id=? AND id>? ORDER BY id",
+                (user_id, max_id),
+            ).fetchall()
+            if cached is not None and not rows:
+                return cached
+            entries = [{"query": q, "response": r} for _, q, r, _ in rows]
+            matrix = (
+                np.vstack([np.frombuffer(e, dtype=np.float32) for _, _, _, e in rows])
+                if rows else np.empty((0, 0), dtype=np.float32)
+            )
+            if cached is not None and len(cached["matrix"]):
+                entries = cached["entries"] + entries
+                matrix = np.vstack([cached["matrix"], matrix])
+            cached = {"entries": entries, "matrix": matrix, "max_id": rows[-1][0] if rows else max_id}
+            self._cache[user_id] = cached
+        return cached
+
+    def search(self, user_id, query, top_n=2, exclude_recent=0):
+        """
+        检索与 query 最相关的历史问答
+        返回 [(entry, score)]，按相似度降序
+        """
+        cached = self._load(user_id)
+        count = len(cached["entries"]) - exclude_recent
+        if count <= 0:
+            return []
+        matrix = cached["matrix"][:count]
+        query_embedding = self._normalize(self.embedding_model.embed_query(query))
+        scores = matrix @ query_embedding
+        top_n = min(top_n, count)
+        top_indices = np.argpartition(-scores, top_n - 1)[:top_n]
+        top_indices = top_indices[np.argsort(-scores[top_indices])]
+        return [(cached["entries"][i], float(scores[i])) for i in top_indices]
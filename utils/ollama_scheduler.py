@@ -0,0 +1,355 @@
+# utils/ollama_scheduler.py
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from config.settings import (
+    SCHEDULER_ENABLED, SCHEDULER_DB_PATH, SCHEDULER_CLASSES, SCHEDULER_LLM_SLOTS,
+    SCHEDULER_POLL_INTERVAL, SCHEDULER_POLL_MAX_INTERVAL, SCHEDULER_LEASE,
+)
+from utils.storage import connect, pid_alive
+from utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+OUTCOMES = ("granted", "rejected", "timed_out")
+
+
+class SchedulerBusy(Exception):
+    """排队过深（立即拒绝）或等待超时，调用方应提示稍后重试或降级处理"""
+
+    def __init__(self, klass, reason, retry_after=5):
+        super().__init__(f"Ollama 繁忙（{klass}: {reason}），请稍后重试")
+        self.klass = klass
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class OllamaScheduler:
+    """
+    跨进程的 Ollama 请求调度器，队列保存在 SQLite（WAL）中，同一台机器上的所有进程共用。
+    每个请求先登记一张排队票据，名额按 优先级 -> 登记时间 的顺序分配：
+    各类别不超过自己的 limit，占用对话模型的类别（interactive / reports）合计不超过 llm_slots；
+    高优先级的请求排在前面，报告生成再多也不会占满交互问答的名额。
+    登记与释放时（写事务内）为所有可运行的票据分配名额，名额一释放就交给下一个排队者；
+    排队者轮询时只读查询自己的票据，只有发现空闲名额或待回收的票据时才获取写锁重新分配，
+    轮询间隔从 poll_interval 起按指数退避到 max_poll_interval。
+    已退出进程遗留的票据与超过 lease 的名额会被回收。
+    """
+
+    def __init__(self, db_path=SCHEDULER_DB_PATH, classes=None, llm_slots=SCHEDULER_LLM_SLOTS,
+                 poll_interval=SCHEDULER_POLL_INTERVAL, max_poll_interval=SCHEDULER_POLL_MAX_INTERVAL,
+                 lease=SCHEDULER_LEASE, enabled=SCHEDULER_ENABLED):
+        self.db_path = db_path
+        self.classes = classes or SCHEDULER_CLASSES
+        self.llm_slots = llm_slots
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.lease = lease
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._last_reap = 0.0
+        self._last_probe = 0.0
+
+    # ---- 数据库 ----
+    def _connection(self):
+        if self._conn is None or self.pid != os.getpid():
+            # fork 出的子进程不能沿用父进程的连接
+            self.pid = os.getpid()
+            conn = connect(self.db_path)
+            # 自动提交模式，事务由 BEGIN IMMEDIATE 显式开启
+            conn.isolation_level = None
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS scheduler_tickets (
+                    id TEXT PRIMARY KEY,
+                    klass TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    started_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS scheduler_counters (
+                    klass TEXT NOT NULL,
+                    outcome TEXT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (klass, outcome)
+                );
+            """)
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _read(self, sql, params=()):
+        # 自动提交模式下单条 SELECT 是只读事务，WAL 下不阻塞写入，也不与其他进程争抢写锁
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+
+    @staticmethod
+    def _count(conn, klass, outcome):
+        conn.execute(
+            "INSERT INTO scheduler_counters (klass, outcome, count) VALUES (?, ?, 1) "
+            "ON CONFLICT(klass, outcome) DO UPDATE SET count = count + 1",
+            (klass, outcome),
+        )
+
+    def _reap(self, conn, now):
+        # 每个进程每秒最多回收一次：已退出进程的票据、超过 lease 仍未释放的名额
+        if now - self._last_reap < 1.0:
+            return
+        self._last_reap = now
+        pids = [pid for (pid,) in conn.execute("SELECT DISTINCT pid FROM scheduler_tickets")]
+        dead = [pid for pid in pids if pid != self.pid and not pid_alive(pid)]
+        if dead:
+            conn.executemany("DELETE FROM scheduler_tickets WHERE pid = ?", [(pid,) for pid in dead])
+        expired = conn.execute(
+            "DELETE FROM scheduler_tickets WHERE state = 'running' AND started_at < ?", (now - self.lease,)
+        ).rowcount
+        if dead or expired:
+            logger.warning(f"回收调度名额：已退出进程 {dead}，超时名额 {expired} 个")
+
+    def _dispatch(self, conn, now):
+        """按优先级与登记顺序为可运行的排队票据分配名额"""
+        self._reap(conn, now)
+        rows = conn.execute(
+            "SELECT id, klass, state FROM scheduler_tickets ORDER BY priority, enqueued_at, id"
+        ).fetchall()
+        running = {klass: 0 for klass in self.classes}
+        for _, klass, state in rows:
+            if state == "running" and klass in running:
+                running[klass] += 1
+        llm_free = self.llm_slots - sum(n for klass, n in running.items() if self.classes[klass]["llm"])
+        granted = []
+        for ticket_id, klass, state in rows:
+            config = self.classes.get(klass)
+            if state != "waiting" or config is None or running[klass] >= config["limit"]:
+                continue
+            if config["llm"]:
+                if llm_free <= 0:
+                    continue
+                llm_free -= 1
+            running[klass] += 1
+            granted.append(ticket_id)
+        if granted:
+            conn.executemany(
+                "UPDATE scheduler_tickets SET state = 'running', started_at = ? WHERE id = ?",
+                [(now, ticket_id) for ticket_id in granted],
+            )
+
+    def _may_dispatch(self, now):
+        """
+        只读检查是否需要获取写锁重新分配：有排队的类别存在空闲名额（通常是持有进程退出后留下的），
+        或有超过 lease 的名额、已退出进程的票据待回收。都没有时名额会在释放时分配，轮询者只需等待
+        """
+        running = {klass: 0 for klass in self.classes}
+        waiting = set()
+        oldest_start = None
+        for klass, state, count, started_at in self._read(
+            "SELECT klass, state, COUNT(*), MIN(started_at) FROM scheduler_tickets GROUP BY klass, state"
+        ):
+            if klass not in running:
+                continue
+            if state == "running":
+                running[klass] = count
+                oldest_start = started_at if oldest_start is None else min(oldest_start, started_at)
+            elif state == "waiting":
+                waiting.add(klass)
+        llm_free = self.llm_slots - sum(n for klass, n in running.items() if self.classes[klass]["llm"])
+        for klass in waiting:
+            config = self.classes[klass]
+            if running[klass] < config["limit"] and (not config["llm"] or llm_free > 0):
+                return True
+        if oldest_start is not None and oldest_start < now - self.lease:
+            return True
+        # 已退出进程的票据：每个进程每秒最多检查一次
+        if now - self._last_probe < 1.0:
+            return False
+        self._last_probe = now
+        pids = self._read("SELECT DISTINCT pid FROM scheduler_tickets")
+        return any(pid != self.pid and not pid_alive(pid) for (pid,) in pids)
+
+    # ---- 票据 ----
+    def _enqueue(self, klass):
+        config = self.classes[klass]
+        ticket_id = uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as conn:
+            self._dispatch(conn, now)
+            (waiting,) = conn.execute(
+                "SELECT COUNT(*) FROM scheduler_tickets WHERE klass = ? AND state = 'waiting'", (klass,)
+            ).fetchone()
+            rejected = waiting >= config["max_queue"]
+            if rejected:
+                self._count(conn, klass, "rejected")
+            else:
+                conn.execute(
+                    "INSERT INTO scheduler_tickets (id, klass, priority, state, pid, enqueued_at) "
+                    "VALUES (?, ?, ?, 'waiting', ?, ?)",
+                    (ticket_id, klass, config["priority"], self.pid, now),
+                )
+                self._dispatch(conn, now)
+        if rejected:
+            # 排队过深时不再登记，立即拒绝，避免请求在 Ollama 前无限堆积
+            raise SchedulerBusy(klass, f"排队数 {waiting} 已达上限")
+        return ticket_id
+
+    def _poll(self, ticket_id):
+        """票据已获得名额时返回 True；票据被回收时抛出 SchedulerBusy"""
+        now = time.time()
+        rows = self._read("SELECT state FROM scheduler_tickets WHERE id = ?", (ticket_id,))
+        if rows and rows[0][0] == "waiting" and self._may_dispatch(now):
+            with self._transaction() as conn:
+                self._dispatch(conn, now)
+                rows = conn.execute("SELECT state FROM scheduler_tickets WHERE id = ?", (ticket_id,)).fetchall()
+        if not rows:
+            raise SchedulerBusy("unknown", "排队票据已被回收")
+        return rows[0][0] == "running"
+
+    def _release(self, ticket_id, klass, outcome=None):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM scheduler_tickets WHERE id = ?", (ticket_id,))
+            if outcome:
+                self._count(conn, klass, outcome)
+            self._dispatch(conn, time.time())
+
+    def _timeout(self, klass, timeout):
+        return self.classes[klass]["timeout"] if timeout is None else timeout
+
+    @contextmanager
+    def slot(self, klass, timeout=None):
+        """
+        在名额内执行一次 Ollama 请求（流式请求需在 with 块内消费完）；
+        排队过深立即抛出 SchedulerBusy，排队超过 timeout 秒同样抛出
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        deadline = start + self._timeout(klass, timeout)
+        ticket_id = self._enqueue(klass)
+        try:
+            delay = self.poll_interval
+            while not self._poll(ticket_id):
+                if time.perf_counter() >= deadline:
+                    raise SchedulerBusy(klass, "排队超时")
+                # 名额刚释放时通常很快轮到，先短间隔轮询，之后按指数退避
+                time.sleep(min(delay, max(0.0, deadline - time.perf_counter())))
+                delay = min(delay * 2, self.max_poll_interval)
+        except SchedulerBusy:
+            self._release(ticket_id, klass, "timed_out")
+            raise
+        except BaseException:
+            self._release(ticket_id, klass)
+            raise
+        tracer.record(f"scheduler.wait.{klass}", time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            # granted 计数与释放在同一个事务中写入，轮询过程不产生写入
+            self._release(ticket_id, klass, "granted")
+
+    @asynccontextmanager
+    async def aslot(self, klass, timeout=None):
+        """slot 的异步版本：数据库操作放到线程中执行，排队时不阻塞事件循环"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        deadline = start + self._timeout(klass, timeout)
+        ticket_id = await asyncio.to_thread(self._enqueue, klass)
+        try:
+            delay = self.poll_interval
+            while not await asyncio.to_thread(self._poll, ticket_id):
+                if time.perf_counter() >= deadline:
+                    raise SchedulerBusy(klass, "排队超时")
+                await asyncio.sleep(min(delay, max(0.0, deadline - time.perf_counter())))
+                delay = min(delay * 2, self.max_poll_interval)
+        except SchedulerBusy:
+            await asyncio.to_thread(self._release, ticket_id, klass, "timed_out")
+            raise
+        except BaseException:
+            await asyncio.to_thread(self._release, ticket_id, klass)
+            raise
+        tracer.record(f"scheduler.wait.{klass}", time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self._release, ticket_id, klass, "granted")
+
+    # ---- 指标 ----
+    def stats(self):
+        """各类别的排队数、运行数与累计 granted / rejected / timed_out 次数（所有进程合计）"""
+        result = {
+            klass: {"waiting": 0, "running": 0, "limit": config["limit"], "max_queue": config["max_queue"],
+                    **{outcome: 0 for outcome in OUTCOMES}}
+            for klass, config in self.classes.items()
+        }
+        if not self.enabled:
+            return {"enabled": False, "llm_slots": self.llm_slots, "classes": result}
+        with self._lock:
+            conn = self._connection()
+            tickets = conn.execute("SELECT klass, state, COUNT(*) FROM scheduler_tickets GROUP BY klass, state").fetchall()
+            counters = conn.execute("SELECT klass, outcome, count FROM scheduler_counters").fetchall()
+        for klass, state, count in tickets:
+            if klass in result and state in ("waiting", "running"):
+                result[klass][state] = count
+        for klass, outcome, count in counters:
+            if klass in result and outcome in OUTCOMES:
+                result[klass][outcome] = count
+        return {"enabled": True, "llm_slots": self.llm_slots, "classes": result}
+
+    def prometheus(self, prefix="medical_scheduler"):
+        """排队深度（gauge）与请求结果计数（counter）的 Prometheus 文本格式"""
+        classes = self.stats()["classes"]
+        lines = [
+            f"# HELP {prefix}_queue_depth Ollama requests waiting or running, by priority class.",
+            f"# TYPE {prefix}_queue_depth gauge",
+        ]
+        for klass, item in classes.items():
+            for state in ("waiting", "running"):
+                lines.append(f'{prefix}_queue_depth{{class="{klass}",state="{state}"}} {item[state]}')
+        lines += [
+            f"# HELP {prefix}_requests_total Ollama requests by priority class and scheduling outcome.",
+            f"# TYPE {prefix}_requests_total counter",
+        ]
+        for klass, item in classes.items():
+            for outcome in OUTCOMES:
+                lines.append(f'{prefix}_requests_total{{class="{klass}",outcome="{outcome}"}} {item[outcome]}')
+        return "\n".join(lines) + "\n"
+
+
+class ScheduledEmbeddings:
+    """向量化模型的调度包装：每次请求 Ollama 前占用一个 embeddings 名额（放在缓存之内，命中缓存不排队）"""
+
+    def __init__(self, embeddings, scheduler, klass="embeddings"):
+        self.embeddings = embeddings
+        self.scheduler = scheduler
+        self.klass = klass
+
+    def embed_query(self, text):
+        with self.scheduler.slot(self.klass):
+            return self.embeddings.embed_query(text)
+
+    def embed_documents(self, texts):
+        with self.scheduler.slot(self.klass):
+            return self.embeddings.embed_documents(texts)
+
+
+scheduler = OllamaScheduler()
@@ -0,0 +1,96 @@
+# utils/qa_history.py
+import logging
+import sqlite3
+from datetime import datetime
+
+from utils.storage import get_pool
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS qa_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        session_id TEXT,
+        query TEXT,
+        response TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_qa_history_user ON qa_history (user_id, id);
+    CREATE TABLE IF NOT EXISTS qa_history_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+# 借助 SQLite JSON1 直接在库内展开每个会话最后一次运行的消息，无需把整段 memory 读到 Python 再解析
+SESSION_MESSAGES = """
+    SELECT s.user_id, s.session_id,
+           json_extract(m.value, '$.role'), json_extract(m.value, '$.content')
+    FROM agent_sessions s, json_each(s.memory, '$.runs[#-1].messages') m
+    WHERE json_valid(s.memory)
+    ORDER BY s.created_at, s.session_id, m.key
+"""
+
+
+def pair_messages(rows):
+    """把 (user_id, session_id, role, content) 按 用户提问 -> 助手回答 配对"""
+    pairs = []
+    last_query = {}
+    for user_id, session_id, role, content in rows:
+        key = (user_id, session_id)
+        if role == "user":
+            last_query[key] = content
+        elif role == "assistant" and last_query.get(key) is not None and content:
+            pairs.append((user_id, session_id, last_query[key], content))
+    return pairs
+
+
+class QAHistoryStore:
+    """
+    规范化的历史问答表，与 agno 的 agent_sessions 同库。
+    每轮问答完成时写入一行，按 user_id 建索引，读取历史只需扫描该用户最近的若干行。
+    首次使用时从 agent_sessions 中导入已有问答。
+    """
+
+    def __init__(self, db_path):
+        self.pool = get_pool(db_path)
+        self.pool.executescript(SCHEMA)
+        self._backfill()
+
+    def _backfill(self):
+        if self.pool.query_one("SELECT value FROM qa_history_meta WHERE key='backfilled'"):
+            return
+        try:
+            rows = self.pool.query(SESSION_MESSAGES)
+        except sqlite3.OperationalError:
+            # agent_sessions 尚未创建（全新部署），无需导入
+            rows = []
+        pairs = pair_messages(rows)
+        with self.pool.connection() as conn:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO qa_history (user_id, session_id, query, response) VALUES (?, ?, ?, ?)", pairs
+                )
+                conn.execute("INSERT OR REPLACE INTO qa_history_meta (key, value) VALUES ('backfilled', '1')")
+        logger.info(f"从 agent_sessions 导入 {len(pairs)} 条历史问答")
+
+    def add(self, user_id, session_id, query, response):
+        """一轮问答完成后写入（后台合并提交）"""
+        if not query or not response:
+            return
+        self.pool.submit(
+            "INSERT INTO qa_history (user_id, session_id, query, response, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, session_id, query, response, datetime.utcnow())
+        )
+
+    def recent(self, user_id=None, limit=None):
+        """按时间顺序返回最近 limit 条问答 [{"query", "response"}]，指定 user_id 时只返回该用户的"""
+        self.pool.flush()
+        where, params = ("WHERE user_id=?", (user_id,)) if user_id is not None else ("", ())
+        rows = self.pool.query(
+            f"SELECT query, response FROM (SELECT id, query, response FROM qa_history {where} "
+            f"ORDER BY id DESC LIMIT ?) ORDER BY id",
+            params + (-1 if limit is None else limit,)
+        )
+        return [{"query": query, "response": response} for query, response in rows]
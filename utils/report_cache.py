@@ -0,0 +1,108 @@
+# utils/report_cache.py
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from config.settings import REPORT_CACHE_DIR, REPORT_CACHE_MAX_BYTES
+
+# 写入中的临时文件（*.tmp）可能属于其他进程；超过该秒数仍未被替换的视为崩溃残留
+TMP_GRACE_SECONDS = 3600
+
+
+class ReportCache:
+    """
+    病例报告的内容寻址缓存：键为 去重后的对话记录 + 提示词模板版本 + 模型 的哈希，
+    Markdown 与 PDF 分别缓存，会话内容未变化时重复请求无需再次调用大模型。
+    总大小超过磁盘配额时按最近使用时间（文件 mtime）淘汰。
+    """
+
+    def __init__(self, root_dir=REPORT_CACHE_DIR, max_bytes=REPORT_CACHE_MAX_BYTES):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        for kind in ("markdown", "pdf"):
+            os.makedirs(os.path.join(root_dir, kind), exist_ok=True)
+
+    @staticmethod
+    def key(transcript: str, prompt_version: str, model_id: str) -> str:
+        return hashlib.sha256(f"{prompt_version}\0{model_id}\0{transcript}".encode("utf-8")).hexdigest()
+
+    def _path(self, kind, key):
+        return os.path.join(self.root_dir, kind, f"{key}.{'md' if kind == 'markdown' else 'pdf'}")
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get_markdown(self, key):
+        path = self._path("markdown", key)
+        if not self._touch(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def put_markdown(self, key, text):
+        path = self._path("markdown", key)
+        # 临时文件名唯一，多个进程 / 线程同时写同一报告时互不覆盖
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with open(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def open_pdf(self, key):
+        """
+        命中时返回已打开的 PDF 文件（调用方负责关闭）。
+        返回的是打开的文件而不是路径：之后即使被 evict() 删除，已打开的文件仍可完整读取
+        """
+        path = self._path("pdf", key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        self._touch(path)
+        return f
+
+    def pdf_path(self, key):
+        """PDF 渲染的目标路径，渲染完成后调用 evict() 检查配额"""
+        return self._path("pdf", key)
+
+    def evict(self):
+        with self.lock:
+            files = []
+            now = time.time()
+            for kind in ("markdown", "pdf"):
+                directory = os.path.join(self.root_dir, kind)
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if name.endswith(".tmp"):
+                        # 其他写入者正在写的临时文件不参与淘汰，只清理过期的残留
+                        if now - stat.st_mtime > TMP_GRACE_SECONDS:
+                            try:
+                                os.remove(path)
+                            except FileNotFoundError:
+                                pass
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
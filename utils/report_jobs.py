@@ -0,0 +1,115 @@
+# utils/report_jobs.py
+import asyncio
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from config.settings import REPORT_JOBS_DB_PATH, REPORT_JOB_TTL, REPORT_LOCK_LEASE
+from utils.storage import get_pool, pid_alive
+
+JOB_FIELDS = ("job_id", "format", "filename", "status", "progress", "result", "error", "created_at", "updated_at")
+ACTIVE_STATUSES = ("queued", "generating", "rendering")
+
+
+class ReportJobStore:
+    """
+    报告任务状态与报告生成锁，保存在 SQLite（WAL）中，同一台机器上的多个 uvicorn worker 共享：
+    任意 worker 都能查询其他 worker 提交的任务；同一份报告同一时刻只有一个进程在生成。
+    任务由提交它的 worker 执行，该进程退出后仍未完成的任务在查询时标记为失败。
+    """
+
+    def __init__(self, db_path=REPORT_JOBS_DB_PATH, ttl=REPORT_JOB_TTL, lease=REPORT_LOCK_LEASE):
+        self.pool = get_pool(db_path)
+        self.ttl = ttl
+        self.lease = lease
+        self.pool.executescript("""
+            CREATE TABLE IF NOT EXISTS report_jobs (
+                job_id TEXT PRIMARY KEY,
+                format TEXT,
+                filename TEXT,
+                status TEXT,
+                progress INTEGER,
+                result TEXT,
+                error TEXT,
+                pid INTEGER,
+                created_at REAL,
+                updated_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS report_locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                pid INTEGER,
+                expires_at REAL
+            );
+        """)
+
+    # ---- 任务 ----
+    def create(self, fmt, filename):
+        now = time.time()
+        job = {
+            "job_id": uuid.uuid4().hex, "format": fmt, "filename": filename, "status": "queued", "progress": 0,
+            "result": None, "error": None, "created_at": now, "updated_at": now,
+        }
+        self.pool.execute(
+            f"INSERT INTO report_jobs ({', '.join(JOB_FIELDS)}, pid) VALUES ({', '.join('?' * len(JOB_FIELDS))}, ?)",
+            tuple(job[f] for f in JOB_FIELDS) + (os.getpid(),),
+        )
+        return job
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        self.pool.execute(
+            f"UPDATE report_jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE job_id=?",
+            tuple(fields.values()) + (job_id,),
+        )
+
+    async def aupdate(self, job_id, **fields):
+        await asyncio.to_thread(self.update, job_id, **fields)
+
+    def get(self, job_id):
+        row = self.pool.query_one(f"SELECT {', '.join(JOB_FIELDS)}, pid FROM report_jobs WHERE job_id=?", (job_id,))
+        if row is None:
+            return None
+        job = dict(zip(JOB_FIELDS, row))
+        if job["status"] in ACTIVE_STATUSES and row[-1] != os.getpid() and not pid_alive(row[-1]):
+            # 执行任务的 worker 已退出
+            job.update(status="failed", error="Worker exited before the job finished.")
+            self.update(job_id, status="failed", error=job["error"])
+        return job
+
+    async def aget(self, job_id):
+        return await asyncio.to_thread(self.get, job_id)
+
+    def purge(self):
+        """清理过期的已完成任务"""
+        self.pool.execute(
+            "DELETE FROM report_jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (time.time() - self.ttl,)
+        )
+
+    # ---- 跨进程锁 ----
+    def _try_lock(self, name, owner):
+        now = time.time()
+        pid = os.getpid()
+        with self.pool.connection() as conn:
+            with conn:
+                row = conn.execute("SELECT pid, expires_at FROM report_locks WHERE name=?", (name,)).fetchone()
+                if row is not None and (row[1] < now or (row[0] != pid and not pid_alive(row[0]))):
+                    # 持有者已退出或超过租期，回收
+                    conn.execute("DELETE FROM report_locks WHERE name=? AND pid=?", (name, row[0]))
+                return conn.execute(
+                    "INSERT OR IGNORE INTO report_locks (name, owner, pid, expires_at) VALUES (?, ?, ?, ?)",
+                    (name, owner, pid, now + self.lease),
+                ).rowcount == 1
+
+    @asynccontextmanager
+    async def lock(self, name, poll_interval=0.05, max_interval=1.0):
+        """跨进程互斥；等待期间按指数退避轮询，不阻塞事件循环"""
+        owner = uuid.uuid4().hex
+        while not await asyncio.to_thread(self._try_lock, name, owner):
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_interval)
+        try:
+            yield
+        finally:
+            await self.pool.aexecute("DELETE FROM report_locks WHERE name=? AND owner=?", (name, owner))
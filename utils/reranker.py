@@ -0,0 +1,90 @@
+# utils/reranker.py
+import logging
+import threading
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from config.settings import RERANKER, RERANK_MODEL, RERANK_BATCH_SIZE
+from utils.sparse_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+RERANKERS = ("none", "embedding", "cross_encoder", "lexical")
+
+
+class EmbeddingReranker:
+    """
+    以整篇父文档的向量与问题向量的余弦相似度重排序。
+    第一阶段按分块检索，这里按整篇文档打分；问题用 embed_query 向量化（与检索时相同，经缓存直接命中），
+    所有候选文档合并为一次 embed_documents 请求，经向量缓存后重复出现的文档无需再次向量化。
+    """
+
+    name = "embedding"
+
+    def __init__(self, embedding_model):
+        self.embedding_model = embedding_model
+
+    def score(self, pairs: Sequence[Tuple[str, str]]) -> List[float]:
+        queries = list(dict.fromkeys(q for q, _ in pairs))
+        texts = list(dict.fromkeys(t for _, t in pairs))
+        query_vectors = self._normalize([self.embedding_model.embed_query(q) for q in queries])
+        text_vectors = self._normalize(self.embedding_model.embed_documents(texts))
+        query_rows = {q: i for i, q in enumerate(queries)}
+        text_rows = {t: i for i, t in enumerate(texts)}
+        return [float(query_vectors[query_rows[q]] @ text_vectors[text_rows[t]]) for q, t in pairs]
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+
+class CrossEncoderReranker:
+    """
+    交叉编码器（如 bge-reranker），在 CPU 上按 batch_size 批量推理。
+    需要安装 sentence-transformers；多个请求共用一个模型，推理串行执行，避免 CPU 线程争用。
+    """
+
+    name = "cross_encoder"
+
+    def __init__(self, model_name=RERANK_MODEL, batch_size=RERANK_BATCH_SIZE, max_length=512):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu", max_length=max_length)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+    def score(self, pairs: Sequence[Tuple[str, str]]) -> List[float]:
+        with self.lock:
+            scores = self.model.predict(list(pairs), batch_size=self.batch_size, show_progress_bar=False)
+        return [float(s) for s in scores]
+
+
+class LexicalReranker:
+    """
+    确定性的替身：问题的词（汉字二元组）在文档中出现的比例，不依赖任何模型，
+    用于测试与基准测试，结果可复现
+    """
+
+    name = "lexical"
+
+    def score(self, pairs: Sequence[Tuple[str, str]]) -> List[float]:
+        scores = []
+        for query, text in pairs:
+            terms = set(tokenize(query))
+            scores.append(len(terms & set(tokenize(text))) / len(terms) if terms else 0.0)
+        return scores
+
+
+def create_reranker(kind=RERANKER, embedding_model=None):
+    """按配置创建重排序模型，"none" 返回 None（单阶段检索）"""
+    if kind == "none":
+        return None
+    if kind == "embedding":
+        return EmbeddingReranker(embedding_model)
+    if kind == "cross_encoder":
+        return CrossEncoderReranker()
+    if kind == "lexical":
+        return LexicalReranker()
+    raise ValueError(f"未知的重排序类型: {kind}，可选: {', '.join(RERANKERS)}")
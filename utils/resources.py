@@ -0,0 +1,85 @@
+# utils/resources.py
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from config.settings import RESOURCE_RETRY_BACKOFF, RESOURCE_RETRY_MAX
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceLoader:
+    """
+    延迟、并行的资源加载器。
+    register 只登记构造函数；start 在后台线程中并行加载全部资源；get 只等待所需的那一个
+    （尚未开始加载时立即在后台开始）。构造函数内可以 get 其他资源作为依赖。
+    加载失败的资源记录失败次数与下次重试时间（retry_at），重试间隔从 retry_backoff 秒起按次数翻倍、
+    不超过 retry_max 秒；到期前 start 不再重新加载、get 直接抛出上次的异常，
+    Streamlit 每次重新运行都调用 start 也不会反复启动加载线程。
+    """
+
+    def __init__(self, retry_backoff=RESOURCE_RETRY_BACKOFF, retry_max=RESOURCE_RETRY_MAX):
+        self.retry_backoff = retry_backoff
+        self.retry_max = retry_max
+        self._factories = {}
+        self._futures = {}
+        self._status = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        with self._lock:
+            self._factories[name] = factory
+            self._status[name] = {"state": "pending"}
+
+    def __contains__(self, name):
+        return name in self._factories
+
+    def _submit(self, name):
+        with self._lock:
+            future = self._futures.get(name)
+            if future is not None and not (future.done() and future.exception() is not None):
+                return future
+            status = self._status[name]
+            if status["state"] == "failed" and time.time() < status["retry_at"]:
+                # 仍在退避期内：返回上次失败的结果，不重新加载
+                return future
+            future = self._futures[name] = Future()
+            self._status[name] = {"state": "loading", "failures": status.get("failures", 0)}
+        # 每个资源一个线程，依赖之间互相等待不会占满线程池
+        threading.Thread(target=self._load, args=(name, future), name=f"load-{name}", daemon=True).start()
+        return future
+
+    def _load(self, name, future):
+        start = time.perf_counter()
+        try:
+            value = self._factories[name]()
+        except Exception as e:
+            failures = self._status[name].get("failures", 0) + 1
+            retry_in = min(self.retry_max, self.retry_backoff * 2 ** (failures - 1))
+            logger.warning(f"资源 {name} 第 {failures} 次加载失败，{retry_in} 秒后重试: {e}")
+            self._status[name] = {
+                "state": "failed", "error": str(e), "seconds": round(time.perf_counter() - start, 3),
+                "failures": failures, "retry_at": time.time() + retry_in,
+            }
+            future.set_exception(e)
+            return
+        self._status[name] = {"state": "ready", "seconds": round(time.perf_counter() - start, 3)}
+        future.set_result(value)
+
+    def start(self, names=None):
+        """后台并行加载（默认全部资源），立即返回"""
+        for name in names or list(self._factories):
+            self._submit(name)
+        return self
+
+    def get(self, name, timeout=None):
+        """获取资源，尚未加载完成时等待"""
+        return self._submit(name).result(timeout)
+
+    def is_ready(self, names=None):
+        return all(self._status[name]["state"] == "ready" for name in names or self._factories)
+
+    def status(self):
+        """{资源名: {"state": pending/loading/ready/failed, "seconds", "error", "failures", "retry_at"（失败时的下次重试时间戳）}}"""
+        return {name: dict(status) for name, status in self._status.items()}
@@ -0,0 +1,308 @@
+# utils/retrieval.py
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from config.settings import (
+    SEARCH_TYPE, TOP_K, RETRIEVAL_TIMEOUT, HYBRID_ENABLED, HYBRID_CANDIDATES, RRF_K,
+    RERANK_CANDIDATES, RERANK_DOC_CHARS, CONTEXT_TOKEN_BUDGET, CONTEXT_BUILDER_ENABLED,
+)
+from utils.context_builder import build_context
+from utils.faiss_index import filtered_search, search_by_vectors
+from utils.token_budget import fit_token_budget
+from utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+ID_KEY = "doc_id"
+
+# 混合检索时稠密检索所在的线程池
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="dense-search")
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """倒数排名融合：score(d) = Σ 1 / (k + rank)，只用名次、不依赖各路得分的量纲"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def _hits(sub_docs) -> List[Tuple[str, str]]:
+    return [(d.metadata[ID_KEY], d.page_content) for d in sub_docs if ID_KEY in d.metadata]
+
+
+def ranked_doc_ids(hits) -> List[str]:
+    """分块命中 [(doc_id, 分块文本)] -> 保持顺序去重的父文档 doc_id"""
+    return list(dict.fromkeys(doc_id for doc_id, _ in hits))
+
+
+def collect_sections(sections, hits):
+    """把命中的分块文本按 doc_id 归并到 sections（{doc_id: [分块文本]}），供上下文构建使用"""
+    for doc_id, text in hits:
+        if text is not None:
+            doc_sections = sections.setdefault(doc_id, [])
+            if text not in doc_sections:
+                doc_sections.append(text)
+    return sections
+
+
+def dense_search(query, embedding_model, vectorstore, k, search_type=SEARCH_TYPE, bitmap=None) -> List[Tuple[str, str]]:
+    """
+    向量检索子分块，返回按相似度排序的分块命中 [(doc_id, 分块文本)]。
+    bitmap: 可选的行号位图（见 CategoryIndex.bitmap），只在选中的分块中检索（此时不做 MMR）
+    """
+    with tracer.span("retrieve.embed"):
+        embedding = embedding_model.embed_query(query)
+    with tracer.span("retrieve.search", k=k, filtered=bitmap is not None) as attrs:
+        if bitmap is not None:
+            sub_docs = filtered_search(vectorstore, embedding, k, bitmap)
+        elif search_type == "mmr":
+            sub_docs = vectorstore.max_marginal_relevance_search_by_vector(embedding, k=k)
+        else:
+            sub_docs = vectorstore.similarity_search_by_vector(embedding, k=k)
+        attrs["hits"] = len(sub_docs)
+    return _hits(sub_docs)
+
+
+def dense_search_batch(queries, embedding_model, vectorstore, k, bitmap=None) -> List[List[Tuple[str, str]]]:
+    """多个查询一次 embed_documents、一次 index.search，返回每个查询的分块命中（不做 MMR）"""
+    with tracer.span("retrieve.embed", batch=len(queries)):
+        embeddings = embedding_model.embed_documents(queries)
+    with tracer.span("retrieve.search", k=k, batch=len(queries), filtered=bitmap is not None) as attrs:
+        results = search_by_vectors(vectorstore, embeddings, k, bitmap)
+        attrs["hits"] = sum(len(docs) for docs in results)
+    return [_hits(docs) for docs in results]
+
+
+def sparse_search(query, sparse_index, k, bitmap=None, vectorstore=None) -> List[Tuple[str, Optional[str]]]:
+    """BM25 检索，返回 [(doc_id, 得分最高的分块文本)]；未提供 vectorstore 时分块文本为 None"""
+    with tracer.span("retrieve.sparse", k=k, filtered=bitmap is not None) as attrs:
+        hits = []
+        for doc_id, _, row in sparse_index.search(query, k, bitmap):
+            text = None
+            if vectorstore is not None:
+                doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id.get(row))
+                text = None if isinstance(doc, str) else doc.page_content
+            hits.append((doc_id, text))
+        attrs["hits"] = len(hits)
+    return hits
+
+
+def fetch_texts(docstore, doc_ids) -> Dict[str, str]:
+    """按 doc_id 读取父文档并解码为 JSON 文本，返回 {doc_id: 文本}（保持顺序，缺失或解码失败的跳过）"""
+    with tracer.span("retrieve.docstore", docs=len(doc_ids)):
+        results = docstore.mget(doc_ids)
+    texts = {}
+    with tracer.span("retrieve.decode"):
+        for doc_id, raw_bytes in zip(doc_ids, results):
+            if raw_bytes is None:
+                continue
+            try:
+                # 父文档以 JSON 存储，解码后即可直接作为上下文
+                texts[doc_id] = raw_bytes.decode("utf-8")
+            except Exception as e:
+                logger.warning(f"解码失败: {e}")
+    return texts
+
+
+def fetch_documents(docstore, doc_ids) -> List[str]:
+    """按 doc_id 读取父文档并解码为 JSON 文本"""
+    return list(fetch_texts(docstore, doc_ids).values())
+
+
+def name_hit_search(query, sparse_index, k):
+    """问题恰为疾病名时返回 doc_id 列表（其余名额用 BM25 结果补足，无需向量化），否则返回 None"""
+    name_hit = sparse_index.lookup_name(query)
+    if name_hit is None:
+        return None
+    with tracer.span("retrieve.name_hit"):
+        return list(dict.fromkeys([name_hit, *ranked_doc_ids(sparse_search(query, sparse_index, k))]))[:k]
+
+
+def category_bitmap(category, category_index, ntotal):
+    """科室 / 类别提示 -> 行号位图；无类别索引、无匹配类别或类别索引与向量库不一致时返回 None（不过滤）"""
+    if not category or category_index is None:
+        return None
+    with tracer.span("retrieve.category") as attrs:
+        bitmap = category_index.bitmap(category)
+        if bitmap is not None and category_index.ntotal != ntotal:
+            logger.warning("类别索引与向量库行数不一致，忽略类别过滤，请执行 python build_index.py --sparse-only")
+            bitmap = None
+        attrs["matched"] = bitmap is not None
+    return bitmap
+
+
+def rerank_pools(pools, texts, reranker, k):
+    """
+    pools: {问题: [候选 doc_id]}，texts: {doc_id: 文档文本}。
+    全部 (问题, 文档) 对一次交给重排序模型批量打分，返回 {问题: 得分最高的 k 个 doc_id}（同分保持原顺序）
+    """
+    pairs, owners = [], []
+    for query, doc_ids in pools.items():
+        for doc_id in doc_ids:
+            if doc_id in texts:
+                pairs.append((query, texts[doc_id][:RERANK_DOC_CHARS]))
+                owners.append((query, doc_id))
+    with tracer.span("retrieve.rerank", reranker=reranker.name, pairs=len(pairs)):
+        scores = reranker.score(pairs) if pairs else []
+    scored = {query: [] for query in pools}
+    for (query, doc_id), score in zip(owners, scores):
+        scored[query].append((score, doc_id))
+    return {
+        query: [doc_id for _, doc_id in sorted(items, key=lambda item: -item[0])[:k]]
+        for query, items in scored.items()
+    }
+
+
+def load_contexts(docstore, doc_ids, sections):
+    """
+    读取父文档；启用上下文构建时只保留命中的分块内容与选定的父文档字段（精确命中疾病名的文档没有分块，
+    保留全部字段，由字段长度上限与总预算截断），返回 {doc_id: 上下文文本}
+    """
+    texts = fetch_texts(docstore, doc_ids)
+    if not CONTEXT_BUILDER_ENABLED:
+        return texts
+    with tracer.span("retrieve.context", docs=len(texts)):
+        return {doc_id: build_context(text, sections.get(doc_id)) for doc_id, text in texts.items()}
+
+
+def search_documents(
+    query, embedding_model, vectorstore, docstore, k=TOP_K, search_type=SEARCH_TYPE, sparse_index=None,
+    category=None, category_index=None, reranker=None, token_budget=CONTEXT_TOKEN_BUDGET,
+) -> List[str]:
+    """
+    与 MultiVectorRetriever 的检索流程一致：向量化 -> 检索子分块 -> 按 doc_id 读取父文档，
+    各阶段分别计时。返回各父文档的上下文文本列表（未启用上下文构建时为父文档 JSON 全文）。
+    提供稀疏索引时：问题恰为疾病名则直接按名称取文档（不调用向量化），
+    否则稠密与 BM25 并行检索，按 RRF 融合后取前 k 个父文档。
+    提供 category 时只在该科室 / 类别的分块中检索（无匹配类别时不过滤）。
+    提供 reranker 时两阶段检索：先取 RERANK_CANDIDATES 个候选父文档，重排序后保留前 k 个。
+    启用上下文构建或重排序时，结果总长按 token_budget 截断。
+    """
+    bitmap = category_bitmap(category, category_index, vectorstore.index.ntotal)
+    hybrid = sparse_index is not None and HYBRID_ENABLED
+    pool = k if reranker is None else max(k, RERANK_CANDIDATES)
+    sections = {}
+
+    doc_ids = name_hit_search(query, sparse_index, k) if hybrid else None
+    exact = doc_ids is not None
+    if not exact and hybrid:
+        candidates = max(pool, HYBRID_CANDIDATES)
+        # 稠密检索在线程池中执行（向量化请求与 FAISS 检索都会释放 GIL），复制上下文以保留 trace_id
+        dense = _executor.submit(
+            contextvars.copy_context().run,
+            dense_search, query, embedding_model, vectorstore, candidates, search_type, bitmap,
+        )
+        sparse_hits = sparse_search(query, sparse_index, candidates, bitmap, vectorstore)
+        dense_hits = dense.result()
+        with tracer.span("retrieve.fuse", dense=len(dense_hits), sparse=len(sparse_hits)):
+            doc_ids = reciprocal_rank_fusion([ranked_doc_ids(dense_hits), ranked_doc_ids(sparse_hits)])[:pool]
+        collect_sections(sections, dense_hits + sparse_hits)
+    elif not exact:
+        dense_hits = dense_search(query, embedding_model, vectorstore, pool, search_type, bitmap)
+        doc_ids = ranked_doc_ids(dense_hits)[:pool]
+        collect_sections(sections, dense_hits)
+
+    texts = load_contexts(docstore, doc_ids, sections)
+    # 疾病名精确命中的结果不再重排序
+    if reranker is not None and not exact:
+        doc_ids = rerank_pools({query: doc_ids}, texts, reranker, k)[query]
+    contexts = [texts[d] for d in doc_ids[:k] if d in texts]
+    if CONTEXT_BUILDER_ENABLED or reranker is not None:
+        return fit_token_budget(contexts, token_budget)
+    return contexts
+
+
+def search_documents_batch(
+    queries, embedding_model, vectorstore, docstore, k=TOP_K, sparse_index=None, category=None, category_index=None,
+    reranker=None, token_budget=CONTEXT_TOKEN_BUDGET,
+) -> List[str]:
+    """
+    多个查询的批量检索：疾病名精确命中的查询不向量化，其余查询一次向量化、一次 FAISS 检索，
+    各查询分别取前 k 个父文档（有稀疏索引时与 BM25 结果按 RRF 融合；提供 reranker 时各取候选池后
+    一次批量重排序）。跨查询去重后一次读取，按名次轮流排列（各查询的第一名在前）。
+    """
+    queries = list(dict.fromkeys(q.strip() for q in queries if q and q.strip()))
+    bitmap = category_bitmap(category, category_index, vectorstore.index.ntotal)
+    hybrid = sparse_index is not None and HYBRID_ENABLED
+    pool = k if reranker is None else max(k, RERANK_CANDIDATES)
+    ranked, pending, sections = {}, [], {}
+    for query in queries:
+        doc_ids = name_hit_search(query, sparse_index, k) if hybrid else None
+        if doc_ids is None:
+            pending.append(query)
+        else:
+            ranked[query] = doc_ids
+
+    pools = {}
+    if pending and hybrid:
+        candidates = max(pool, HYBRID_CANDIDATES)
+        dense = _executor.submit(
+            contextvars.copy_context().run,
+            dense_search_batch, pending, embedding_model, vectorstore, candidates, bitmap,
+        )
+        sparse_lists = [sparse_search(query, sparse_index, candidates, bitmap, vectorstore) for query in pending]
+        dense_lists = dense.result()
+        with tracer.span("retrieve.fuse", batch=len(pending)):
+            for query, dense_hits, sparse_hits in zip(pending, dense_lists, sparse_lists):
+                pools[query] = reciprocal_rank_fusion([ranked_doc_ids(dense_hits), ranked_doc_ids(sparse_hits)])[:pool]
+                collect_sections(sections, dense_hits + sparse_hits)
+    elif pending:
+        for query, dense_hits in zip(pending, dense_search_batch(pending, embedding_model, vectorstore, pool, bitmap)):
+            pools[query] = ranked_doc_ids(dense_hits)[:pool]
+            collect_sections(sections, dense_hits)
+
+    texts = load_contexts(
+        docstore, list(dict.fromkeys(d for ids in [*ranked.values(), *pools.values()] for d in ids)), sections
+    )
+    if reranker is None:
+        ranked.update(pools)
+    else:
+        ranked.update(rerank_pools(pools, texts, reranker, k))
+
+    doc_ids = {}
+    for rank in range(k):
+        for query in queries:
+            if rank < len(ranked[query]):
+                doc_ids.setdefault(ranked[query][rank], None)
+    contexts = [texts[d] for d in doc_ids if d in texts]
+    if CONTEXT_BUILDER_ENABLED or reranker is not None:
+        return fit_token_budget(contexts, token_budget)
+    return contexts
+
+
+class RetrievalClient:
+    """检索服务（retrieval_service.py）的客户端，复用 HTTP 连接"""
+
+    def __init__(self, base_url, timeout=RETRIEVAL_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def retrieve(self, query, k=TOP_K, category=None) -> List[str]:
+        with tracer.span("retrieve.remote", k=k):
+            resp = self.session.post(
+                f"{self.base_url}/retrieve", json={"query": query, "k": k, "category": category}, timeout=self.timeout
+            )
+            resp.raise_for_status()
+            return resp.json()["documents"]
+
+    def retrieve_batch(self, queries, k=TOP_K, category=None) -> List[str]:
+        with tracer.span("retrieve.remote", k=k, batch=len(queries)):
+            resp = self.session.post(
+                f"{self.base_url}/retrieve_batch",
+                json={"queries": list(queries), "k": k, "category": category},
+                timeout=self.timeout,
+            )
+            resp.raise_for_status()
+            return resp.json()["documents"]
+
+    def health(self):
+        resp = self.session.get(f"{self.base_url}/health", timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
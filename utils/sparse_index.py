@@ -0,0 +1,258 @@
+# utils/sparse_index.py
+import json
+import logging
+import os
+import re
+import unicodedata
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from config.settings import SPARSE_TOKENIZER, BM25_K1, BM25_B
+from utils.docstore import RowPack
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+logger = logging.getLogger(__name__)
+
+# 稀疏索引保存在向量库目录下（vs/sparse），与 index.faiss 一同构建、一同更新
+SPARSE_DIR = "sparse"
+FORMAT_VERSION = 2
+META_FILE = "meta.json"
+ID_KEY = "doc_id"
+
+# 连续的汉字，或连续的字母数字（药名缩写、剂量等）
+_TOKEN_RUN = re.compile(r"[㐀-鿿]+|[a-z0-9]+")
+_NAME_STRIP = re.compile(r"[\s\W_]+")
+
+
+def tokenize(text, tokenizer=SPARSE_TOKENIZER):
+    """
+    中文分词：默认取汉字二元组（单字词保留单字），无需词典即可匹配疾病名、药名；
+    tokenizer="jieba" 且已安装 jieba 时使用搜索引擎模式分词。字母数字串整体作为一个词。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for run in _TOKEN_RUN.findall(text):
+        if run.isascii():
+            tokens.append(run)
+        elif tokenizer == "jieba" and jieba is not None:
+            tokens.extend(w for w in jieba.cut_for_search(run) if w.strip())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def normalize_name(text):
+    """疾病名归一化：全角转半角、去除空白与标点，用于精确匹配"""
+    return _NAME_STRIP.sub("", unicodedata.normalize("NFKC", text or "").lower())
+
+
+class _TextRows:
+    """RowPack 的字符串视图：按行号返回解码后的文本"""
+
+    def __init__(self, pack):
+        self.pack = pack
+
+    def __len__(self):
+        return len(self.pack)
+
+    def __getitem__(self, row):
+        return self.pack.text(row)
+
+
+class _PackedMap:
+    """键按字节序保存在 RowPack 中的只读映射，按键二分查找；value_at(行号) 取对应的值"""
+
+    def __init__(self, keys, value_at):
+        self.keys = keys
+        self.value_at = value_at
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.keys.find(key) is not None
+
+    def __getitem__(self, key):
+        row = self.keys.find(key)
+        if row is None:
+            raise KeyError(key)
+        return self.value_at(row)
+
+    def get(self, key, default=None):
+        row = self.keys.find(key)
+        return default if row is None else self.value_at(row)
+
+
+def _write_atomic(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class SparseIndex:
+    """
+    BM25 倒排索引，按分块建索引，检索结果按所属父文档（doc_id）去重。
+    倒排表以 CSR 形式保存为 numpy 数组（indptr / rows / tfs），词表、各分块的 doc_id 与
+    疾病名 -> doc_id 映射保存为 RowPack，加载时全部内存映射，不解析 JSON，多个进程共享页缓存。
+    """
+
+    def __init__(self, vocab, indptr, rows, tfs, doc_len, doc_ids, names, tokenizer=SPARSE_TOKENIZER,
+                 k1=BM25_K1, b=BM25_B):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.rows = rows
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.doc_ids = doc_ids
+        self.names = names
+        self.tokenizer = tokenizer
+        n = len(doc_len)
+        self.avgdl = float(doc_len.mean()) if n else 0.0
+        df = np.diff(indptr).astype(np.float32)
+        self.idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        self.k1 = k1
+        # 文档长度归一化项只与分块长度有关，加载时计算一次
+        self.norm = (k1 * (1.0 - b + b * np.asarray(doc_len, dtype=np.float32) / max(self.avgdl, 1e-9))).astype(np.float32)
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    @classmethod
+    def from_documents(cls, documents, tokenizer=SPARSE_TOKENIZER):
+        """由分块 Document（page_content + metadata 中的 doc_id / name）构建"""
+        if tokenizer == "jieba" and jieba is None:
+            logger.warning("未安装 jieba，稀疏索引改用汉字二元组分词")
+            tokenizer = "bigram"
+        vocab, names, doc_ids = {}, {}, []
+        term_ids, rows, tfs, doc_len = array("i"), array("i"), array("f"), array("i")
+        for row, doc in enumerate(documents):
+            # JSON 分块后只有首个分块含 name 字段，每个分块都附带所属疾病名一起建索引
+            counts = Counter(tokenize(f"{doc.metadata.get('name', '')} {doc.page_content}", tokenizer))
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                rows.append(row)
+                tfs.append(tf)
+            doc_len.append(sum(counts.values()))
+            doc_id = doc.metadata.get(ID_KEY, "")
+            doc_ids.append(doc_id)
+            name = normalize_name(doc.metadata.get("name", ""))
+            if name and doc_id:
+                names.setdefault(name, doc_id)
+
+        # 按词 ID 稳定排序得到 CSR 倒排表，同一个词的 rows 保持升序
+        term_ids = np.frombuffer(term_ids, dtype=np.int32)
+        order = np.argsort(term_ids, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=indptr[1:])
+        return cls(
+            vocab,
+            indptr,
+            np.frombuffer(rows, dtype=np.int32)[order],
+            np.frombuffer(tfs, dtype=np.float32)[order],
+            np.frombuffer(doc_len, dtype=np.int32).copy(),
+            doc_ids,
+            names,
+            tokenizer,
+        )
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore, tokenizer=SPARSE_TOKENIZER):
+        """
+        由 FAISS 向量库中已保存的分块构建，全量构建与增量更新之后都可直接调用。
+        按向量行号顺序建索引，行号与 index.faiss 一致，可与类别位图对齐
+        """
+        docstore, mapping = vectorstore.docstore, vectorstore.index_to_docstore_id
+        return cls.from_documents(
+            (docstore.search(mapping[row]) for row in range(vectorstore.index.ntotal)), tokenizer
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name, value in (("indptr", self.indptr), ("rows", self.rows), ("tfs", self.tfs), ("doc_len", self.doc_len)):
+            _write_atomic(os.path.join(path, f"{name}.npy"), lambda f, v=value: np.save(f, v))
+        # 词表与疾病名按字节序排序保存，加载后二分查找；doc_ids 按行号保存
+        terms = sorted(self.vocab, key=lambda t: t.encode("utf-8"))
+        RowPack.write(path, "vocab", (t.encode("utf-8") for t in terms))
+        term_ids = np.array([self.vocab[t] for t in terms], dtype=np.int32)
+        _write_atomic(os.path.join(path, "vocab_ids.npy"), lambda f: np.save(f, term_ids))
+        RowPack.write(path, "doc_ids", (d.encode("utf-8") for d in self.doc_ids))
+        names = sorted(self.names, key=lambda n: n.encode("utf-8"))
+        RowPack.write(path, "names", (n.encode("utf-8") for n in names))
+        RowPack.write(path, "name_doc_ids", (self.names[n].encode("utf-8") for n in names))
+        # meta.json 最后写入，作为索引完整的标志
+        meta = {"version": FORMAT_VERSION, "tokenizer": self.tokenizer, "chunks": len(self), "terms": len(self.vocab)}
+        _write_atomic(os.path.join(path, META_FILE), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """加载稀疏索引；不存在或版本不符时返回 None（检索退化为纯向量检索）"""
+        meta_path = os.path.join(path, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != FORMAT_VERSION:
+            logger.warning(f"稀疏索引 {path} 版本不符，请运行 python build_index.py --sparse-only 重建")
+            return None
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ("indptr", "rows", "tfs", "doc_len", "vocab_ids")
+        }
+        term_ids = arrays["vocab_ids"]
+        name_doc_ids = RowPack(path, "name_doc_ids", mmap_mode)
+        return cls(
+            _PackedMap(RowPack(path, "vocab", mmap_mode), lambda row: int(term_ids[row])),
+            arrays["indptr"], arrays["rows"], arrays["tfs"], arrays["doc_len"],
+            _TextRows(RowPack(path, "doc_ids", mmap_mode)),
+            _PackedMap(RowPack(path, "names", mmap_mode), name_doc_ids.text),
+            meta.get("tokenizer", SPARSE_TOKENIZER),
+        )
+
+    def lookup_name(self, query):
+        """问题与某个疾病名完全一致（忽略空白与标点）时返回其 doc_id"""
+        return self.names.get(normalize_name(query))
+
+    def search(self, query, k, bitmap=None):
+        """
+        BM25 检索，返回按得分排序、按 doc_id 去重的 [(doc_id, score, 行号)]，最多 k 条；
+        行号为该文档得分最高的分块，与 index.faiss 的行号一致。
+        bitmap: 可选的行号位图（见 CategoryIndex.bitmap），只返回选中的分块
+        """
+        term_ids = {self.vocab[t] for t in tokenize(query, self.tokenizer) if t in self.vocab}
+        if not term_ids or not len(self):
+            return []
+        scores = np.zeros(len(self), dtype=np.float32)
+        k1, norm = self.k1, self.norm
+        for term_id in term_ids:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            rows, tfs = self.rows[start:end], self.tfs[start:end]
+            scores[rows] += self.idf[term_id] * tfs * (k1 + 1.0) / (tfs + norm[rows])
+
+        if bitmap is not None:
+            scores *= np.unpackbits(bitmap, count=len(self), bitorder="little")
+
+        # 同一父文档可能有多个分块命中，多取一些候选再去重
+        candidates = np.flatnonzero(scores)
+        if not len(candidates):
+            return []
+        n = min(len(candidates), k * 4)
+        top = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        results = {}
+        for row in top:
+            doc_id = self.doc_ids[row]
+            if doc_id and doc_id not in results:
+                results[doc_id] = (doc_id, float(scores[row]), int(row))
+                if len(results) >= k:
+                    break
+        return list(results.values())
@@ -0,0 +1,176 @@
+# utils/storage.py
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config.settings import SQLITE_POOL_SIZE, SQLITE_BUSY_TIMEOUT_MS, SQLITE_WRITE_BATCH
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # 读写互不阻塞，多进程读不再出现 database is locked
+    "PRAGMA synchronous=NORMAL",     # WAL 模式下安全且提交更快
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size=-16000",      # 约 16MB 页缓存
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def connect(db_path):
+    """创建已设置 WAL 与性能参数的连接，可跨线程使用（调用方负责串行化）"""
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def pid_alive(pid):
+    """同一台机器上的进程是否仍在运行（用于回收多进程共享的 SQLite 状态中已退出进程的记录）"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SQLitePool:
+    """单个数据库文件的连接池，附带一个合并写入的后台写线程"""
+
+    def __init__(self, db_path, size=SQLITE_POOL_SIZE, write_batch=SQLITE_WRITE_BATCH):
+        self.db_path = db_path
+        self.size = size
+        self.write_batch = write_batch
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # 后台写入
+        self._writes = queue.Queue()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._writer = None
+
+    @contextmanager
+    def connection(self):
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    conn = connect(self.db_path)
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def execute(self, sql, params=()):
+        """立即执行一条写语句并提交，返回 lastrowid"""
+        with self.connection() as conn:
+            with conn:
+                return conn.execute(sql, params).lastrowid
+
+    def executemany(self, sql, seq_of_params):
+        with self.connection() as conn:
+            with conn:
+                conn.executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        with self.connection() as conn:
+            conn.executescript(script)
+
+    def query(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    # ---- 合并写入 ----
+    def submit(self, sql, params=()):
+        """提交一条写语句到后台写线程，与同时到达的其他写入合并为一个事务"""
+        with self._cond:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name=f"sqlite-writer-{os.path.basename(self.db_path)}", daemon=True)
+                self._writer.start()
+            self._pending += 1
+        self._writes.put((sql, params))
+
+    def _write_loop(self):
+        while True:
+            batch = [self._writes.get()]
+            # 只合并已经排队的写入，不额外等待，单条写入也不会增加延迟
+            while len(batch) < self.write_batch:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.connection() as conn:
+                    with conn:
+                        for sql, params in batch:
+                            conn.execute(sql, params)
+            except sqlite3.Error as e:
+                # 整批已回滚：逐条重试，每条单独提交，一条失败不再连带丢弃同批的其他写入
+                logger.warning(f"批量写入 {self.db_path} 失败（{len(batch)} 条），改为逐条写入: {e}")
+                self._write_each(batch)
+            with self._cond:
+                self._pending -= len(batch)
+                self._cond.notify_all()
+
+    def _write_each(self, batch):
+        for sql, params in batch:
+            try:
+                with self.connection() as conn:
+                    with conn:
+                        conn.execute(sql, params)
+            except sqlite3.Error as e:
+                logger.error(f"写入 {self.db_path} 失败: {e}; SQL: {sql}")
+
+    def flush(self, timeout=None):
+        """等待已提交的写入全部落盘（读自己刚写入的数据前调用）"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    # ---- 异步接口 ----
+    async def aexecute(self, sql, params=()):
+        return await asyncio.to_thread(self.execute, sql, params)
+
+    async def aquery(self, sql, params=()):
+        return await asyncio.to_thread(self.query, sql, params)
+
+    async def aflush(self, timeout=None):
+        return await asyncio.to_thread(self.flush, timeout)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path) -> SQLitePool:
+    """按数据库文件共享连接池（进程内单例）"""
+    db_path = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = SQLitePool(db_path)
+        return pool
+
+
+@atexit.register
+def _flush_all():
+    for pool in list(_pools.values()):
+        pool.flush(timeout=5)
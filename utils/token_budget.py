@@ -0,0 +1,44 @@
+# utils/token_budget.py
+import re
+
+# 不加载大模型的分词器，按字符粗略估算 token 数：
+# 汉字（含中文标点）约 1 个 token，其余字符约 4 个字符 1 个 token
+_WIDE = re.compile(r"[　-〿㐀-鿿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    wide = len(_WIDE.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """截断到估算不超过 budget 个 token，在截断处加省略号"""
+    if estimate_tokens(text) <= budget:
+        return text
+    # 估算值随长度单调增加，二分查找最长的前缀
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget - 1:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + "…"
+
+
+def fit_token_budget(texts, budget, min_tokens=64):
+    """
+    按顺序保留文本直到用完预算；放不下的那一篇截断到剩余预算，
+    剩余预算不足 min_tokens 时丢弃，不再返回过短的片段
+    """
+    results, remaining = [], budget
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if tokens <= remaining:
+            results.append(text)
+            remaining -= tokens
+            continue
+        if remaining >= min_tokens:
+            results.append(truncate_to_tokens(text, remaining))
+        break
+    return results
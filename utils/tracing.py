@@ -0,0 +1,240 @@
+# utils/tracing.py
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from config.settings import TRACING_ENABLED, TRACE_PATH, TRACE_WINDOW, TRACE_MAX_BYTES, TRACE_TAIL_BYTES
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+# 轮转锁残留超过该秒数视为持有进程已崩溃
+ROTATE_LOCK_STALE = 60
+
+# 当前请求（一轮问答 / 一次报告生成）的 trace_id，同一轮中的各阶段共享
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+class Tracer:
+    """
+    记录各阶段耗时（span），追加写入本地 JSONL，并在内存中保留每个阶段最近 window 次耗时，
+    用于计算 p50/p95/p99 与输出 Prometheus 文本格式指标。
+    """
+
+    def __init__(self, path=TRACE_PATH, window=TRACE_WINDOW, max_bytes=TRACE_MAX_BYTES, enabled=TRACING_ENABLED):
+        self.path = path
+        self.window = window
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self._durations = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts = defaultdict(int)
+        self._sums = defaultdict(float)
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    @staticmethod
+    def new_trace(trace_id=None):
+        """开始一次新的请求追踪，返回 trace_id"""
+        trace_id = trace_id or uuid.uuid4().hex[:16]
+        _trace_id.set(trace_id)
+        return trace_id
+
+    def record(self, name, seconds, **attrs):
+        """记录一个已完成的阶段耗时"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self._durations[name].append(seconds)
+            self._counts[name] += 1
+            self._sums[name] += seconds
+        if self.path:
+            self._export({
+                "ts": time.time(),
+                "trace_id": _trace_id.get(),
+                "span": name,
+                "duration_ms": round(seconds * 1000, 3),
+                **attrs,
+            })
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        计时上下文，可在块内补充属性：
+            with tracer.span("retrieve.search", k=2) as attrs:
+                attrs["hits"] = len(docs)
+        """
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except Exception as e:
+            attrs["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, **attrs)
+
+    def _export(self, item):
+        line = json.dumps(item, ensure_ascii=False, default=str) + "\n"
+        try:
+            with self.lock:
+                # 超过大小上限时轮转为 .1，只保留一个历史文件
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+        except OSError as e:
+            logger.warning(f"写入追踪记录失败: {e}")
+
+    def _rotate(self):
+        """
+        多个进程写同一个文件：以锁文件（O_EXCL 创建）保证同一时刻只有一个进程轮转，
+        持锁后重新检查大小，避免刚轮转出的新文件又被其他进程覆盖到 .1
+        """
+        lock_path = self.path + ".lock"
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # 其他进程正在轮转，本次直接追加；锁文件残留过久时清理
+            try:
+                if time.time() - os.path.getmtime(lock_path) > ROTATE_LOCK_STALE:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            return
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+    def reset(self):
+        """清空内存中的统计（不影响已写入的 JSONL）"""
+        with self.lock:
+            self._durations.clear()
+            self._counts.clear()
+            self._sums.clear()
+
+    def summary(self):
+        """{阶段: {"count", "mean_ms", "p50_ms", "p95_ms", "p99_ms"}}（分位数基于最近 window 次）"""
+        with self.lock:
+            items = {name: (np.array(values), self._counts[name], self._sums[name]) for name, values in self._durations.items()}
+        return {name: summarize(values, count, total) for name, (values, count, total) in sorted(items.items())}
+
+    def prometheus(self):
+        with self.lock:
+            items = {name: (np.array(values), self._counts[name], self._sums[name]) for name, values in self._durations.items()}
+        return render_prometheus(items)
+
+
+def summarize(values, count=None, total=None):
+    count = len(values) if count is None else count
+    total = float(np.sum(values)) if total is None else total
+    result = {"count": count, "mean_ms": round(total / count * 1000, 3) if count else 0.0}
+    if len(values):
+        for q, v in zip(QUANTILES, np.quantile(values, QUANTILES)):
+            result[f"p{int(q * 100)}_ms"] = round(float(v) * 1000, 3)
+    return result
+
+
+def render_prometheus(items, metric="medical_stage_duration_seconds"):
+    """items: {阶段: (最近耗时数组, 累计次数, 累计耗时)}，输出 Prometheus summary 文本格式"""
+    lines = [
+        f"# HELP {metric} Duration of pipeline stages in seconds.",
+        f"# TYPE {metric} summary",
+    ]
+    for name, (values, count, total) in sorted(items.items()):
+        if len(values):
+            for q, v in zip(QUANTILES, np.quantile(values, QUANTILES)):
+                lines.append(f'{metric}{{stage="{name}",quantile="{q}"}} {float(v):.6f}')
+        lines.append(f'{metric}_count{{stage="{name}"}} {count}')
+        lines.append(f'{metric}_sum{{stage="{name}"}} {total:.6f}')
+    return "\n".join(lines) + "\n"
+
+
+class SpanReader:
+    """
+    汇总所有进程写入 JSONL 的阶段耗时（供 /metrics 使用）：首次只读取文件末尾 tail_bytes 字节，
+    之后每次只读取上次之后新追加的内容，内存中保留每个阶段最近 window 次耗时；
+    文件轮转后先读完旧文件（.1）剩余部分，再从新文件开头读取。count / sum 从本进程开始读取时累计。
+    """
+
+    def __init__(self, path=TRACE_PATH, window=TRACE_WINDOW, tail_bytes=TRACE_TAIL_BYTES):
+        self.path = path
+        self.window = window
+        self.tail_bytes = tail_bytes
+        self.lock = threading.Lock()
+        self._durations = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts = defaultdict(int)
+        self._sums = defaultdict(float)
+        # 当前读取的文件（inode）与已读取到的偏移
+        self._inode = None
+        self._offset = 0
+
+    def _consume(self, file_path, start, align=False):
+        """从 start 开始读取完整的行，返回读取结束的偏移；align 时跳过 start 处不完整的首行"""
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            if align and start > 0:
+                f.readline()
+            data = f.read()
+            end = f.tell()
+        # 最后一行可能还在写入中，留到下次读取
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].splitlines():
+            try:
+                item = json.loads(line)
+                seconds = item["duration_ms"] / 1000
+                name = item["span"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            self._durations[name].append(seconds)
+            self._counts[name] += 1
+            self._sums[name] += seconds
+        return end - (len(data) - complete)
+
+    def _catch_up(self):
+        rotated = self.path + ".1"
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if self._inode is None:
+            # 首次读取：只取末尾 tail_bytes，当前文件不足时从轮转出的旧文件末尾补足
+            start = max(0, stat.st_size - self.tail_bytes)
+            rest = self.tail_bytes - stat.st_size
+            if rest > 0 and os.path.exists(rotated):
+                self._consume(rotated, max(0, os.path.getsize(rotated) - rest), align=True)
+            self._offset = self._consume(self.path, start, align=True)
+        elif stat.st_ino != self._inode or stat.st_size < self._offset:
+            # 已轮转：旧文件剩余部分在 .1 中
+            try:
+                if os.stat(rotated).st_ino == self._inode:
+                    self._consume(rotated, self._offset)
+            except FileNotFoundError:
+                pass
+            self._offset = self._consume(self.path, 0)
+        elif stat.st_size > self._offset:
+            self._offset = self._consume(self.path, self._offset)
+        self._inode = stat.st_ino
+
+    def read(self):
+        """{阶段: (最近耗时数组, 累计次数, 累计耗时)}"""
+        with self.lock:
+            try:
+                self._catch_up()
+            except OSError as e:
+                logger.warning(f"读取追踪记录失败: {e}")
+            return {name: (np.array(values), self._counts[name], self._sums[name]) for name, values in self._durations.items()}
+
+
+tracer = Tracer()
+span_reader = SpanReader()